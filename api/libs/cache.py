@@ -0,0 +1,83 @@
+import time
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+
+class CredentialCache():
+    '''
+    A bounded, thread-safe LRU cache with a time-to-live for API
+    credentials, keyed by user ID.
+
+    Entries are dropped by signal handlers when the User or SharedSecret
+    behind them changes. Those signals only reach the current process,
+    so the TTL bounds how long other worker processes may keep using a
+    changed credential.
+    '''
+    def __init__(self, maxsize=1024, ttl=300):
+        '''
+        :param int maxsize: The largest number of users to keep.
+        :param float ttl: The number of seconds an entry stays valid.
+        '''
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, userid):
+        '''
+        Return the cached `(user, shared_secret)` tuple for `userid`, or
+        None if it is missing or expired.
+        '''
+        with self._lock:
+            try:
+                expires, value = self._entries[userid]
+            except KeyError:
+                self.misses += 1
+                return None
+
+            if expires < time.monotonic():
+                del self._entries[userid]
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(userid)
+            self.hits += 1
+            return value
+
+    def put(self, userid, user, shared_secret):
+        '''
+        Store the credentials of `userid`, evicting the least recently
+        used entry if the cache is full.
+        '''
+        with self._lock:
+            self._entries[userid] = (time.monotonic() + self.ttl,
+                                     (user, shared_secret))
+            self._entries.move_to_end(userid)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, userid):
+        with self._lock:
+            self._entries.pop(userid, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        '''
+        Return a dict with the hit and miss counters and current size.
+        '''
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'size': len(self._entries)}
+
+
+#: The credential cache shared by every API request in this process
+credentials = CredentialCache(
+    maxsize=getattr(settings, 'GRAVEL_CREDENTIAL_CACHE_SIZE', 1024),
+    ttl=getattr(settings, 'GRAVEL_CREDENTIAL_CACHE_TTL', 300))
@@ -0,0 +1,257 @@
+'''
+Token-bucket rate limits for the API.
+
+Every API user has a bucket per endpoint. A bucket holds up to `burst`
+tokens and refills at `rate` tokens per second; each call takes one
+token, and a call that finds the bucket empty is refused with a 429 and
+a Retry-After header. Endpoints set their limit with the `rate_limit`
+decorator; the others use `GRAVEL_API_RATE_LIMIT`. `api_get_tokens`
+also draws the number of request tokens it issues from a bucket of its
+own, `GRAVEL_API_TOKEN_RATE_LIMIT`.
+
+All authenticated API calls together also draw from one bucket,
+`GRAVEL_API_CAPACITY`. When it is empty, API calls are refused with a
+503 before their view runs, leaving the workers to the HTML pages,
+which never draw from any bucket. The default is meant to only come
+into play when the API floods a small deployment; size it to what the
+API workers can serve, or set it to None to turn shedding off.
+
+Buckets live in a fixed-size table of slots. When
+`GRAVEL_RATE_LIMIT_FILE` is set, the table is a memory-mapped file
+shared by every worker process, with the slots of a key locked while it
+is updated; otherwise every process has its own table. Keys are hashed
+to a set of `WAYS` slots. A key that is not in its set takes the set's
+least recently used slot, with a full bucket, so keys only lose their
+buckets when more than `WAYS` busy keys share a set, and then only ever
+to the advantage of the caller. The capacity bucket of the whole API
+has a slot of its own.
+
+Set `GRAVEL_RATE_LIMITS` to False to turn all of this off.
+'''
+import os
+import math
+import mmap
+import time
+import struct
+import hashlib
+import threading
+from contextlib import contextmanager
+
+import django.http
+from django.conf import settings
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+
+#: The layout of a slot: the key's tag, the tokens left in the bucket
+#: and the time they were counted
+SLOT = struct.Struct('=Qdd')
+
+#: The number of slots a key may be stored in
+WAYS = 4
+
+#: The key of the bucket shared by all API calls
+API_KEY = 'api'
+
+#: The default (rate, burst) of each user's bucket for an endpoint
+DEFAULT_RATE_LIMIT = (10, 100)
+
+#: The default (rate, burst) of the capacity shared by all API calls
+DEFAULT_API_CAPACITY = (100, 1000)
+
+#: The default (rate, burst) of request tokens issued to each user;
+#: the burst must cover the largest single request for tokens
+DEFAULT_TOKEN_RATE_LIMIT = (10, 2048)
+
+
+class BucketStore():
+    '''
+    A table of token buckets, optionally shared between processes
+    through a memory-mapped file.
+    '''
+    def __init__(self, path=None, slots=4096, clock=time.time,
+                 reserved=(API_KEY,)):
+        '''
+        :param str path: The file to share the buckets through, or None
+          to keep them in this process.
+        :param int slots: The number of buckets in the table, rounded
+          up to a multiple of `WAYS`.
+        :param clock: A function returning the current time in seconds;
+          processes sharing a file must agree on it.
+        :param reserved: Keys that get a slot of their own, before the
+          others; processes sharing a file must agree on them.
+        '''
+        self.path = path
+        self.sets = max(-(-slots // WAYS), 1)
+        self.reserved = {key: i for i, key in enumerate(reserved)}
+        self.slots = len(self.reserved) + self.sets * WAYS
+        self.clock = clock
+        self._buffer = None
+        self._fd = None
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    def _open(self):
+        size = SLOT.size * self.slots
+        if self.path is None or fcntl is None:
+            self._buffer = bytearray(size)
+            return
+
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.lockf(fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)
+        finally:
+            fcntl.lockf(fd, fcntl.LOCK_UN)
+        self._fd = fd
+        self._buffer = mmap.mmap(fd, size)
+
+    @contextmanager
+    def _locked(self, offset, length=SLOT.size):
+        '''
+        Hold `length` bytes of the table from `offset` against other
+        threads and processes; a length of 0 holds the whole table.
+        '''
+        if os.getpid() != self._pid:
+            # A lock held by another thread at the fork stays held
+            self._pid = os.getpid()
+            self._lock = threading.Lock()
+
+        with self._lock:
+            if self._buffer is None:
+                self._open()
+            if self._fd is None:
+                yield
+                return
+
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, length, offset)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, length, offset)
+
+    def take(self, key, rate, burst, cost=1):
+        '''
+        Take `cost` tokens from the bucket for `key`, which refills at
+        `rate` tokens per second up to `burst` tokens.
+
+        :returns: 0 if the tokens were taken; otherwise nothing is taken
+          and the number of seconds until there will be enough.
+        '''
+        digest = hashlib.sha1(key.encode('utf8')).digest()
+        # The tag is never 0, so an empty slot never matches
+        tag = int.from_bytes(digest[:8], 'big') | 1
+        if key in self.reserved:
+            first, ways = self.reserved[key], 1
+        else:
+            first = len(self.reserved) + (tag >> 1) % self.sets * WAYS
+            ways = WAYS
+
+        with self._locked(first * SLOT.size, ways * SLOT.size):
+            now = self.clock()
+            # The slot holding the key, or else the least recently used
+            victim = None
+            for offset in range(first * SLOT.size, (first + ways) * SLOT.size,
+                                SLOT.size):
+                stored, tokens, counted = SLOT.unpack_from(self._buffer,
+                                                           offset)
+                if stored == tag:
+                    break
+                if victim is None or counted < victim[1]:
+                    victim = (offset, counted)
+            else:
+                offset = victim[0]
+                tokens, counted = burst, now
+            tokens = min(burst, tokens + max(now - counted, 0) * rate)
+
+            if tokens >= cost:
+                tokens -= cost
+                wait = 0
+            else:
+                wait = (cost - tokens) / rate
+            SLOT.pack_into(self._buffer, offset, tag, tokens, now)
+        return wait
+
+    def clear(self):
+        '''
+        Refill every bucket.
+        '''
+        with self._locked(0, 0):
+            self._buffer[:] = bytes(len(self._buffer))
+
+
+def rate_limit(rate, burst):
+    '''
+    Limit each user to `burst` calls to the decorated API view at once,
+    refilled at `rate` calls per second.
+
+    Apply this outside `ValidateApiRequest`, which enforces it.
+    '''
+    def decorator(view):
+        view.rate_limit = (rate, burst)
+        return view
+    return decorator
+
+
+def enabled():
+    return getattr(settings, 'GRAVEL_RATE_LIMITS', True)
+
+
+def retry_after(response, wait):
+    '''
+    Set the Retry-After header of `response` to `wait` seconds, rounded
+    up to whole seconds, and return it.
+    '''
+    response['Retry-After'] = str(max(int(math.ceil(wait)), 1))
+    return response
+
+
+def shed_wait(cost=1):
+    '''
+    Take `cost` calls from the capacity of the whole API.
+
+    :returns: 0 if the calls may go ahead, otherwise the seconds until
+      the API has capacity again.
+    '''
+    capacity = getattr(settings, 'GRAVEL_API_CAPACITY', DEFAULT_API_CAPACITY)
+    if not enabled() or capacity is None:
+        return 0
+    # More than the burst could never be taken
+    return buckets.take(API_KEY, *capacity, cost=min(cost, capacity[1]))
+
+
+def user_wait(user, name, limit=None, cost=1):
+    '''
+    Take `cost` tokens from `user`'s bucket named `name`.
+
+    :param tuple limit: The (rate, burst) of the bucket, or None for
+      `GRAVEL_API_RATE_LIMIT`.
+    :returns: 0 if the tokens were taken, otherwise the seconds until
+      there will be enough.
+    '''
+    if not enabled():
+        return 0
+    if limit is None:
+        limit = getattr(settings, 'GRAVEL_API_RATE_LIMIT', DEFAULT_RATE_LIMIT)
+    return buckets.take('%i:%s' % (user.pk, name), *limit, cost=cost)
+
+
+def too_many_requests(wait):
+    response = django.http.HttpResponse('Rate limit exceeded', status=429)
+    return retry_after(response, wait)
+
+
+def over_capacity(wait):
+    response = django.http.HttpResponse('API over capacity', status=503)
+    return retry_after(response, wait)
+
+
+#: The buckets shared by every API request in this process, and in
+#: every process when `GRAVEL_RATE_LIMIT_FILE` is set
+buckets = BucketStore(
+    path=getattr(settings, 'GRAVEL_RATE_LIMIT_FILE', None),
+    slots=getattr(settings, 'GRAVEL_RATE_LIMIT_SLOTS', 4096))
@@ -0,0 +1,235 @@
+'''
+Issuing and redeeming one-time request tokens.
+
+Tokens come in two forms. Database tokens are random strings stored as
+`RequestToken` rows until they are redeemed. Signed tokens are stateless:
+they carry their own expiry and a random nonce, signed with a key
+derived from `SECRET_KEY`, so issuing them writes nothing. Replays of a
+signed token are refused by recording its nonce as a `SpentNonce` when
+it is redeemed.
+
+`GRAVEL_API_TOKEN_MODE` selects the form handed out by `issue_tokens`
+('database', the default, or 'signed'). Both forms are always accepted
+by `redeem_token` so that switching modes does not invalidate tokens
+that are already outstanding.
+'''
+import os
+import hmac
+import time
+import logging
+import threading
+import hashlib
+import binascii
+import datetime
+
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.utils import timezone
+
+from api import models
+from api.models import TOKEN_LIFETIME
+from gravel.metrics import TOKENS_ISSUED, TOKENS_REDEEMED
+
+
+#: The width in seconds of the buckets that spent nonces are grouped in
+NONCE_BUCKET_SECONDS = 3600
+
+#: The number of random bytes in the nonce of a signed token
+NONCE_BYTES = 16
+
+logger = logging.getLogger(__name__)
+
+
+def token_mode():
+    return getattr(settings, 'GRAVEL_API_TOKEN_MODE', 'database')
+
+
+def _signing_key():
+    return hashlib.sha256(b'gravel.api.tokens:' +
+                          settings.SECRET_KEY.encode('utf8')).digest()
+
+
+def _sign(key, userid, expires, nonce):
+    message = ('%i:%i:%s' % (userid, expires, nonce)).encode('ascii')
+    return hmac.new(key, message, hashlib.sha256).hexdigest()[:32]
+
+
+def is_signed_token(token):
+    return '.' in token
+
+
+def build_signed_tokens(user, count=1):
+    '''
+    Generate signed tokens for the given user without touching the
+    database.
+
+    :returns: a `(expires, tokens)` tuple of the expiry datetime and a
+      list of token strings.
+    '''
+    expires = int(time.time() + TOKEN_LIFETIME.total_seconds())
+    key = _signing_key()
+    entropy = binascii.hexlify(os.urandom(NONCE_BYTES * count)).decode()
+
+    tokens = []
+    width = NONCE_BYTES * 2
+    for i in range(count):
+        nonce = entropy[i * width:(i + 1) * width]
+        signature = _sign(key, user.pk, expires, nonce)
+        tokens.append('%i.%s.%s' % (expires, nonce, signature))
+
+    expiry = datetime.datetime.fromtimestamp(expires, timezone.utc)
+    return expiry, tokens
+
+
+def redeem_signed_token(user, token):
+    '''
+    Check the signature and expiry of a signed token and mark its
+    nonce as spent.
+
+    :returns: True if the token is valid and had not been used before.
+    '''
+    try:
+        expires, nonce, signature = token.split('.')
+        expires = int(expires)
+    except ValueError:
+        return False
+
+    expected = _sign(_signing_key(), user.pk, expires, nonce)
+    if not hmac.compare_digest(expected, signature):
+        return False
+    if expires < time.time():
+        return False
+
+    try:
+        with transaction.atomic():
+            models.SpentNonce.objects.create(
+                bucket=expires // NONCE_BUCKET_SECONDS, nonce=nonce)
+    except IntegrityError:
+        return False
+    return True
+
+
+def issue_tokens(user, count=1):
+    '''
+    Generate `count` tokens for the given user in the configured mode.
+
+    :returns: a `(expires, tokens)` tuple of the expiry datetime and a
+      list of token strings.
+    '''
+    mode = token_mode()
+    TOKENS_ISSUED.inc(count, mode=mode)
+    if mode == 'signed':
+        return build_signed_tokens(user, count)
+
+    tokens = models.RequestToken.build_tokens(user, count)
+    expires = timezone.now() + TOKEN_LIFETIME
+    if tokens:
+        expires = tokens[0].expires
+    return expires, [token.token for token in tokens]
+
+
+def redeem_token(user, token):
+    '''
+    Redeem a token of either form for the given user.
+
+    :returns: True if the token was valid and is now spent.
+    '''
+    if is_signed_token(token):
+        redeemed = redeem_signed_token(user, token)
+    else:
+        redeemed = redeem_database_token(user, token)
+
+    TOKENS_REDEEMED.inc(result='accepted' if redeemed else 'rejected')
+    return redeemed
+
+
+def redeem_database_token(user, token):
+    '''
+    Spend a `RequestToken` row by deleting it. Of several requests
+    redeeming the same token at once, only the one whose delete removed
+    the row accepts it; Django's `delete()` does not say how many rows
+    it removed, so the delete is done in SQL.
+    '''
+    meta = models.RequestToken._meta
+    expires = meta.get_field('expires').get_db_prep_value(
+        timezone.now(), connection)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'DELETE FROM %s WHERE %s = %%s AND %s = %%s AND %s > %%s' % (
+                connection.ops.quote_name(meta.db_table),
+                connection.ops.quote_name(meta.get_field('user').column),
+                connection.ops.quote_name(meta.get_field('token').column),
+                connection.ops.quote_name(meta.get_field('expires').column)),
+            [user.pk, token, expires])
+        return cursor.rowcount == 1
+
+
+def _purge_in_batches(queryset, batch_size):
+    while True:
+        start = time.perf_counter()
+        pks = list(queryset.values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            return
+        queryset.model.objects.filter(pk__in=pks).delete()
+        yield len(pks), time.perf_counter() - start
+
+
+def purge_expired(batch_size=1000):
+    '''
+    Delete expired RequestTokens, then spent nonces whose tokens have
+    all expired, at most `batch_size` rows per statement so that no
+    delete holds its locks for long.
+
+    This is a generator; it yields a `(model, deleted, seconds)` tuple
+    after each batch and must be consumed for the purge to run.
+    '''
+    expired = models.RequestToken.objects.filter(expires__lte=timezone.now())
+    for deleted, seconds in _purge_in_batches(expired, batch_size):
+        yield models.RequestToken, deleted, seconds
+
+    bucket = int(time.time()) // NONCE_BUCKET_SECONDS
+    spent = models.SpentNonce.objects.filter(bucket__lt=bucket)
+    for deleted, seconds in _purge_in_batches(spent, batch_size):
+        yield models.SpentNonce, deleted, seconds
+
+
+class PurgeThread(threading.Thread):
+    '''
+    A daemon thread that runs `purge_expired` every `interval` seconds.
+    '''
+    def __init__(self, interval, batch_size=1000):
+        super().__init__(name='gravel-token-purge', daemon=True)
+        self.interval = interval
+        self.batch_size = batch_size
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                for model, deleted, seconds in purge_expired(self.batch_size):
+                    logger.info('Purged %i %s rows in %.3fs', deleted,
+                                model.__name__, seconds)
+            except Exception:
+                logger.exception('Purging expired tokens failed')
+            finally:
+                # Each run is a fresh unit of work; don't hold a
+                # connection open between runs
+                connection.close()
+
+    def stop(self):
+        self.stopped.set()
+
+
+def start_purge_thread():
+    '''
+    Start a `PurgeThread` if `GRAVEL_TOKEN_PURGE_INTERVAL` is set.
+
+    :returns: the started thread, or None.
+    '''
+    interval = getattr(settings, 'GRAVEL_TOKEN_PURGE_INTERVAL', None)
+    if not interval:
+        return None
+
+    thread = PurgeThread(interval)
+    thread.start()
+    return thread
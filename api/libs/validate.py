@@ -5,6 +5,19 @@ import json
 import django.http
 from django.contrib.auth.models import User
 from api import models
+from api.libs import ratelimit
+from api.libs.cache import credentials
+from api.libs.tokens import redeem_token
+from gravel.metrics import API_REJECTIONS
+from gravel.queries import view_name
+
+
+def reject(reason, response):
+    '''
+    Count a refused API request under `reason` and return `response`.
+    '''
+    API_REJECTIONS.inc(reason=reason)
+    return response
 
 
 class ValidateApiRequest():
@@ -15,7 +28,8 @@ class ValidateApiRequest():
         '''
         Check that `request` is a POST request that contains the
         headers to indicate that it is a Gravel request with a user ID
-        and a valid HMAC.
+        and a valid HMAC, and that neither the API nor the user is over
+        its rate limit.
         
         If the request is valid, forward it to the view along with the
         User object for the requesting user. Otherwise, return an
@@ -23,43 +37,83 @@ class ValidateApiRequest():
         '''
         # Check that the request is using the POST method
         if request.method != 'POST':
-            return django.http.HttpResponseNotAllowed(['POST'])
+            return reject('method',
+                          django.http.HttpResponseNotAllowed(['POST']))
 
         # Check that the Gravel User ID header is present
         if 'HTTP_X_GRAVEL_USER_ID' not in request.META:
-            return django.http.HttpResponseForbidden('No User ID specified')
+            return reject('missing_user', django.http.HttpResponseForbidden(
+                'No User ID specified'))
         if 'HTTP_X_GRAVEL_HMAC_SHA256' not in request.META:
-            return django.http.HttpResponseForbidden('No HMAC given')
+            return reject('missing_hmac', django.http.HttpResponseForbidden(
+                'No HMAC given'))
         if 'CONTENT_TYPE' not in request.META:
-            return django.http.HttpResponseBadRequest('Missing Content-Type')
+            return reject('content_type', django.http.HttpResponseBadRequest(
+                'Missing Content-Type'))
         if request.META['CONTENT_TYPE'] != 'application/json':
-            return django.http.HttpResponseBadRequest('Non-JSON Content-Type')
+            return reject('content_type', django.http.HttpResponseBadRequest(
+                'Non-JSON Content-Type'))
 
         # Check that the user exists and has API access permission
         try:
             userid = int(request.META['HTTP_X_GRAVEL_USER_ID'])
-            user = User.objects.get(pk=userid)
+            user, shared_secret = self.get_credentials(userid)
         except ValueError:
-            return django.http.HttpResponseBadRequest('Non-integer User ID')
+            return reject('bad_user', django.http.HttpResponseBadRequest(
+                'Non-integer User ID'))
         except User.DoesNotExist:
-            return django.http.HttpResponseForbidden('User ID does not exist')
+            return reject('unknown_user', django.http.HttpResponseForbidden(
+                'User ID does not exist'))
 
         # TODO: check that the user has API access permission
 
         # Check that the HMAC is valid
-        if not self.validate_request_hmac(request, user):
-            return django.http.HttpResponseForbidden('Invalid HMAC')
+        if not self.validate_request_hmac(request, user, shared_secret):
+            return reject('bad_hmac', django.http.HttpResponseForbidden(
+                'Invalid HMAC'))
+
+        # Shed API calls when the API is over capacity, keeping the
+        # workers for the HTML pages; only authenticated calls count,
+        # so junk requests cannot use up the capacity
+        wait = ratelimit.shed_wait()
+        if wait:
+            return reject('shed', ratelimit.over_capacity(wait))
+
+        # Check the user's rate limit for this view
+        wait = ratelimit.user_wait(user, view_name(self.view),
+                                   getattr(self, 'rate_limit', None))
+        if wait:
+            return reject('rate_limited', ratelimit.too_many_requests(wait))
 
         # Parse the JSON data
         try:
             data = json.loads(request.body.decode('utf8'))
         except ValueError:
-            return django.http.HttpResponseBadRequest('Invalid JSON data')
+            return reject('bad_json', django.http.HttpResponseBadRequest(
+                'Invalid JSON data'))
 
         # The checks pass; forward the request and the user to the View
         return self.view(request, user, data, *args, **kwargs)
 
-    def validate_request_hmac(self, request, user):
+    @staticmethod
+    def get_credentials(userid):
+        '''
+        Return the User and shared secret for `userid`, from the
+        credential cache when possible.
+
+        :raises django.contrib.auth.models.User.DoesNotExist: if there
+          is no user with the given ID.
+        '''
+        cached = credentials.get(userid)
+        if cached is not None:
+            return cached
+
+        user = User.objects.get(pk=userid)
+        shared_secret = models.SharedSecret.get_or_create(user)
+        credentials.put(userid, user, shared_secret)
+        return user, shared_secret
+
+    def validate_request_hmac(self, request, user, shared_secret=None):
         '''
         Grab the shared secret for the given user and use it to
         validate the HMAC given in the message headers.
@@ -68,16 +122,19 @@ class ValidateApiRequest():
           that contains the headers, POST data, etc.
         :param django.contrib.auth.models.User user: A user object that
           the request is claiming to be the originating user.
+        :param bytes shared_secret: The shared secret of `user`, if the
+          caller already has it.
         :returns: a boolean value; `true` indicates a valid request;
           `false` indicates an invalid request
         '''
         if 'HTTP_X_GRAVEL_HMAC_SHA256' not in request.META:
             return False
 
-        try:
-            shared_secret = models.SharedSecret.get_or_create(user)
-        except models.SharedSecret.DoesNotExist:
-            return False
+        if shared_secret is None:
+            try:
+                shared_secret = models.SharedSecret.get_or_create(user)
+            except models.SharedSecret.DoesNotExist:
+                return False
 
         digest = hmac.new(shared_secret, request.body, sha256).hexdigest()
         return self.__safe_compare(digest, request.META['HTTP_X_GRAVEL_HMAC_SHA256'])
@@ -116,21 +173,23 @@ class ValidateToken():
         Check that `request` contains the expected token data for a
         request from the User ID specified in the headers.
         
-        If the request is valid, delete the token object and forward
-        the request to the view. Otherwise, return an error code.
+        If the request is valid, spend the token and forward the
+        request to the view. Otherwise, return an error code.
         
         This should follow the ValidateApiRequest decorator because it
         requires a user object, which that decorator fetches.
         '''
         try:
             tokenstr = data['token']
-        except IndexError:
-            return django.http.HttpResponseBadRequest('Missing token in JSON')
-
-        try:
-            token = models.RequestToken.objects.get(user=user, token=tokenstr)
-            token.delete()
-        except models.RequestToken.DoesNotExist:
-            return django.http.HttpResponseForbidden('Invalid token used')
+        except KeyError:
+            return reject('missing_token', django.http.HttpResponseBadRequest(
+                'Missing token in JSON'))
+
+        if not isinstance(tokenstr, str):
+            return reject('bad_token', django.http.HttpResponseBadRequest(
+                'Non-string token'))
+        if not redeem_token(user, tokenstr):
+            return reject('bad_token', django.http.HttpResponseForbidden(
+                'Invalid token used'))
 
         return self.view(request, user, data, *args, **kwargs)
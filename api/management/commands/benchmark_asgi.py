@@ -0,0 +1,133 @@
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.core.wsgi import get_wsgi_application
+from django.test.utils import override_settings
+
+from gravel.asgi import AsgiAdapter
+
+
+class Command(BaseCommand):
+    help = ('Serve many clients that upload their request bodies and read '
+            'their responses slowly, first holding a thread per request '
+            'from its first byte to its last, as a threaded WSGI server '
+            'does, then through gravel.asgi with the same number of '
+            'threads, and report how long each took. Requests go through '
+            'the full Django stack in this process, without sockets.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=200,
+                            help='Number of clients, all connecting at once')
+        parser.add_argument('--threads', type=int, default=8,
+                            help='Number of threads handling requests')
+        parser.add_argument('--method', default='GET',
+                            help='Method of every request')
+        parser.add_argument('--path', default='/problem/list/all',
+                            help='Path that every client requests')
+        parser.add_argument('--body', type=int, default=4096,
+                            help='Size in bytes of each request body')
+        parser.add_argument('--chunks', type=int, default=4,
+                            help='Number of pieces each body is sent in')
+        parser.add_argument('--delay', type=float, default=0.05,
+                            help='Seconds each client waits before sending '
+                                 'each piece of its body')
+        parser.add_argument('--read-delay', type=float, default=0,
+                            help='Seconds each client takes to read each '
+                                 'piece of its response')
+
+    def handle(self, *args, **options):
+        self.options = options
+        size = max(options['body'] // max(options['chunks'], 1), 1)
+        self.chunks = [b'x' * size] * max(options['chunks'], 1)
+        self.scope = {
+            'type': 'http', 'method': options['method'],
+            'path': options['path'],
+            'query_string': b'', 'server': ('testserver', 80),
+            'headers': [(b'content-type', b'application/octet-stream')],
+        }
+
+        self.stdout.write('%i clients, %i threads, %i x %i byte chunks '
+                          'every %.3fs' % (
+                              options['clients'], options['threads'],
+                              len(self.chunks), size, options['delay']))
+        self.stdout.write('%-10s %10s %10s %10s' % (
+            'server', 'seconds', 'req/s', 'statuses'))
+
+        application = get_wsgi_application()
+        with override_settings(ALLOWED_HOSTS=['testserver']):
+            for name, run in (('threaded', self.run_threaded),
+                              ('asgi', self.run_asgi)):
+                start = time.perf_counter()
+                statuses = run(application)
+                seconds = time.perf_counter() - start
+                self.stdout.write('%-10s %10.2f %10.1f %10s' % (
+                    name, seconds, len(statuses) / seconds,
+                    ','.join('%ix%i' % (statuses.count(status), status)
+                             for status in sorted(set(statuses)))))
+
+    def run_threaded(self, application):
+        '''
+        Serve every client with a pool of threads, each of which waits
+        for a client's whole body and writes its whole response.
+        '''
+        def serve():
+            for chunk in self.chunks:
+                time.sleep(self.options['delay'])
+            environ = AsgiAdapter.environ(self.scope, b''.join(self.chunks))
+
+            status = []
+
+            def start_response(line, headers, exc_info=None):
+                status.append(int(line.split(' ', 1)[0]))
+
+            response = application(environ, start_response)
+            try:
+                for chunk in response:
+                    time.sleep(self.options['read_delay'])
+            finally:
+                if hasattr(response, 'close'):
+                    response.close()
+            return status[0]
+
+        with ThreadPoolExecutor(self.options['threads']) as executor:
+            futures = [executor.submit(serve)
+                       for i in range(self.options['clients'])]
+            return [future.result() for future in futures]
+
+    def run_asgi(self, application):
+        '''
+        Serve every client through an `AsgiAdapter` with a pool of the
+        same size.
+        '''
+        adapter = AsgiAdapter(application, threads=self.options['threads'])
+
+        async def client():
+            chunks = list(self.chunks)
+            status = []
+
+            async def receive():
+                await asyncio.sleep(self.options['delay'])
+                body = chunks.pop(0)
+                return {'type': 'http.request', 'body': body,
+                        'more_body': bool(chunks)}
+
+            async def send(message):
+                if message['type'] == 'http.response.start':
+                    status.append(message['status'])
+                elif message.get('body'):
+                    await asyncio.sleep(self.options['read_delay'])
+
+            await adapter(self.scope, receive, send)
+            return status[0]
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            return loop.run_until_complete(asyncio.gather(
+                *[client() for i in range(self.options['clients'])]))
+        finally:
+            adapter.executor.shutdown(wait=True)
+            asyncio.set_event_loop(None)
+            loop.close()
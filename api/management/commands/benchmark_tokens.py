@@ -0,0 +1,100 @@
+import os
+import time
+import binascii
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from api import models
+from api.libs.tokens import redeem_token
+
+
+class Command(BaseCommand):
+    help = ('Measure RequestToken issue and redeem latency as the number '
+            'of outstanding tokens grows. Everything the benchmark writes '
+            'is rolled back when it finishes.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--outstanding', default='10000,100000,1000000',
+                            help='Comma-separated numbers of outstanding '
+                                 'tokens to measure at')
+        parser.add_argument('--samples', type=int, default=200,
+                            help='Number of issue and redeem calls to time '
+                                 'at each level')
+        parser.add_argument('--issue-count', type=int, default=16,
+                            help='Number of tokens issued per issue call')
+
+    def handle(self, *args, **options):
+        levels = sorted(int(level) for level in
+                        options['outstanding'].split(','))
+
+        self.stdout.write('%12s %12s %12s %12s %12s' % (
+            'outstanding', 'issue p50', 'issue p95', 'redeem p50',
+            'redeem p95'))
+
+        with transaction.atomic():
+            suffix = binascii.hexlify(os.urandom(4)).decode('ascii')
+            user = User.objects.create(username='benchmark-tokens-' + suffix)
+            outstanding = 0
+            for level in levels:
+                self.seed(user, level - outstanding)
+                outstanding = level
+
+                issue, redeem = self.measure(user, options['samples'],
+                                             options['issue_count'])
+                self.stdout.write('%12i %10.3fms %10.3fms %10.3fms %10.3fms'
+                                  % (level,
+                                     percentile(issue, 50),
+                                     percentile(issue, 95),
+                                     percentile(redeem, 50),
+                                     percentile(redeem, 95)))
+
+            transaction.set_rollback(True)
+
+    @staticmethod
+    def seed(user, count, batch_size=10000):
+        '''
+        Store `count` random tokens for `user` in bulk.
+        '''
+        expires = timezone.now() + models.TOKEN_LIFETIME
+        while count > 0:
+            size = min(count, batch_size)
+            entropy = binascii.hexlify(os.urandom(32 * size)).decode('ascii')
+            models.RequestToken.objects.bulk_create(
+                models.RequestToken(user=user, token=entropy[i:i + 64],
+                                    expires=expires)
+                for i in range(0, 64 * size, 64))
+            count -= size
+
+    @staticmethod
+    def measure(user, samples, issue_count):
+        '''
+        Time `samples` issue calls and as many redeem calls.
+
+        :returns: a `(issue, redeem)` tuple of latency lists in
+          milliseconds.
+        '''
+        issue = []
+        issued = []
+        for i in range(samples):
+            start = time.perf_counter()
+            tokens = models.RequestToken.build_tokens(user, issue_count)
+            issue.append((time.perf_counter() - start) * 1000)
+            issued.append(tokens[0].token)
+
+        redeem = []
+        for token in issued:
+            start = time.perf_counter()
+            if not redeem_token(user, token):
+                raise AssertionError('Freshly issued token was rejected')
+            redeem.append((time.perf_counter() - start) * 1000)
+
+        return issue, redeem
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    index = min(len(values) - 1, int(len(values) * percent / 100))
+    return values[index]
@@ -0,0 +1,354 @@
+import os
+import json
+import time
+import binascii
+
+import django.test
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import timezone
+
+from api import models as api_models
+from api.libs.signing import GravelApiRequestFactory
+from api.libs.tokens import issue_tokens
+from api.management.commands import benchmark_tokens
+from api.management.commands.benchmark_tokens import percentile
+from problems import models, utils
+from problems.render import RENDER_VERSION, render_markdown
+
+
+#: Words that seeded problems are written with, and searched for
+WORDS = ('database', 'deadlock', 'timeout', 'printer', 'network', 'login',
+         'upload', 'report', 'latency', 'cache', 'disk', 'email')
+
+#: Problems created per bulk insert while seeding
+SEED_BATCH_SIZE = 1000
+
+
+class Command(BaseCommand):
+    help = ('Seed problems, replies, tags and tokens at the given volumes, '
+            'drive every view in problems.views and api.views through the '
+            'full request stack, and report latency percentiles, throughput '
+            'and queries per request. Everything the benchmark writes is '
+            'rolled back when it finishes.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--problems', type=int, default=1000,
+                            help='Number of problems to seed')
+        parser.add_argument('--replies', type=int, default=10,
+                            help='Number of replies to seed per problem')
+        parser.add_argument('--tags', type=int, default=50,
+                            help='Number of tags to seed')
+        parser.add_argument('--tokens', type=int, default=10000,
+                            help='Number of outstanding API tokens to seed')
+        parser.add_argument('--samples', type=int, default=100,
+                            help='Number of requests to time per view')
+        parser.add_argument('--warmup', type=int, default=5,
+                            help='Number of untimed requests to send to '
+                                 'each view first')
+        parser.add_argument('--only', default='',
+                            help='Comma-separated names of the views to '
+                                 'run; all of them by default')
+        parser.add_argument('--save-baseline', metavar='PATH',
+                            help='Write the results to PATH as JSON')
+        parser.add_argument('--baseline', metavar='PATH',
+                            help='Compare the results with a baseline '
+                                 'written by --save-baseline and fail if '
+                                 'any view regressed')
+        parser.add_argument('--tolerance', type=float, default=0.25,
+                            help='Fraction by which p95 latency may exceed '
+                                 'the baseline before it is a regression')
+
+    def handle(self, *args, **options):
+        volumes = {name: options[name] for name in
+                   ('problems', 'replies', 'tags', 'tokens')}
+        only = set(filter(None, options['only'].split(',')))
+
+        results = {}
+        # The test client sends requests for the host 'testserver', and
+        # the benchmark calls the API far faster than its rate limits
+        with override_settings(ALLOWED_HOSTS=['testserver'],
+                               GRAVEL_RATE_LIMITS=False), \
+                transaction.atomic():
+            self.stdout.write('Seeding %(problems)i problems, %(replies)i '
+                              'replies each, %(tags)i tags and %(tokens)i '
+                              'tokens' % volumes)
+            bench = Bench(**volumes)
+
+            self.stdout.write('%-24s %10s %10s %10s %10s %8s' % (
+                'view', 'p50', 'p95', 'p99', 'req/s', 'queries'))
+            for name, run in bench.scenarios():
+                if only and name not in only:
+                    continue
+                result = bench.measure(run, options['samples'],
+                                       options['warmup'])
+                results[name] = result
+                self.stdout.write(
+                    '%-24s %8.2fms %8.2fms %8.2fms %10.1f %8.1f' % (
+                        name, result['p50'], result['p95'], result['p99'],
+                        result['throughput'], result['queries']))
+
+            transaction.set_rollback(True)
+
+        report = {'volumes': volumes, 'results': results}
+        if options['save_baseline']:
+            with open(options['save_baseline'], 'w') as f:
+                json.dump(report, f, indent=2, sort_keys=True)
+            self.stdout.write('Saved baseline to %s'
+                              % options['save_baseline'])
+
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)
+            regressions = compare(baseline, report, options['tolerance'])
+            if baseline.get('volumes') != volumes:
+                self.stdout.write('Warning: the baseline was measured at '
+                                  'different volumes: %s'
+                                  % baseline.get('volumes'))
+            for regression in regressions:
+                self.stdout.write('REGRESSION ' + regression)
+            if regressions:
+                raise CommandError('%i views regressed' % len(regressions))
+            self.stdout.write('No regressions against %s'
+                              % options['baseline'])
+
+
+def compare(baseline, report, tolerance):
+    '''
+    Compare the results of `report` with those of `baseline`.
+
+    A view regresses if its p95 latency grew by more than `tolerance`,
+    or if it makes more queries per request. Views missing from either
+    side are skipped.
+
+    :returns: a list of strings describing each regression.
+    '''
+    regressions = []
+    for name, result in sorted(report['results'].items()):
+        base = baseline['results'].get(name)
+        if base is None:
+            continue
+        if result['p95'] > base['p95'] * (1 + tolerance):
+            regressions.append('%s: p95 %.2fms, baseline %.2fms' % (
+                name, result['p95'], base['p95']))
+        if round(result['queries']) > round(base['queries']):
+            regressions.append('%s: %.1f queries, baseline %.1f' % (
+                name, result['queries'], base['queries']))
+    return regressions
+
+
+class Bench():
+    '''
+    Seeded data and the requests that exercise each view.
+    '''
+    def __init__(self, problems, replies, tags, tokens):
+        suffix = binascii.hexlify(os.urandom(4)).decode('ascii')
+        self.password = suffix
+        self.user = User.objects.create_user(
+            'benchmark-views-' + suffix, password=self.password)
+        self.tag_names = ['bench-%s-%i' % (suffix, i)
+                          for i in range(max(tags, 1))]
+
+        self.problem_pks = self.seed_problems(problems)
+        self.seed_replies(replies)
+        benchmark_tokens.Command.seed(self.user, tokens)
+
+        self.client = django.test.Client()
+        self.api = GravelApiRequestFactory()
+        self.secret = api_models.SharedSecret.get_or_create(self.user)
+        self.tokens = []
+
+    def seed_problems(self, count):
+        '''
+        Create `count` problems with `utils.create_problems`, each with
+        two tags and three words from `WORDS`.
+
+        :returns: the list of their primary keys.
+        '''
+        pks = []
+        for start in range(0, count, SEED_BATCH_SIZE):
+            problems = []
+            tags = []
+            for i in range(start, min(start + SEED_BATCH_SIZE, count)):
+                words = ' '.join(WORDS[(i * n) % len(WORDS)]
+                                 for n in (1, 3, 7))
+                problems.append(models.Problem(
+                    title='Benchmark problem %i' % i,
+                    description='Seeded *%s* problem' % words))
+                tags.append([self.tag_names[i % len(self.tag_names)],
+                             self.tag_names[(i * 7) % len(self.tag_names)]])
+            utils.create_problems(self.user, problems, tags)
+            pks.extend(problem.pk for problem in problems)
+        return pks
+
+    def seed_replies(self, per_problem):
+        '''
+        Add `per_problem` replies to every seeded problem in bulk.
+        '''
+        if not per_problem:
+            return
+
+        text = 'Seeded reply about the *%s*' % WORDS[0]
+        html = render_markdown(text)
+        for start in range(0, len(self.problem_pks), SEED_BATCH_SIZE):
+            pks = self.problem_pks[start:start + SEED_BATCH_SIZE]
+            models.Reply.objects.bulk_create(
+                models.Reply(problem_id=pk, user=self.user, text=text,
+                             text_html=html, text_html_version=RENDER_VERSION)
+                for pk in pks for i in range(per_problem))
+
+        models.Problem.objects.filter(pk__in=self.problem_pks).update(
+            reply_count=per_problem, last_reply_at=timezone.now(),
+            last_reply_user=self.user)
+
+    def problem(self, i):
+        return self.problem_pks[i % len(self.problem_pks)]
+
+    def tag(self, i):
+        return self.tag_names[i % len(self.tag_names)]
+
+    def token(self):
+        '''
+        Return an unused API token, issuing a new supply when needed.
+        '''
+        if not self.tokens:
+            self.tokens = issue_tokens(self.user, 1024)[1]
+        return self.tokens.pop()
+
+    def api_post(self, path, data, token=False):
+        if token:
+            data['token'] = self.token()
+        datastr = json.dumps(data)
+        headers = {
+            'HTTP_X_GRAVEL_USER_ID': self.user.pk,
+            'HTTP_X_GRAVEL_HMAC_SHA256': self.api.compute_hmac(datastr,
+                                                               self.secret),
+        }
+        return lambda: self.client.post(path, datastr,
+                                        content_type='application/json',
+                                        **headers)
+
+    def scenarios(self):
+        '''
+        Yield a `(name, prepare)` tuple for every view. `prepare(i)`
+        does the untimed setup of the i-th request and returns a
+        callable that sends it.
+        '''
+        client = self.client
+
+        # Anonymous problems.views
+        yield 'problem_report', lambda i: lambda: client.get(
+            '/problem/report/')
+        yield 'problem_submit', lambda i: lambda: client.post(
+            '/problem/report/submit', {
+                'title': 'Submitted problem %i' % i,
+                'description': 'About the *%s*' % WORDS[i % len(WORDS)],
+                'username': 'benchmark'})
+        yield 'problem_view', lambda i: lambda: client.get(
+            '/problem/view/%i/' % self.problem(i))
+        yield 'problem_list', lambda i: lambda: client.get(
+            '/problem/list/all', {'resolved': 'false'})
+        yield 'problem_search', lambda i: lambda: client.get(
+            '/problem/search/', {'q': WORDS[i % len(WORDS)]})
+        yield 'tag_view', lambda i: lambda: client.get(
+            '/problem/tag/%s/view' % self.tag(i))
+
+        # Logged-in problems.views
+        yield 'problem_view_logged_in', self.logged_in(lambda i: (
+            lambda: client.get('/problem/view/%i/' % self.problem(i))))
+        yield 'problem_reply_submit', self.logged_in(lambda i: (
+            lambda: client.post(
+                '/problem/reply/%i/submit' % self.problem(i),
+                {'text': 'Benchmark reply %i' % i})))
+        # problem_edit is not implemented yet
+
+        # api.views
+        yield 'api_get_tokens', lambda i: self.api_post(
+            '/api/get_tokens', {'count': 16})
+        yield 'problem_highest_id', lambda i: self.api_post(
+            '/api/problem/highest_id', {})
+        yield 'problem_reply', lambda i: self.api_post(
+            '/api/problem/replies/submit',
+            {'id': self.problem(i), 'text': 'API reply %i' % i}, token=True)
+        yield 'problem_submit_bulk', lambda i: self.api_post(
+            '/api/problem/submit_bulk', {'problems': [
+                {'title': 'Bulk problem %i.%i' % (i, n),
+                 'description': 'About the %s' % WORDS[n % len(WORDS)],
+                 'tags': [self.tag(i + n)]} for n in range(10)]},
+            token=True)
+        yield 'problem_get_replies', lambda i: self.api_post(
+            '/api/problem/replies/get', {'id': self.problem(i)})
+        yield 'api_problem_search', lambda i: self.api_post(
+            '/api/problem/search', {'query': WORDS[i % len(WORDS)]})
+        yield 'changes', lambda i: self.api_post(
+            '/api/changes', {'limit': 500})
+        # Disjoint pairs of problems, so that no chain grows too long;
+        # the removals undo the additions
+        yield 'problem_dependency_add', lambda i: self.api_post(
+            '/api/problem/dependencies/add',
+            {'id': self.problem(2 * i), 'child': self.problem(2 * i + 1)},
+            token=True)
+        yield 'problem_subtree', lambda i: self.api_post(
+            '/api/problem/subtree', {'id': self.problem(2 * i)})
+        yield 'problem_dependency_remove', lambda i: self.api_post(
+            '/api/problem/dependencies/remove',
+            {'id': self.problem(2 * i), 'child': self.problem(2 * i + 1)},
+            token=True)
+        yield 'tag_get', lambda i: self.api_post(
+            '/api/tag/get', {'name': self.tag(i)})
+        yield 'tag_problems', lambda i: self.api_post(
+            '/api/tag/problems', {'name': self.tag(i)})
+        yield 'tag_all', lambda i: self.api_post('/api/tag/all', {})
+        yield 'batch', lambda i: self.api_post('/api/batch', {'operations': [
+            {'op': 'problem/highest_id'},
+            {'op': 'problem/replies/get', 'data': {'id': self.problem(i)}},
+            {'op': 'tag/get', 'data': {'name': self.tag(i)}},
+        ]}, token=True)
+
+    def logged_in(self, prepare):
+        def logged_in_prepare(i):
+            if i == 0:
+                self.client.login(username=self.user.get_username(),
+                                  password=self.password)
+            return prepare(i)
+        return logged_in_prepare
+
+    def measure(self, prepare, samples, warmup=0):
+        '''
+        Send `warmup` untimed requests built by `prepare`, then
+        `samples` timed ones, timing each one including reading its
+        whole body.
+
+        :returns: a dict of the latency percentiles in milliseconds, the
+          throughput in requests per second and the mean number of
+          queries per request.
+        '''
+        latencies = []
+        queries = 0
+        try:
+            for i in range(warmup + samples):
+                send = prepare(i)
+                with CaptureQueriesContext(connection) as context:
+                    start = time.perf_counter()
+                    response = send()
+                    if response.streaming:
+                        b''.join(response.streaming_content)
+                    elapsed = time.perf_counter() - start
+                if response.status_code >= 400:
+                    raise CommandError('%s answered %i' % (
+                        response.request['PATH_INFO'], response.status_code))
+                if i >= warmup:
+                    latencies.append(elapsed)
+                    queries += len(context)
+        finally:
+            self.client.logout()
+
+        return {
+            'p50': percentile(latencies, 50) * 1000,
+            'p95': percentile(latencies, 95) * 1000,
+            'p99': percentile(latencies, 99) * 1000,
+            'throughput': len(latencies) / sum(latencies),
+            'queries': queries / samples,
+        }
@@ -0,0 +1,30 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from api.libs.tokens import purge_expired
+
+
+class Command(BaseCommand):
+    help = ('Delete expired request tokens and spent nonces in bounded '
+            'batches.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Largest number of rows per DELETE')
+        parser.add_argument('--pause', type=float, default=0,
+                            help='Seconds to sleep between batches')
+
+    def handle(self, *args, **options):
+        totals = {}
+        for model, deleted, seconds in purge_expired(options['batch_size']):
+            name = model.__name__
+            totals[name] = totals.get(name, 0) + deleted
+            self.stdout.write('Deleted %i %s rows in %.3fs' %
+                              (deleted, name, seconds))
+            if options['pause']:
+                time.sleep(options['pause'])
+
+        for name in ('RequestToken', 'SpentNonce'):
+            self.stdout.write('Total %s rows deleted: %i' %
+                              (name, totals.get(name, 0)))
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_auto_20150608_0517'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SpentNonce',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('bucket', models.PositiveIntegerField()),
+                ('nonce', models.CharField(max_length=32)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='spentnonce',
+            unique_together=set([('bucket', 'nonce')]),
+        ),
+    ]
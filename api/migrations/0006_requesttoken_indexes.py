@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+def remove_duplicate_tokens(apps, schema_editor):
+    '''
+    Tokens used to be generated from the clock, so a bulk request could
+    store the same token many times. Keep one row of each.
+    '''
+    RequestToken = apps.get_model('api', 'RequestToken')
+    duplicates = (RequestToken.objects.values('user', 'token')
+                  .annotate(count=Count('pk'), keep=Min('pk'))
+                  .filter(count__gt=1))
+    for duplicate in duplicates:
+        (RequestToken.objects
+         .filter(user=duplicate['user'], token=duplicate['token'])
+         .exclude(pk=duplicate['keep'])
+         .delete())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_spentnonce'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_tokens,
+                             migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='requesttoken',
+            name='expires',
+            field=models.DateTimeField(db_index=True),
+        ),
+        migrations.AlterUniqueTogether(
+            name='requesttoken',
+            unique_together=set([('user', 'token')]),
+        ),
+    ]
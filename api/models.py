@@ -1,18 +1,29 @@
 import os
-import time
 import base64
-import hashlib
+import binascii
 import datetime
 
 from django.db import models
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 from django.contrib.auth.models import User
+from django.utils import timezone
+
+from api.libs.cache import credentials
+
+
+#: How long an issued request token stays valid
+TOKEN_LIFETIME = datetime.timedelta(hours=1)
 
 
 class RequestToken(models.Model):
     user = models.ForeignKey(User)
     token = models.CharField(max_length=64)
 
-    expires = models.DateTimeField()
+    expires = models.DateTimeField(db_index=True)
+
+    class Meta:
+        unique_together = ('user', 'token')
 
     @classmethod
     def build_tokens(cls, user, count=1):
@@ -23,22 +34,31 @@ class RequestToken(models.Model):
           the generated tokens should be valid for.
         :param int count: The number of tokens to generate.
         '''
-        i = 0
-        tokens = []
-
-        expiration = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+        expiration = timezone.now() + TOKEN_LIFETIME
 
-        while i < count:
-            hash = hashlib.sha256(str(time.time()).encode('utf8')).hexdigest()
-            token = RequestToken(user=user, token=hash, expires=expiration)
-            tokens.append(token)
-            i += 1
+        # Draw the randomness for every token in one call to the OS
+        entropy = binascii.hexlify(os.urandom(32 * count)).decode('ascii')
+        tokens = [cls(user=user, token=entropy[i:i + 64], expires=expiration)
+                  for i in range(0, 64 * count, 64)]
 
         cls.objects.bulk_create(tokens)
 
         return tokens
 
 
+class SpentNonce(models.Model):
+    '''
+    The nonce of a redeemed signed request token. Nonces are grouped in
+    buckets by the expiry time of their token, so a whole bucket can be
+    dropped once every token in it has expired.
+    '''
+    bucket = models.PositiveIntegerField()
+    nonce = models.CharField(max_length=32)
+
+    class Meta:
+        unique_together = ('bucket', 'nonce')
+
+
 class SharedSecret(models.Model):
     user = models.OneToOneField(User)
     shared_secret = models.BinaryField(max_length=64)
@@ -52,3 +72,15 @@ class SharedSecret(models.Model):
             obj = cls(user=user, shared_secret=secret)
             obj.save()
             return obj.shared_secret
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_user_credentials(sender, instance, **kwargs):
+    credentials.invalidate(instance.pk)
+
+
+@receiver(post_save, sender=SharedSecret)
+@receiver(post_delete, sender=SharedSecret)
+def invalidate_shared_secret_credentials(sender, instance, **kwargs):
+    credentials.invalidate(instance.user_id)
@@ -4,7 +4,9 @@ import django.test
 from django.contrib.auth.models import User
 
 from api import views
+from api.libs.cache import credentials
 from api.tests import utils
+from gravel.testing import QueryBudgetMixin
 import api.models
 import problems.models
 
@@ -129,6 +131,130 @@ class TestProblemReply(TestWithUser):
         self.skipTest('Not implemented')
 
 
+class TestProblemSubmitBulk(TestWithUser):
+    '''
+    Test that the problem_submit_bulk view creates problems with their
+    tags, counts and search entries.
+    '''
+    def setUp(self):
+        super().setUp()
+        self.factory = utils.GravelApiRequestFactory()
+        self.tokens = api.models.RequestToken.build_tokens(self.user, 3)
+
+    def submit(self, submissions):
+        data = {'problems': submissions, 'token': self.tokens.pop().token}
+        request = self.factory.create_api_request(
+            self.user, '/api/problem/submit_bulk', data)
+        return views.problem_submit_bulk(request)
+
+    def test_expected_case(self):
+        problems.models.ProblemTag.get_or_create('nightly')
+        submissions = [
+            {'title': 'Failure %i' % i, 'description': '*test* %i' % i,
+             'tags': ['nightly', 'unit'] if i % 2 else ['nightly']}
+            for i in range(300)
+        ]
+        response = self.submit(submissions)
+
+        self.assertEqual(response.status_code, 200,
+                         'View returned an HTTP error code')
+        ids = json.loads(response.content.decode('utf8'))['ids']
+        self.assertEqual(len(ids), 300)
+
+        created = problems.models.Problem.objects.in_bulk(ids)
+        for pk, submission in zip(ids, submissions):
+            problem = created[pk]
+            self.assertEqual(problem.title, submission['title'])
+            self.assertEqual(problem.userref, self.user)
+            self.assertIn('<em>test</em>', problem.description_html)
+            self.assertEqual(sorted(t.name for t in problem.tags.all()),
+                             sorted(submission['tags']))
+
+        nightly = problems.models.ProblemTag.objects.get(name='nightly')
+        unit = problems.models.ProblemTag.objects.get(name='unit')
+        self.assertEqual(nightly.problem_count, 300)
+        self.assertEqual(unit.problem_count, 150)
+
+        results = problems.models.SearchTerm.search('failure 299')
+        self.assertEqual([p.pk for p, score in results], [ids[-1]])
+
+    def test_invalid_problem(self):
+        response = self.submit([
+            {'title': 'Valid', 'description': 'test'},
+            {'title': 'x' * 100, 'description': 'test'},
+        ])
+
+        self.assertEqual(response.status_code, 400)
+        rdata = json.loads(response.content.decode('utf8'))
+        self.assertEqual(rdata['index'], 1)
+        self.assertFalse(problems.models.Problem.objects.exists(),
+                         'Problems were saved from an invalid request')
+
+    def test_invalid_tags(self):
+        response = self.submit([
+            {'title': 'Test', 'description': 'test', 'tags': 'nightly'}])
+        self.assertEqual(response.status_code, 400)
+
+    def test_fingerprint(self):
+        '''
+        Test that a problem reported again with the same fingerprint is
+        counted as an occurrence of the first report.
+        '''
+        submission = {'title': 'Crash', 'description': 'test',
+                      'fingerprint': 'crash-in-parser'}
+        first = json.loads(self.submit([submission]).content.decode('utf8'))
+        self.assertEqual(first['created'], [True])
+
+        second = json.loads(self.submit([
+            submission, {'title': 'Other', 'description': 'test'},
+        ]).content.decode('utf8'))
+        self.assertEqual(second['ids'][0], first['ids'][0])
+        self.assertEqual(second['created'], [False, True])
+
+        problem = problems.models.Problem.objects.get(pk=first['ids'][0])
+        self.assertEqual(problem.occurrence_count, 2)
+        self.assertIsNotNone(problem.last_occurred)
+        self.assertEqual(problem.occurrences.get().user, self.user)
+        self.assertEqual(problems.models.Problem.objects.count(), 2)
+
+    def test_fingerprint_repeated_in_batch(self):
+        submission = {'title': 'Crash', 'description': 'test',
+                      'fingerprint': 'crash-in-parser'}
+        response = self.submit([submission] * 3)
+
+        rdata = json.loads(response.content.decode('utf8'))
+        self.assertEqual(len(set(rdata['ids'])), 1)
+        self.assertEqual(rdata['created'], [True, False, False])
+        problem = problems.models.Problem.objects.get()
+        self.assertEqual(problem.occurrence_count, 3)
+        self.assertEqual(problem.occurrences.count(), 2)
+
+    def test_routing(self):
+        tag = problems.models.ProblemTag.get_or_create('database')
+        problems.models.RoutingRule.objects.create(
+            pattern='deadlock', tag=tag, assignee=self.user)
+        response = self.submit([
+            {'title': 'Deadlock', 'description': 'test', 'tags': ['nightly']},
+            {'title': 'Other', 'description': 'test'},
+        ])
+
+        ids = json.loads(response.content.decode('utf8'))['ids']
+        routed, other = (problems.models.Problem.objects.get(pk=pk)
+                         for pk in ids)
+        self.assertEqual(sorted(t.name for t in routed.tags.all()),
+                         ['database', 'nightly'])
+        self.assertEqual(list(routed.assigned_to.all()), [self.user])
+        self.assertFalse(other.tags.exists())
+        self.assertFalse(other.assigned_to.exists())
+
+    def test_invalid_fingerprint(self):
+        response = self.submit([
+            {'title': 'Test', 'description': 'test', 'fingerprint': 12}])
+        self.assertEqual(response.status_code, 400)
+        rdata = json.loads(response.content.decode('utf8'))
+        self.assertEqual(rdata['errors'], 'Invalid fingerprint')
+
+
 class TestProblemGetReplies(TestWithUser):
     '''
     Test that the problem_get_replies view returns the correct reply
@@ -167,7 +293,7 @@ class TestProblemGetReplies(TestWithUser):
         self.assertEqual(response.status_code, 200,
                          'View returned an HTTP error code')
 
-        rdata = json.loads(response.content.decode('utf8'))
+        rdata = json.loads(b''.join(response).decode('utf8'))
         self.assertEqual(rdata['problemid'], problem.pk,
                          'Response included an unexpected `problemid` value')
         self.assertEqual(len(rdata['replies']), 0,
@@ -200,7 +326,7 @@ class TestProblemGetReplies(TestWithUser):
         self.assertEqual(response.status_code, 200,
                          'View returned an HTTP error code')
 
-        rdata = json.loads(response.content.decode('utf8'))
+        rdata = json.loads(b''.join(response).decode('utf8'))
         self.assertEqual(rdata['problemid'], problem.pk,
                          'Response included an unexpected `problemid` value')
         self.assertEqual(len(rdata['replies']), 1,
@@ -211,6 +337,350 @@ class TestProblemGetReplies(TestWithUser):
         self.assertEqual(rreply['userid'], self.user.pk,
                          'User ID in reply is incorrect')
 
+    def test_since_id_and_limit(self):
+        '''
+        Test that following the `next` cursor returns every reply once,
+        in order, at most `limit` at a time.
+        '''
+        problem = problems.models.Problem(title='Test', description='test')
+        problem.save()
+        expected = []
+        for i in range(5):
+            reply = problems.models.Reply(text='reply %i' % i, user=self.user)
+            reply.save()
+            problem.add_response(reply)
+            expected.append(reply.pk)
+
+        seen = []
+        data = {'id': problem.pk, 'limit': 2}
+        while True:
+            request = self.factory.create_api_request(
+                self.user, '/api/problem/replies/get', data)
+            response = views.problem_get_replies(request)
+            self.assertEqual(response.status_code, 200)
+            rdata = json.loads(b''.join(response).decode('utf8'))
+            self.assertLessEqual(len(rdata['replies']), 2)
+            seen.extend(reply['id'] for reply in rdata['replies'])
+            if rdata['next'] is None:
+                break
+            data['since_id'] = rdata['next']
+
+        self.assertEqual(seen, expected)
+
+    def test_not_modified(self):
+        '''
+        Test that a matching If-None-Match header gets a 304 until a
+        reply is added.
+        '''
+        problem = problems.models.Problem(title='Test', description='test')
+        problem.save()
+        path = '/api/problem/replies/get'
+        data = {'id': problem.pk}
+
+        request = self.factory.create_api_request(self.user, path, data)
+        etag = views.problem_get_replies(request)['ETag']
+
+        request = self.factory.create_api_request(self.user, path, data)
+        request.META['HTTP_IF_NONE_MATCH'] = etag
+        self.assertEqual(views.problem_get_replies(request).status_code, 304)
+
+        reply = problems.models.Reply(text='test', user=self.user)
+        reply.save()
+        problem.add_response(reply)
+
+        request = self.factory.create_api_request(self.user, path, data)
+        request.META['HTTP_IF_NONE_MATCH'] = etag
+        self.assertEqual(views.problem_get_replies(request).status_code, 200)
+
+    def test_no_user_queries(self):
+        '''
+        Test that streaming replies does not query for each reply's user.
+        '''
+        problem = problems.models.Problem(title='Test', description='test')
+        problem.save()
+        for i in range(10):
+            reply = problems.models.Reply(text='reply %i' % i, user=self.user)
+            reply.save()
+            problem.add_response(reply)
+
+        request = self.factory.create_api_request(
+            self.user, '/api/problem/replies/get', {'id': problem.pk})
+        response = views.problem_get_replies(request)
+        with self.assertNumQueries(1):
+            rdata = json.loads(b''.join(response).decode('utf8'))
+        self.assertEqual(len(rdata['replies']), 10)
+
+
+class TestProblemSearch(TestWithUser):
+    '''
+    Test that the problem_search view returns ranked matches.
+    '''
+    def setUp(self):
+        super().setUp()
+        self.factory = utils.GravelApiRequestFactory()
+
+    def test_expected_case(self):
+        problem = problems.models.Problem(title='Disk full',
+                                          description='on the build host')
+        problem.save()
+        other = problems.models.Problem(title='Other', description='test')
+        other.save()
+
+        path = '/api/problem/search'
+        data = {'query': 'disk'}
+        request = self.factory.create_api_request(self.user, path, data)
+        response = views.problem_search(request)
+
+        self.assertEqual(response.status_code, 200,
+                         'View returned an HTTP error code')
+        rdata = json.loads(response.content.decode('utf8'))
+        self.assertEqual([r['id'] for r in rdata['results']], [problem.pk])
+
+    def test_missing_query(self):
+        path = '/api/problem/search'
+        request = self.factory.create_api_request(self.user, path, {})
+        response = views.problem_search(request)
+        self.assertEqual(response.status_code, 400)
+
+
+class TestTagViews(TestWithUser):
+    '''
+    Test that the tag_get, tag_problems and tag_all views return the
+    expected tags and problems.
+    '''
+    def setUp(self):
+        super().setUp()
+        self.factory = utils.GravelApiRequestFactory()
+        self.tag = problems.models.ProblemTag.get_or_create('robot')
+        problems.models.ProblemTag.get_or_create('empty')
+
+        self.problems = []
+        for i in range(5):
+            problem = problems.models.Problem(title='Test %i' % i,
+                                              description='test')
+            problem.save()
+            problem.tags.add(self.tag)
+            self.problems.append(problem)
+
+    def call(self, view, data):
+        request = self.factory.create_api_request(self.user, '/api/tag',
+                                                  data)
+        return view(request)
+
+    def test_tag_get(self):
+        for data in ({'id': self.tag.pk}, {'name': 'robot'}):
+            response = self.call(views.tag_get, data)
+            self.assertEqual(response.status_code, 200)
+            rdata = json.loads(response.content.decode('utf8'))
+            self.assertEqual(rdata, {'id': self.tag.pk, 'name': 'robot',
+                                     'problems': 5})
+
+        response = self.call(views.tag_get, {'name': 'missing'})
+        self.assertEqual(response.status_code, 404)
+        for data in ({}, {'id': None}, {'id': [1]}):
+            response = self.call(views.tag_get, data)
+            self.assertEqual(response.status_code, 400)
+            response = self.call(views.tag_problems, data)
+            self.assertEqual(response.status_code, 400)
+
+    def test_tag_problems_pages(self):
+        seen = []
+        data = {'name': 'robot', 'limit': 2}
+        while True:
+            response = self.call(views.tag_problems, data)
+            self.assertEqual(response.status_code, 200)
+            rdata = json.loads(response.content.decode('utf8'))
+            self.assertLessEqual(len(rdata['problems']), 2)
+            seen.extend(problem['id'] for problem in rdata['problems'])
+            if rdata['next'] is None:
+                break
+            data['after'] = rdata['next']
+
+        self.assertEqual(seen, [problem.pk for problem in self.problems])
+
+    def test_tag_all(self):
+        response = self.call(views.tag_all, {})
+        self.assertEqual(response.status_code, 200)
+        rdata = json.loads(response.content.decode('utf8'))
+        self.assertEqual([(t['name'], t['problems']) for t in rdata['tags']],
+                         [('empty', 0), ('robot', 5)])
+
+
+class TestProblemDependencies(TestWithUser):
+    '''
+    Test the views that edit and read the dependency graph.
+    '''
+    def setUp(self):
+        super().setUp()
+        self.factory = utils.GravelApiRequestFactory()
+        self.problems = []
+        for i in range(3):
+            problem = problems.models.Problem(title='test %i' % i,
+                                              description='test')
+            problem.save()
+            self.problems.append(problem)
+
+    def call(self, view, path, data, token=False):
+        if token:
+            data['token'] = api.models.RequestToken.build_tokens(
+                self.user, 1)[0].token
+        request = self.factory.create_api_request(self.user, path, data)
+        response = view(request)
+        return response, json.loads(response.content.decode('utf8'))
+
+    def depend(self, parent, child):
+        return self.call(views.problem_dependency_add,
+                         '/api/problem/dependencies/add',
+                         {'id': parent.pk, 'child': child.pk}, token=True)
+
+    def test_subtree(self):
+        a, b, c = self.problems
+        c.resolved = True
+        c.save()
+        response, rdata = self.depend(b, c)
+        self.assertEqual(rdata, {'id': b.pk, 'rollup_completion': 50})
+        self.depend(a, b)
+
+        response, rdata = self.call(views.problem_subtree,
+                                    '/api/problem/subtree', {'id': a.pk})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [(p['id'], p['rollup_completion'], p['children'])
+             for p in rdata['problems']],
+            [(a.pk, 33, [b.pk]), (b.pk, 50, [c.pk]), (c.pk, 100, [])])
+
+        response, rdata = self.call(views.problem_subtree,
+                                    '/api/problem/subtree',
+                                    {'id': a.pk, 'depth': 1})
+        self.assertTrue(rdata['problems'][1]['truncated'])
+
+    def test_cycle(self):
+        a, b, c = self.problems
+        self.depend(a, b)
+        self.depend(b, c)
+        response, rdata = self.depend(c, a)
+        self.assertEqual(response.status_code, 409)
+
+    def test_remove(self):
+        a, b, c = self.problems
+        self.depend(a, b)
+        response, rdata = self.call(views.problem_dependency_remove,
+                                    '/api/problem/dependencies/remove',
+                                    {'id': a.pk, 'child': b.pk}, token=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(problems.models.Dependency.objects.exists())
+
+    def test_missing_problem(self):
+        response = self.factory.create_api_request(
+            self.user, '/api/problem/subtree', {'id': 1000})
+        self.assertEqual(views.problem_subtree(response).status_code, 404)
+
+    def test_bad_ids(self):
+        a, b, c = self.problems
+        for data in ({'id': [a.pk]}, {'id': a.pk, 'depth': None}):
+            request = self.factory.create_api_request(
+                self.user, '/api/problem/subtree', data)
+            self.assertEqual(views.problem_subtree(request).status_code, 400)
+
+        token = api.models.RequestToken.build_tokens(self.user, 1)[0].token
+        request = self.factory.create_api_request(
+            self.user, '/api/problem/dependencies/add',
+            {'id': [a.pk], 'child': b.pk, 'token': token})
+        self.assertEqual(views.problem_dependency_add(request).status_code,
+                         400)
+
+
+class TestChanges(TestWithUser):
+    '''
+    Test that the changes view reports each changed problem and reply
+    once and continues from its cursor.
+    '''
+    def setUp(self):
+        super().setUp()
+        self.factory = utils.GravelApiRequestFactory()
+
+    def get_changes(self, cursor=None, limit=None):
+        data = {}
+        if cursor:
+            data['cursor'] = cursor
+        if limit:
+            data['limit'] = limit
+        request = self.factory.create_api_request(self.user, '/api/changes',
+                                                  data)
+        response = views.changes(request)
+        self.assertEqual(response.status_code, 200,
+                         'View returned an HTTP error code')
+        return json.loads(response.content.decode('utf8'))
+
+    def test_expected_case(self):
+        first = problems.models.Problem(title='First', description='test')
+        first.save()
+        second = problems.models.Problem(title='Second', description='test')
+        second.save()
+
+        rdata = self.get_changes()
+        self.assertEqual([p['id'] for p in rdata['problems']],
+                         [first.pk, second.pk])
+        self.assertFalse(rdata['more'])
+        cursor = rdata['cursor']
+
+        # Nothing changed since the cursor
+        rdata = self.get_changes(cursor)
+        self.assertEqual(rdata['problems'], [])
+        self.assertEqual(rdata['cursor'], cursor)
+
+        # A reply changes the problem too; each is reported once
+        first.title = 'Changed'
+        first.save()
+        reply = problems.models.Reply(text='test', user=self.user)
+        reply.save()
+        first.add_response(reply)
+
+        rdata = self.get_changes(cursor)
+        self.assertEqual([p['title'] for p in rdata['problems']],
+                         ['Changed'])
+        self.assertEqual([(r['id'], r['problem']) for r in rdata['replies']],
+                         [(reply.pk, first.pk)])
+
+    def test_deleted(self):
+        problem = problems.models.Problem(title='Test', description='test')
+        problem.save()
+        reply = problems.models.Reply(text='test', user=self.user)
+        reply.save()
+        problem.add_response(reply)
+        cursor = self.get_changes()['cursor']
+
+        problem_id, reply_id = problem.pk, reply.pk
+        problem.delete()
+
+        rdata = self.get_changes(cursor)
+        self.assertEqual(rdata['problems'], [])
+        self.assertEqual(rdata['replies'], [])
+        self.assertEqual(rdata['deleted'], {'problems': [problem_id],
+                                            'replies': [reply_id]})
+
+    def test_limit(self):
+        for i in range(5):
+            problems.models.Problem(title='Test', description='test').save()
+
+        seen = []
+        cursor = None
+        while True:
+            rdata = self.get_changes(cursor, limit=2)
+            seen.extend(p['id'] for p in rdata['problems'])
+            cursor = rdata['cursor']
+            if not rdata['more']:
+                break
+
+        self.assertEqual(len(seen), 5)
+        self.assertEqual(len(set(seen)), 5)
+
+    def test_bad_cursor(self):
+        request = self.factory.create_api_request(
+            self.user, '/api/changes', {'cursor': '!!!'})
+        response = views.changes(request)
+        self.assertEqual(response.status_code, 400)
+
 
 class TestApiGetTokens(TestWithUser):
     '''
@@ -238,6 +708,30 @@ class TestApiGetTokens(TestWithUser):
         self.assertEqual(len(tokens), token_count,
                          'Incorrect number of RequestToken objects saved')
 
+    @django.test.override_settings(GRAVEL_API_TOKEN_MODE='signed')
+    def test_signed_tokens(self):
+        '''
+        Test that signed tokens are issued without RequestToken rows
+        and are accepted once by a view that requires a token.
+        '''
+        path = '/api/get_tokens'
+        request = self.factory.create_api_request(self.user, path,
+                                                  {'count': 1})
+        response = views.api_get_tokens(request)
+        self.assertEqual(response.status_code, 200)
+        token = json.loads(response.content.decode('utf8'))['tokens'][0]
+        self.assertFalse(api.models.RequestToken.objects.exists(),
+                         'Signed mode stored RequestToken objects')
+
+        problem = problems.models.Problem(title='Test', description='test')
+        problem.save()
+        data = {'id': problem.pk, 'text': 'test', 'token': token}
+        path = '/api/problem/replies/submit'
+        for status in (200, 403):
+            request = self.factory.create_api_request(self.user, path, data)
+            response = views.problem_reply(request)
+            self.assertEqual(response.status_code, status)
+
     def test_non_numeric_count(self):
         '''
         Test that a request for a non-numeric number of tokens is
@@ -274,3 +768,201 @@ class TestApiGetTokens(TestWithUser):
 
         self.assertEqual(response.status_code, 400,
                          'View accepted an overly-large count')
+
+
+class TestBatch(TestWithUser):
+    '''
+    Test that the batch view runs its operations in order and honors
+    the requested transaction mode.
+    '''
+    def setUp(self):
+        super().setUp()
+        self.factory = utils.GravelApiRequestFactory()
+        self.tokens = api.models.RequestToken.build_tokens(self.user)
+        self.problem = problems.models.Problem(title='Test',
+                                               description='test')
+        self.problem.save()
+
+    def run_batch(self, operations, **extra):
+        data = {'operations': operations, 'token': self.tokens.pop().token}
+        data.update(extra)
+        request = self.factory.create_api_request(self.user, '/api/batch',
+                                                  data)
+        response = views.batch(request)
+        self.assertEqual(response.status_code, 200,
+                         'View returned an HTTP error code')
+        return json.loads(response.content.decode('utf8'))
+
+    def test_expected_case(self):
+        rdata = self.run_batch([
+            {'op': 'problem/replies/submit',
+             'data': {'id': self.problem.pk, 'text': 'first'}},
+            {'op': 'problem/replies/submit',
+             'data': {'id': self.problem.pk, 'text': 'second'}},
+            {'op': 'problem/replies/get', 'data': {'id': self.problem.pk}},
+            {'op': 'problem/highest_id'},
+        ])
+
+        self.assertTrue(rdata['committed'])
+        results = rdata['results']
+        self.assertEqual([r['status'] for r in results], [200] * 4)
+        self.assertEqual([r['text'] for r in results[2]['data']['replies']],
+                         ['first', 'second'])
+        self.assertEqual(results[3]['data']['id'], self.problem.pk)
+
+    def test_atomic_rollback(self):
+        '''
+        Test that a failed operation rolls back the earlier operations
+        and stops the batch.
+        '''
+        rdata = self.run_batch([
+            {'op': 'problem/replies/submit',
+             'data': {'id': self.problem.pk, 'text': 'first'}},
+            {'op': 'problem/replies/submit',
+             'data': {'id': 0, 'text': 'missing problem'}},
+            {'op': 'problem/highest_id'},
+        ])
+
+        self.assertFalse(rdata['committed'])
+        self.assertEqual([r['status'] for r in rdata['results']], [200, 404])
+        self.assertEqual(len(self.problem.replies()), 0,
+                         'Failed batch was not rolled back')
+
+    def test_non_atomic(self):
+        '''
+        Test that with `atomic` disabled a failed operation does not
+        affect the others.
+        '''
+        rdata = self.run_batch([
+            {'op': 'problem/replies/submit',
+             'data': {'id': 0, 'text': 'missing problem'}},
+            {'op': 'no/such/op'},
+            {'op': 'problem/replies/submit',
+             'data': {'id': self.problem.pk, 'text': 'second'}},
+        ], atomic=False)
+
+        self.assertEqual([r['status'] for r in rdata['results']],
+                         [404, 400, 200])
+        self.assertEqual([r['committed'] for r in rdata['results']],
+                         [False, False, True])
+        self.assertFalse(rdata['committed'])
+        self.assertEqual(len(self.problem.replies()), 1)
+
+    def test_malformed_data(self):
+        '''
+        Test that operations with malformed data fail on their own
+        instead of failing the whole batch.
+        '''
+        rdata = self.run_batch([
+            {'op': 'problem/replies/get', 'data': {'id': [1]}},
+            {'op': 'problem/highest_id', 'data': [1]},
+            {'op': 'problem/replies/get', 'data': {'id': self.problem.pk}},
+        ], atomic=False)
+
+        self.assertEqual([r['status'] for r in rdata['results']],
+                         [400, 400, 200])
+
+    def test_token_required(self):
+        data = {'operations': []}
+        request = self.factory.create_api_request(self.user, '/api/batch',
+                                                  data)
+        response = views.batch(request)
+        self.assertNotEqual(response.status_code, 200,
+                            'Batch ran without a token')
+
+
+class TestQueryBudgets(QueryBudgetMixin, TestWithUser):
+    '''
+    Test that the API views stay within their query budgets, with the
+    credential cache cold and enough replies and tags to show up any
+    per-row queries.
+    '''
+    def setUp(self):
+        super().setUp()
+        self.factory = utils.GravelApiRequestFactory()
+        self.tokens = api.models.RequestToken.build_tokens(self.user, 6)
+
+        self.problem = problems.models.Problem(title='deadlock',
+                                               description='test')
+        self.problem.save()
+        for i in range(3):
+            tag = problems.models.ProblemTag.get_or_create('tag%i' % i)
+            self.problem.tags.add(tag)
+        for i in range(30):
+            self.problem.add_response(problems.models.Reply(
+                user=self.user, text='deadlock %i' % i))
+
+    def assertWithinBudget(self, view, path, data, token=False):
+        if token:
+            data['token'] = self.tokens.pop().token
+        request = self.factory.create_api_request(self.user, path, data)
+        credentials.clear()
+
+        with self.assertQueryBudget(view):
+            response = view(request)
+            content = b''.join(response)
+        self.assertEqual(response.status_code, 200, content)
+
+    def test_problem_highest_id(self):
+        self.assertWithinBudget(views.problem_highest_id,
+                                '/api/problem/highest_id', {})
+
+    def test_problem_reply(self):
+        self.assertWithinBudget(views.problem_reply,
+                                '/api/problem/replies/submit',
+                                {'id': self.problem.pk, 'text': 'test'},
+                                token=True)
+
+    def test_problem_submit_bulk(self):
+        self.assertWithinBudget(views.problem_submit_bulk,
+                                '/api/problem/submit_bulk', {'problems': [
+                                    {'title': 'test %i' % i,
+                                     'description': 'test',
+                                     'tags': ['tag0', 'new']}
+                                    for i in range(20)]}, token=True)
+
+    def test_problem_get_replies(self):
+        self.assertWithinBudget(views.problem_get_replies,
+                                '/api/problem/replies/get',
+                                {'id': self.problem.pk})
+
+    def test_problem_search(self):
+        self.assertWithinBudget(views.problem_search, '/api/problem/search',
+                                {'query': 'deadlock test'})
+
+    def test_changes(self):
+        self.assertWithinBudget(views.changes, '/api/changes', {})
+
+    def test_api_get_tokens(self):
+        self.assertWithinBudget(views.api_get_tokens, '/api/get_tokens',
+                                {'count': 16})
+
+    def test_tag_views(self):
+        self.assertWithinBudget(views.tag_get, '/api/tag/get',
+                                {'name': 'tag0'})
+        self.assertWithinBudget(views.tag_problems, '/api/tag/problems',
+                                {'name': 'tag0'})
+        self.assertWithinBudget(views.tag_all, '/api/tag/all', {})
+
+    def test_dependency_views(self):
+        # A chain as long as allowed once the link in its middle is added
+        depth = problems.models.DEPENDENCY_MAX_DEPTH
+        chain = [problems.models.Problem(title='chain %i' % i,
+                                         description='test')
+                 for i in range(depth + 1)]
+        for problem in chain:
+            problem.save()
+        middle = depth // 2
+        for parent, child in zip(chain, chain[1:]):
+            if parent is not chain[middle]:
+                parent.add_dependency(child)
+
+        link = {'id': chain[middle].pk, 'child': chain[middle + 1].pk}
+        self.assertWithinBudget(views.problem_dependency_add,
+                                '/api/problem/dependencies/add', dict(link),
+                                token=True)
+        self.assertWithinBudget(views.problem_subtree, '/api/problem/subtree',
+                                {'id': chain[0].pk, 'depth': 10})
+        self.assertWithinBudget(views.problem_dependency_remove,
+                                '/api/problem/dependencies/remove',
+                                dict(link), token=True)
@@ -0,0 +1,73 @@
+import os
+import json
+import tempfile
+
+import django.test
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.utils.six import StringIO
+
+from api.management.commands import benchmark_views
+from problems import models
+
+
+class TestBenchmarkViews(django.test.TestCase):
+    '''
+    Test the benchmark_views management command.
+    '''
+
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix='.json')
+        os.close(handle)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_run_and_compare(self):
+        '''
+        Test that every view is driven successfully, that the seeded
+        data is rolled back, and that a saved baseline can be compared
+        against.
+        '''
+        options = {'problems': 12, 'replies': 2, 'tags': 3, 'tokens': 10,
+                   'samples': 3, 'warmup': 1}
+        call_command('benchmark_views', save_baseline=self.path,
+                     stdout=StringIO(), **options)
+
+        with open(self.path) as f:
+            report = json.load(f)
+        self.assertIn('problem_view', report['results'])
+        self.assertIn('batch', report['results'])
+        self.assertIn('problem_dependency_add', report['results'])
+        self.assertEqual(models.Problem.objects.count(), 0,
+                         'Benchmark data was not rolled back')
+
+        out = StringIO()
+        call_command('benchmark_views', baseline=self.path, tolerance=1000,
+                     only='tag_get', stdout=out, **options)
+        self.assertIn('No regressions', out.getvalue())
+
+    def test_compare(self):
+        baseline = {'results': {
+            'fast': {'p95': 10.0, 'queries': 2.0},
+            'lean': {'p95': 10.0, 'queries': 2.0},
+        }}
+        report = {'results': {
+            'fast': {'p95': 20.0, 'queries': 2.0},
+            'lean': {'p95': 11.0, 'queries': 3.0},
+            'new': {'p95': 50.0, 'queries': 9.0},
+        }}
+        regressions = benchmark_views.compare(baseline, report, 0.25)
+        self.assertEqual(len(regressions), 2)
+        self.assertTrue(regressions[0].startswith('fast: p95'))
+        self.assertTrue(regressions[1].startswith('lean: 3.0 queries'))
+
+    def test_regression_fails(self):
+        with open(self.path, 'w') as f:
+            json.dump({'volumes': {}, 'results': {
+                'tag_all': {'p95': 0.0001, 'queries': 0}}}, f)
+
+        with self.assertRaises(CommandError):
+            call_command('benchmark_views', baseline=self.path,
+                         only='tag_all', problems=1, replies=0, tags=1,
+                         tokens=0, samples=2, stdout=StringIO())
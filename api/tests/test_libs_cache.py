@@ -0,0 +1,74 @@
+import django.test
+from django.contrib.auth.models import User
+
+from api.libs.cache import CredentialCache, credentials
+import api.models
+
+
+class TestCredentialCache(django.test.SimpleTestCase):
+    '''
+    Test the LRU and TTL behavior of CredentialCache.
+    '''
+
+    def test_hit_and_miss(self):
+        cache = CredentialCache()
+        self.assertIsNone(cache.get(1))
+
+        cache.put(1, 'user', b'secret')
+        self.assertEqual(cache.get(1), ('user', b'secret'))
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 1, 'size': 1})
+
+    def test_lru_eviction(self):
+        '''
+        Test that the least recently used entry is evicted when the
+        cache is full.
+        '''
+        cache = CredentialCache(maxsize=2)
+        cache.put(1, 'one', b'1')
+        cache.put(2, 'two', b'2')
+        cache.get(1)
+        cache.put(3, 'three', b'3')
+
+        self.assertIsNone(cache.get(2), 'LRU entry was not evicted')
+        self.assertIsNotNone(cache.get(1))
+        self.assertIsNotNone(cache.get(3))
+
+    def test_ttl(self):
+        cache = CredentialCache(ttl=-1)
+        cache.put(1, 'one', b'1')
+        self.assertIsNone(cache.get(1), 'Expired entry was returned')
+
+    def test_invalidate(self):
+        cache = CredentialCache()
+        cache.put(1, 'one', b'1')
+        cache.invalidate(1)
+        self.assertIsNone(cache.get(1))
+
+
+class TestCredentialCacheSignals(django.test.TestCase):
+    '''
+    Test that changes to a User or SharedSecret drop cached credentials.
+    '''
+
+    def setUp(self):
+        self.user = User(username='test', email='test@example.com')
+        self.user.set_password('test')
+        self.user.save()
+        self.secret = api.models.SharedSecret.get_or_create(self.user)
+        credentials.put(self.user.pk, self.user, self.secret)
+
+    def test_user_change(self):
+        self.user.first_name = 'Changed'
+        self.user.save()
+        self.assertIsNone(credentials.get(self.user.pk))
+
+    def test_shared_secret_change(self):
+        secret = api.models.SharedSecret.objects.get(user=self.user)
+        secret.shared_secret = b'new secret'
+        secret.save()
+        self.assertIsNone(credentials.get(self.user.pk))
+
+    def test_user_delete(self):
+        userid = self.user.pk
+        self.user.delete()
+        self.assertIsNone(credentials.get(userid))
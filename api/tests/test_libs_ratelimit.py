@@ -0,0 +1,219 @@
+import os
+import json
+import shutil
+import tempfile
+
+import django.test
+from django.contrib.auth.models import User
+from django.test.utils import override_settings
+
+from api import views
+from api.libs import ratelimit
+from api.libs.ratelimit import BucketStore
+from api.tests import utils
+import api.models
+
+
+class FakeClock():
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestBucketStore(django.test.SimpleTestCase):
+    '''
+    Test the token buckets, within one process and shared through a
+    file.
+    '''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.clock = FakeClock()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_burst_and_refill(self):
+        store = BucketStore(clock=self.clock)
+        for i in range(3):
+            self.assertEqual(store.take('a', 2, 3), 0)
+        self.assertAlmostEqual(store.take('a', 2, 3), 0.5)
+
+        self.clock.now += 0.5
+        self.assertEqual(store.take('a', 2, 3), 0)
+        self.assertGreater(store.take('a', 2, 3), 0)
+
+        # Refilling stops at the burst size
+        self.clock.now += 60
+        for i in range(3):
+            self.assertEqual(store.take('a', 2, 3), 0)
+        self.assertGreater(store.take('a', 2, 3), 0)
+
+    def test_keys_are_separate(self):
+        store = BucketStore(clock=self.clock)
+        self.assertEqual(store.take('a', 1, 1), 0)
+        self.assertGreater(store.take('a', 1, 1), 0)
+        self.assertEqual(store.take('b', 1, 1), 0)
+
+    def test_cost(self):
+        store = BucketStore(clock=self.clock)
+        self.assertEqual(store.take('a', 10, 100, cost=60), 0)
+        self.assertAlmostEqual(store.take('a', 10, 100, cost=60), 2)
+        self.assertEqual(store.take('a', 10, 100, cost=40), 0)
+
+    def test_collisions(self):
+        '''
+        Test that keys sharing a set keep their buckets until the set is
+        full, and that the least recently used bucket is then dropped.
+        '''
+        store = BucketStore(slots=ratelimit.WAYS, clock=self.clock)
+        self.assertEqual(store.take('api', 1, 1), 0)
+        for i in range(ratelimit.WAYS):
+            self.clock.now += 1
+            self.assertEqual(store.take('key%i' % i, 0.001, 1), 0)
+        for i in range(ratelimit.WAYS):
+            self.assertGreater(store.take('key%i' % i, 0.001, 1), 0)
+
+        # key0 was used least recently
+        self.clock.now += 1
+        self.assertEqual(store.take('other', 0.001, 1), 0)
+        self.assertEqual(store.take('key0', 0.001, 1), 0)
+        self.assertGreater(store.take('key2', 0.001, 1), 0)
+
+        # The capacity bucket has a slot of its own
+        self.assertGreater(store.take('api', 0.001, 1), 0)
+
+    def test_shared_file(self):
+        '''
+        Test that stores sharing a file, as in separate worker
+        processes, share their buckets.
+        '''
+        path = os.path.join(self.directory, 'buckets')
+        first = BucketStore(path, slots=16, clock=self.clock)
+        second = BucketStore(path, slots=16, clock=self.clock)
+
+        self.assertEqual(first.take('a', 1, 2), 0)
+        self.assertEqual(second.take('a', 1, 2), 0)
+        self.assertGreater(first.take('a', 1, 2), 0)
+
+        second.clear()
+        self.assertEqual(first.take('a', 1, 2), 0)
+
+
+class TestApiRateLimits(django.test.TestCase):
+    '''
+    Test that API views enforce the rate limits.
+    '''
+
+    def setUp(self):
+        ratelimit.buckets.clear()
+        self.user = User.objects.create_user('testuser')
+        self.factory = utils.GravelApiRequestFactory()
+
+    def tearDown(self):
+        ratelimit.buckets.clear()
+
+    def call(self, view, path, data):
+        return view(self.factory.create_api_request(self.user, path, data))
+
+    @override_settings(GRAVEL_API_RATE_LIMIT=(0.01, 2))
+    def test_user_limit(self):
+        for i in range(2):
+            response = self.call(views.tag_all, '/api/tag/all', {})
+            self.assertEqual(response.status_code, 200)
+
+        response = self.call(views.tag_all, '/api/tag/all', {})
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '100')
+
+        # Other views have buckets of their own
+        response = self.call(views.problem_highest_id,
+                             '/api/problem/highest_id', {})
+        self.assertEqual(response.status_code, 200)
+
+    @override_settings(GRAVEL_API_RATE_LIMIT=(0.01, 1),
+                       GRAVEL_RATE_LIMITS=False)
+    def test_disabled(self):
+        for i in range(3):
+            response = self.call(views.tag_all, '/api/tag/all', {})
+            self.assertEqual(response.status_code, 200)
+
+    @override_settings(GRAVEL_API_CAPACITY=(0.5, 1))
+    def test_shedding(self):
+        '''
+        Test that API calls are refused once the API is over capacity,
+        while the HTML pages are still served.
+        '''
+        response = self.call(views.tag_all, '/api/tag/all', {})
+        self.assertEqual(response.status_code, 200)
+
+        response = self.call(views.tag_all, '/api/tag/all', {})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '2')
+
+        response = self.client.get('/problem/list/all')
+        self.assertEqual(response.status_code, 200)
+
+    @override_settings(GRAVEL_API_CAPACITY=(0.5, 1))
+    def test_shedding_authenticated_only(self):
+        '''
+        Test that requests failing authentication do not use up the
+        capacity of the API.
+        '''
+        factory = utils.GravelApiRequestFactory(
+            override={'HTTP_X_GRAVEL_HMAC_SHA256': 'bad'})
+        for i in range(3):
+            request = factory.create_api_request(self.user, '/api/tag/all',
+                                                 {})
+            self.assertEqual(views.tag_all(request).status_code, 403)
+
+        response = self.call(views.tag_all, '/api/tag/all', {})
+        self.assertEqual(response.status_code, 200)
+
+    @override_settings(GRAVEL_API_TOKEN_RATE_LIMIT=(1, 1500))
+    def test_tokens_issued(self):
+        response = self.call(views.api_get_tokens, '/api/get_tokens',
+                             {'count': 1000})
+        self.assertEqual(response.status_code, 200)
+
+        response = self.call(views.api_get_tokens, '/api/get_tokens',
+                             {'count': 1000})
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(api.models.RequestToken.objects.count(), 1000)
+
+    @override_settings(GRAVEL_API_RATE_LIMIT=(0.01, 2))
+    def test_batch_operations(self):
+        '''
+        Test that batch operations draw from the rate limits of the
+        views they run.
+        '''
+        token = api.models.RequestToken.build_tokens(self.user, 1)[0].token
+        response = self.call(views.batch, '/api/batch', {
+            'token': token, 'atomic': False,
+            'operations': [{'op': 'tag/all'}] * 3})
+
+        results = json.loads(response.content.decode('utf8'))['results']
+        self.assertEqual([result['status'] for result in results],
+                         [200, 200, 429])
+
+    @override_settings(GRAVEL_API_CAPACITY=(0.5, 3))
+    def test_batch_capacity(self):
+        '''
+        Test that each operation of a batch counts against the capacity
+        of the API.
+        '''
+        tokens = api.models.RequestToken.build_tokens(self.user, 2)
+        response = self.call(views.batch, '/api/batch', {
+            'token': tokens[0].token,
+            'operations': [{'op': 'tag/all'}] * 4})
+        self.assertEqual(response.status_code, 503)
+
+        response = self.call(views.batch, '/api/batch', {
+            'token': tokens[1].token,
+            'operations': [{'op': 'tag/all'}] * 2})
+        self.assertEqual(response.status_code, 200)
+
+        response = self.call(views.tag_all, '/api/tag/all', {})
+        self.assertEqual(response.status_code, 503)
@@ -0,0 +1,162 @@
+import datetime
+
+import django.test
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.utils import timezone
+from django.utils.six import StringIO
+
+from api.libs import tokens
+from gravel import metrics
+import api.models
+
+
+class TestDatabaseTokens(django.test.TestCase):
+    '''
+    Test issuing and redeeming RequestToken rows.
+    '''
+
+    def setUp(self):
+        self.user = User(username='test', email='test@example.com')
+        self.user.set_password('test')
+        self.user.save()
+
+    def test_bulk_tokens_unique(self):
+        issued = api.models.RequestToken.build_tokens(self.user, 1024)
+        self.assertEqual(len(set(token.token for token in issued)), 1024,
+                         'Bulk-generated tokens are not unique')
+        self.assertTrue(all(len(token.token) == 64 for token in issued))
+
+    def test_redeem_once(self):
+        token = api.models.RequestToken.build_tokens(self.user)[0]
+        self.assertTrue(tokens.redeem_token(self.user, token.token))
+        self.assertFalse(tokens.redeem_token(self.user, token.token))
+
+    def test_other_user(self):
+        other = User.objects.create_user('other')
+        token = api.models.RequestToken.build_tokens(self.user)[0]
+        self.assertFalse(tokens.redeem_token(other, token.token))
+        self.assertTrue(tokens.redeem_token(self.user, token.token))
+
+    def test_expired_token(self):
+        token = api.models.RequestToken.build_tokens(self.user)[0]
+        api.models.RequestToken.objects.filter(token=token.token).update(
+            expires=timezone.now() - datetime.timedelta(seconds=1))
+
+        self.assertFalse(tokens.redeem_token(self.user, token.token),
+                         'An expired token was accepted')
+
+    def test_metrics(self):
+        def value(name, labels):
+            return metrics.REGISTRY.collect().get((name, labels), 0)
+
+        issued = value('gravel_api_tokens_issued_total', ('database',))
+        accepted = value('gravel_api_tokens_redeemed_total', ('accepted',))
+        rejected = value('gravel_api_tokens_redeemed_total', ('rejected',))
+
+        expires, issued_tokens = tokens.issue_tokens(self.user, 3)
+        tokens.redeem_token(self.user, issued_tokens[0])
+        tokens.redeem_token(self.user, issued_tokens[0])
+
+        self.assertEqual(value('gravel_api_tokens_issued_total',
+                               ('database',)), issued + 3)
+        self.assertEqual(value('gravel_api_tokens_redeemed_total',
+                               ('accepted',)), accepted + 1)
+        self.assertEqual(value('gravel_api_tokens_redeemed_total',
+                               ('rejected',)), rejected + 1)
+
+
+class TestPurgeExpired(django.test.TestCase):
+    '''
+    Test that expired tokens and spent nonces are purged in batches.
+    '''
+
+    def setUp(self):
+        self.user = User(username='test', email='test@example.com')
+        self.user.set_password('test')
+        self.user.save()
+
+        self.live = api.models.RequestToken.build_tokens(self.user, 3)
+        expired = api.models.RequestToken.build_tokens(self.user, 5)
+        api.models.RequestToken.objects.filter(
+            token__in=[token.token for token in expired]
+        ).update(expires=timezone.now() - datetime.timedelta(hours=1))
+
+        api.models.SpentNonce.objects.create(bucket=1, nonce='old')
+        expires, issued = tokens.build_signed_tokens(self.user)
+        tokens.redeem_token(self.user, issued[0])
+
+    def test_purge(self):
+        batches = list(tokens.purge_expired(batch_size=2))
+
+        deleted = [n for model, n, s in batches
+                   if model is api.models.RequestToken]
+        self.assertEqual(deleted, [2, 2, 1])
+        self.assertEqual(
+            sorted(api.models.RequestToken.objects.values_list('token',
+                                                               flat=True)),
+            sorted(token.token for token in self.live))
+        self.assertEqual(api.models.SpentNonce.objects.count(), 1,
+                         'Purge removed a nonce that may still be replayed')
+
+    def test_command(self):
+        out = StringIO()
+        call_command('purge_tokens', batch_size=4, stdout=out)
+
+        self.assertIn('Deleted 4 RequestToken rows', out.getvalue())
+        self.assertIn('Total RequestToken rows deleted: 5', out.getvalue())
+        self.assertIn('Total SpentNonce rows deleted: 1', out.getvalue())
+
+
+class TestSignedTokens(django.test.TestCase):
+    '''
+    Test issuing and redeeming stateless signed tokens.
+    '''
+
+    def setUp(self):
+        self.user = User(username='test', email='test@example.com')
+        self.user.set_password('test')
+        self.user.save()
+
+    @django.test.override_settings(GRAVEL_API_TOKEN_MODE='signed')
+    def test_issue_without_writes(self):
+        with self.assertNumQueries(0):
+            expires, issued = tokens.issue_tokens(self.user, 1024)
+        self.assertEqual(len(issued), 1024)
+        self.assertEqual(len(set(issued)), 1024, 'Tokens are not unique')
+
+    def test_redeem_once(self):
+        expires, issued = tokens.build_signed_tokens(self.user, 2)
+
+        self.assertTrue(tokens.redeem_token(self.user, issued[0]))
+        self.assertFalse(tokens.redeem_token(self.user, issued[0]),
+                         'A signed token was redeemed twice')
+        self.assertTrue(tokens.redeem_token(self.user, issued[1]))
+        self.assertEqual(api.models.SpentNonce.objects.count(), 2)
+
+    def test_wrong_user(self):
+        other = User(username='other', email='other@example.com')
+        other.set_password('test')
+        other.save()
+
+        expires, issued = tokens.build_signed_tokens(self.user)
+        self.assertFalse(tokens.redeem_token(other, issued[0]),
+                         'A token was accepted for another user')
+
+    def test_tampered_token(self):
+        expires, issued = tokens.build_signed_tokens(self.user)
+        expiry, nonce, signature = issued[0].split('.')
+
+        later = '%i.%s.%s' % (int(expiry) + 3600, nonce, signature)
+        self.assertFalse(tokens.redeem_token(self.user, later),
+                         'A token with a modified expiry was accepted')
+        self.assertFalse(tokens.redeem_token(self.user, 'a.b'))
+
+    def test_expired_token(self):
+        key = tokens._signing_key()
+        nonce = '0' * 32
+        signature = tokens._sign(key, self.user.pk, 1000, nonce)
+        token = '1000.%s.%s' % (nonce, signature)
+
+        self.assertFalse(tokens.redeem_token(self.user, token),
+                         'An expired token was accepted')
@@ -1,5 +1,7 @@
+import django.http
 import django.test
 from django.contrib.auth.models import User
+from api.libs.cache import credentials
 from api.libs.validate import ValidateApiRequest
 from api.tests import utils
 
@@ -130,3 +132,36 @@ class TestValidateApiRequest(django.test.TestCase):
 
         self.assertEqual(response.status_code, 403,
                          'View did not return a 403 error for a missing user')
+
+
+class TestValidateApiRequestCache(django.test.TestCase):
+    '''
+    Test that ValidateApiRequest serves repeat requests from the
+    credential cache without querying the database.
+    '''
+
+    def setUp(self):
+        @ValidateApiRequest
+        def dummy_view(request, user, data):
+            return django.http.HttpResponse(str(user.pk))
+
+        self.view = dummy_view
+        self.factory = utils.GravelApiRequestFactory()
+
+        self.user = User(username='testuser', email='test@example.com')
+        self.user.set_password('testpassword')
+        self.user.save()
+        credentials.clear()
+
+    def test_cached_credentials(self):
+        path = '/api/problem/highest_id'
+        request = self.factory.create_api_request(self.user, path, data={})
+        response = self.view(request)
+        self.assertEqual(response.status_code, 200)
+
+        hits = credentials.hits
+        request = self.factory.create_api_request(self.user, path, data={})
+        with self.assertNumQueries(0):
+            response = self.view(request)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(credentials.hits, hits + 1)
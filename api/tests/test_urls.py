@@ -49,3 +49,12 @@ class TestUrls(django.test.TestCase):
     def test_404(self):
         response = self.client.get('/api/this_should_404')
         self.assertEqual(response.status_code, 404)
+
+    def test_batch(self):
+        # Send a non-POST request, expect rejection
+        response = self.client.get('/api/batch')
+        self.assertEqual(response.status_code, 405)
+
+        # Send a non-authenticated request, expect rejection
+        response = self.client.post('/api/batch')
+        self.assertEqual(response.status_code, 403)
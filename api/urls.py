@@ -4,11 +4,18 @@ urlpatterns = patterns('api.views',
 
     # Normal API commands
     url(r'get_tokens$', 'api_get_tokens'),
+    url(r'batch$', 'batch'),
+    url(r'changes$', 'changes'),
 
     # Problem commands
     url(r'problem/highest_id$', 'problem_highest_id'),
+    url(r'problem/submit_bulk$', 'problem_submit_bulk'),
     url(r'problem/replies/submit$', 'problem_reply'),
     url(r'problem/replies/get$', 'problem_get_replies'),
+    url(r'problem/search$', 'problem_search'),
+    url(r'problem/subtree$', 'problem_subtree'),
+    url(r'problem/dependencies/add$', 'problem_dependency_add'),
+    url(r'problem/dependencies/remove$', 'problem_dependency_remove'),
 
     # Tag commands
     url(r'tag/get', 'tag_get'),
@@ -1,13 +1,24 @@
 import json
+import base64
+import logging
+import binascii
 
 import django.http
+from django.conf import settings
+from django.db import transaction
 from django.http import JsonResponse
 from django.shortcuts import render
-from problems import models
-from api.models import RequestToken
-from api.libs.validate import ValidateApiRequest, ValidateToken
+from gravel.queries import query_budget, view_name
+from problems import forms, models, utils
+from api.libs import ratelimit
+from api.libs.ratelimit import rate_limit
+from api.libs.tokens import issue_tokens
+from api.libs.validate import ValidateApiRequest, ValidateToken, reject
 
+logger = logging.getLogger(__name__)
 
+
+@query_budget(3)
 @ValidateApiRequest
 def problem_highest_id(request, user, data):
     try:
@@ -17,40 +28,344 @@ def problem_highest_id(request, user, data):
         return JsonResponse({'id': 0})
 
 
+@query_budget(20)
 @ValidateApiRequest
 @ValidateToken
 def problem_reply(request, user, data):
     try:
         problem = models.Problem.objects.get(pk=data['id'])
         reply = models.Reply(user=user, text=data['text'])
-    except IndexError:
-        return django.http.HttpResponse('Key missing from JSON data')
+    except KeyError:
+        return django.http.HttpResponseBadRequest('Key missing from JSON data')
     except models.Problem.DoesNotExist:
         return django.http.HttpResponseNotFound('Could not find problem')
 
-    reply.save()
     problem.add_response(reply)
 
     return JsonResponse({'problemid': problem.pk, 'replyid': reply.pk})
 
 
+#: The deepest subtree returned by `problem_subtree`
+SUBTREE_MAX_DEPTH = 10
+
+
+@query_budget(4 + SUBTREE_MAX_DEPTH)
+@ValidateApiRequest
+def problem_subtree(request, user, data):
+    '''
+    Get a problem and the problems it depends on, down to `depth`
+    levels (5 by default), each with its `rollup_completion`: the mean
+    progress of the problem and everything it depends on, counting a
+    problem reached by several paths once for each path.
+
+    `problems` lists each problem once, the requested one first, with
+    the IDs of its dependencies in `children`; problems below the
+    depth, or beyond the most links returned, have `truncated` set
+    instead when they have dependencies.
+    '''
+    try:
+        problem = models.Problem.objects.get(pk=data['id'])
+        depth = min(int(data.get('depth', 5)), SUBTREE_MAX_DEPTH)
+    except KeyError:
+        return django.http.HttpResponseBadRequest('Key missing from JSON data')
+    except (ValueError, TypeError):
+        return django.http.HttpResponseBadRequest('Invalid ID or depth')
+    except models.Problem.DoesNotExist:
+        return django.http.HttpResponseNotFound('Could not find problem')
+
+    return JsonResponse({'problems': problem.subtree(max(depth, 0))})
+
+
+def find_dependency(data):
+    '''
+    Look up the problems named by the `id` and `child` keys of `data`.
+
+    :raises KeyError: if either key is missing.
+    :raises ValueError, TypeError: if either ID is not an integer.
+    :raises models.Problem.DoesNotExist: if either problem is missing.
+    '''
+    pks = (int(data['id']), int(data['child']))
+    problems = models.Problem.objects.in_bulk(pks)
+    if len(problems) != len(set(pks)):
+        raise models.Problem.DoesNotExist()
+    return problems[pks[0]], problems[pks[1]]
+
+
+@query_budget(15 + 3 * models.DEPENDENCY_MAX_DEPTH)
+@ValidateApiRequest
+@ValidateToken
+def problem_dependency_add(request, user, data):
+    '''
+    Make problem `id` depend on problem `child`, and return the
+    `rollup_completion` of problem `id` as `problem_subtree` does.
+
+    A dependency that would make a problem depend on itself is refused
+    with a 409, as is one that would make a chain of more than
+    `problems.models.DEPENDENCY_MAX_DEPTH` links. So is one that would
+    make a problem's rollup count more than
+    `problems.models.ROLLUP_COUNT_MAX` problems: a problem reached by
+    several paths is counted once for each, which adds up quickly in
+    graphs of overlapping diamonds.
+    '''
+    try:
+        problem, child = find_dependency(data)
+    except KeyError:
+        return django.http.HttpResponseBadRequest('Key missing from JSON data')
+    except (ValueError, TypeError):
+        return django.http.HttpResponseBadRequest('Invalid problem ID')
+    except models.Problem.DoesNotExist:
+        return django.http.HttpResponseNotFound('Could not find problem')
+
+    try:
+        problem.add_dependency(child)
+    except models.DependencyCycle:
+        return JsonResponse({'error': 'Dependency cycle'}, status=409)
+    except models.DependencyTooDeep:
+        return JsonResponse({'error': 'Dependency chain too long'},
+                            status=409)
+    except models.RollupOverflow:
+        return JsonResponse({'error': 'Too many dependency paths'},
+                            status=409)
+    return JsonResponse({'id': problem.pk,
+                         'rollup_completion': problem.rollup_completion})
+
+
+@query_budget(11 + 2 * models.DEPENDENCY_MAX_DEPTH)
+@ValidateApiRequest
+@ValidateToken
+def problem_dependency_remove(request, user, data):
+    '''
+    Stop problem `id` depending on problem `child`, and return the
+    `rollup_completion` of problem `id`.
+    '''
+    try:
+        problem, child = find_dependency(data)
+    except KeyError:
+        return django.http.HttpResponseBadRequest('Key missing from JSON data')
+    except (ValueError, TypeError):
+        return django.http.HttpResponseBadRequest('Invalid problem ID')
+    except models.Problem.DoesNotExist:
+        return django.http.HttpResponseNotFound('Could not find problem')
+
+    problem.remove_dependency(child)
+    return JsonResponse({'id': problem.pk,
+                         'rollup_completion': problem.rollup_completion})
+
+
+#: The largest number of problems accepted by `problem_submit_bulk`
+SUBMIT_BULK_MAX_PROBLEMS = 5000
+
+
+@query_budget(30)
+@rate_limit(1, 10)
+@ValidateApiRequest
+@ValidateToken
+def problem_submit_bulk(request, user, data):
+    '''
+    Create many problems, each with a `title`, a `description`, an
+    optional list of `tags` and an optional `fingerprint`, in a single
+    transaction.
+
+    A problem whose fingerprint this user has reported before is not
+    created again; the existing problem's occurrence count goes up
+    instead. The response holds the ID of each problem in `ids`, and
+    in `created` whether it is new.
+
+    Nothing is saved if any problem is invalid; the response then gives
+    the index of the first invalid problem and its errors.
+    '''
+    try:
+        submissions = data['problems']
+        if not isinstance(submissions, list):
+            raise TypeError()
+    except (KeyError, TypeError):
+        return django.http.HttpResponseBadRequest('Missing problems list')
+    if len(submissions) > SUBMIT_BULK_MAX_PROBLEMS:
+        return django.http.HttpResponseBadRequest('Too many problems')
+
+    problems = []
+    tags = []
+    fingerprints = []
+    for index, submission in enumerate(submissions):
+        if not isinstance(submission, dict):
+            return JsonResponse({'index': index, 'errors': 'Not an object'},
+                                status=400)
+
+        form = forms.ProblemSubmitForm({
+            'title': submission.get('title'),
+            'description': submission.get('description'),
+            'username': user.get_username()
+        })
+        names = submission.get('tags', [])
+        if not form.is_valid():
+            return JsonResponse({'index': index, 'errors': form.errors},
+                                status=400)
+        if (not isinstance(names, list) or
+                not all(isinstance(name, str) and 0 < len(name) <= 30
+                        for name in names)):
+            return JsonResponse({'index': index, 'errors': 'Invalid tags'},
+                                status=400)
+        fingerprint = submission.get('fingerprint')
+        if fingerprint is not None and (
+                not isinstance(fingerprint, str) or
+                not 0 < len(fingerprint) <= 200):
+            return JsonResponse(
+                {'index': index, 'errors': 'Invalid fingerprint'}, status=400)
+
+        problems.append(form.save(commit=False))
+        tags.append(names)
+        fingerprints.append(fingerprint)
+
+    results = utils.report_problems(user, problems, tags, fingerprints)
+    return JsonResponse({'ids': [pk for pk, created in results],
+                         'created': [created for pk, created in results]})
+
+
+@query_budget(5)
 @ValidateApiRequest
 def problem_get_replies(request, user, data):
+    '''
+    Stream the replies to a problem in ascending ID order.
+
+    Only replies with an ID above `since_id` are returned, and at most
+    `limit` of them if it is given. When a limit cuts the list short,
+    `next` holds the `since_id` for the following page; otherwise it
+    is null.
+
+    The response carries an ETag; a request whose If-None-Match header
+    matches the current one gets a 304 without any replies being read.
+    '''
     try:
         problem = models.Problem.objects.get(pk=data['id'])
-    except IndexError:
-        return django.http.HttpResponse('Key missing from JSON data')
+        since_id = int(data.get('since_id', 0))
+        limit = data.get('limit')
+        if limit is not None:
+            limit = max(int(limit), 1)
+    except KeyError:
+        return django.http.HttpResponseBadRequest('Key missing from JSON data')
+    except ValueError:
+        return django.http.HttpResponseBadRequest('Invalid since_id or limit')
     except models.Problem.DoesNotExist:
         return django.http.HttpResponseNotFound('Could not find problem')
 
+    etag = '"%s"' % utils.make_etag('replies', problem.pk,
+                                    utils.problem_version(problem.pk),
+                                    since_id, limit)
+    if request.META.get('HTTP_IF_NONE_MATCH') == etag:
+        response = django.http.HttpResponseNotModified()
+        response['ETag'] = etag
+        return response
+
+    replies = (models.Reply.objects
+               .filter(problem=problem, pk__gt=since_id)
+               .order_by('pk')
+               .values_list('pk', 'date', 'text', 'user_id'))
+    if limit is not None:
+        replies = replies[:limit + 1]
+
+    response = django.http.StreamingHttpResponse(
+        stream_replies(problem.pk, replies, limit),
+        content_type='application/json')
+    response['ETag'] = etag
+    return response
+
+
+def stream_replies(problemid, replies, limit=None):
+    '''
+    Yield the JSON body of a problem_get_replies response piece by
+    piece, serializing each reply as it comes from the database.
+    '''
+    yield '{"problemid": %s, "replies": [' % json.dumps(problemid)
+
+    count = 0
+    next_id = None
+    for pk, date, text, userid in replies.iterator():
+        if limit is not None and count == limit:
+            next_id = last_pk
+            break
+        yield (', ' if count else '') + json.dumps({
+            'id': pk,
+            'date': date.isoformat(),
+            'text': text,
+            'userid': userid
+        })
+        count += 1
+        last_pk = pk
+
+    yield '], "next": %s}' % json.dumps(next_id)
+
+
+@query_budget(5)
+@ValidateApiRequest
+def problem_search(request, user, data):
+    '''
+    Search problems for the terms in `query`, best matches first.
+    '''
+    try:
+        query = str(data['query'])
+        offset = int(data.get('offset', 0))
+        limit = min(int(data.get('limit', 20)), 100)
+    except KeyError:
+        return django.http.HttpResponseBadRequest('Key missing from JSON data')
+    except ValueError:
+        return django.http.HttpResponseBadRequest('Invalid offset or limit')
+
+    results = models.SearchTerm.search(query, max(offset, 0), max(limit, 0))
     return JsonResponse({
-        'problemid': problem.pk,
-        'replies': [reply.serialize() for reply in problem.replies()]
+        'results': [{'id': problem.pk, 'title': problem.title,
+                     'score': score} for problem, score in results]
     })
 
 
+@query_budget(5)
+@ValidateApiRequest
+def changes(request, user, data):
+    '''
+    Get the problems and replies created, changed or deleted since
+    `cursor`; `deleted` lists the IDs of the deleted ones.
+
+    Pass the returned `cursor` on the next call to continue from there;
+    omit it to start from the beginning. `more` is true when further
+    changes are already waiting.
+    '''
+    try:
+        seq = 0
+        if data.get('cursor'):
+            cursor = base64.urlsafe_b64decode(str(data['cursor']).encode())
+            seq = int(cursor.decode('ascii'))
+        limit = min(max(int(data.get('limit', 500)), 1), 5000)
+    except (ValueError, UnicodeError, binascii.Error):
+        return django.http.HttpResponseBadRequest('Invalid cursor or limit')
+
+    problems, replies, deleted, seq, more = models.Change.since(seq, limit)
+
+    serialized_replies = []
+    for reply in replies:
+        serialized = reply.serialize()
+        serialized['problem'] = reply.problem_id
+        serialized_replies.append(serialized)
+
+    cursor = base64.urlsafe_b64encode(str(seq).encode('ascii'))
+    return JsonResponse({
+        'problems': [problem.serialize() for problem in problems],
+        'replies': serialized_replies,
+        'deleted': {'problems': deleted[0], 'replies': deleted[1]},
+        'cursor': cursor.decode('ascii'),
+        'more': more
+    })
+
+
+@query_budget(3)
+@rate_limit(1, 10)
 @ValidateApiRequest
 def api_get_tokens(request, user, data):
+    '''
+    Issue `count` request tokens, 1 by default and at most 1024.
+
+    The tokens are drawn from the user's token issuing limit, so asking
+    for more tokens does not get around the rate limit of the views that
+    spend them.
+    '''
     count = 1
     try:
         if 'count' in data:
@@ -63,32 +378,227 @@ def api_get_tokens(request, user, data):
     elif count < 0:
         return django.http.HttpResponseBadRequest('Too few tokens requested')
 
-    tokens = RequestToken.build_tokens(user, count)
+    wait = ratelimit.user_wait(
+        user, 'tokens', getattr(settings, 'GRAVEL_API_TOKEN_RATE_LIMIT',
+                                ratelimit.DEFAULT_TOKEN_RATE_LIMIT), count)
+    if wait:
+        return ratelimit.too_many_requests(wait)
+
+    expires, tokens = issue_tokens(user, count)
     return JsonResponse({
-        'expires': tokens[0].expires.isoformat(),
-        'tokens': [token.token for token in tokens]
+        'expires': expires.isoformat(),
+        'tokens': tokens
     })
 
 
+def find_tag(data):
+    '''
+    Look up the ProblemTag named by the `id` or `name` key of `data`.
+
+    :raises KeyError: if neither key is present.
+    :raises ValueError, TypeError: if the ID is not an integer.
+    :raises models.ProblemTag.DoesNotExist: if there is no such tag.
+    '''
+    if 'id' in data:
+        return models.ProblemTag.objects.get(pk=int(data['id']))
+    return models.ProblemTag.objects.get(name=data['name'])
+
+
+@query_budget(3)
 @ValidateApiRequest
 def tag_get(request, user, data):
     '''
     Get a specific tag by looking up the ID or name.
     '''
-    pass
+    try:
+        tag = find_tag(data)
+    except (KeyError, ValueError, TypeError):
+        return django.http.HttpResponseBadRequest('Missing tag ID or name')
+    except models.ProblemTag.DoesNotExist:
+        return django.http.HttpResponseNotFound('Could not find tag')
 
+    return JsonResponse(tag.serialize())
 
+
+@query_budget(5)
 @ValidateApiRequest
 def tag_problems(request, user, data):
     '''
-    Get all problems that have a specific tag.
+    Get all problems that have a specific tag, in ascending ID order.
+
+    Results are paginated: pass the `next` value of a response as
+    `after` to get the following page. `next` is null on the last page.
     '''
-    pass
+    try:
+        tag = find_tag(data)
+        after = int(data.get('after', 0))
+        limit = min(max(int(data.get('limit', 100)), 1), 1000)
+    except (KeyError, ValueError, TypeError):
+        return django.http.HttpResponseBadRequest('Missing tag or bad cursor')
+    except models.ProblemTag.DoesNotExist:
+        return django.http.HttpResponseNotFound('Could not find tag')
+
+    # Page through the tag's links rather than its problems, so that the
+    # seek and the order both come from the (problemtag, problem) index
+    Link = models.Problem.tags.through
+    pks = list(Link.objects
+               .filter(problemtag=tag, problem__gt=after)
+               .order_by('problem')
+               .values_list('problem', flat=True)[:limit + 1])
+    problems = list(models.Problem.objects
+                    .filter(pk__in=pks)
+                    .order_by('pk'))
 
+    next_cursor = None
+    if len(problems) > limit:
+        problems = problems[:limit]
+        next_cursor = problems[-1].pk
 
+    return JsonResponse({
+        'tag': tag.serialize(),
+        'problems': [problem.serialize() for problem in problems],
+        'next': next_cursor
+    })
+
+
+@query_budget(3)
 @ValidateApiRequest
 def tag_all(request, user, data):
     '''
-    Get a list of all tags and their IDs.
+    Get a list of all tags, their IDs and their problem counts.
+    '''
+    tags = models.ProblemTag.objects.order_by('name')
+    return JsonResponse({'tags': [tag.serialize() for tag in tags]})
+
+
+#: Operations that may be run by `batch`, keyed by their API path.
+#: They run without their own HMAC and token checks, which the batch
+#: request as a whole has already passed.
+BATCH_OPERATIONS = {
+    'changes': changes,
+    'problem/highest_id': problem_highest_id,
+    'problem/replies/submit': problem_reply,
+    'problem/submit_bulk': problem_submit_bulk,
+    'problem/replies/get': problem_get_replies,
+    'problem/search': problem_search,
+    'problem/subtree': problem_subtree,
+    'problem/dependencies/add': problem_dependency_add,
+    'problem/dependencies/remove': problem_dependency_remove,
+    'tag/get': tag_get,
+    'tag/problems': tag_problems,
+    'tag/all': tag_all,
+}
+
+#: The largest number of operations accepted in one batch
+BATCH_MAX_OPERATIONS = 1024
+
+
+class BatchAborted(Exception):
+    '''
+    Raised inside an atomic block to roll back a failed batch.
+    '''
+
+
+def run_batch_operation(request, user, operation):
+    '''
+    Run a single batch operation and return its result as a dict with
+    the HTTP status code of the operation and its decoded response.
+    '''
+    try:
+        view = BATCH_OPERATIONS[operation['op']]
+        data = operation.get('data', {})
+    except (KeyError, TypeError, AttributeError):
+        return {'status': 400, 'error': 'Unknown or malformed operation'}
+    if not isinstance(data, dict):
+        return {'status': 400, 'error': 'Operation data is not an object'}
+
+    # Operations draw from the same rate limits as direct calls
+    wait = ratelimit.user_wait(user, view_name(view),
+                               getattr(view, 'rate_limit', None))
+    if wait:
+        return {'status': 429, 'error': 'Rate limit exceeded',
+                'retry_after': wait}
+
+    # Skip the validation decorators; the batch was already validated
+    while hasattr(view, 'view'):
+        view = view.view
+
+    # A bad operation must not take the rest of the batch down with it
+    try:
+        response = view(request, user, data)
+    except (KeyError, TypeError, ValueError):
+        return {'status': 400, 'error': 'Malformed operation data'}
+    except Exception:
+        logger.exception('Batch operation %s failed', operation['op'])
+        return {'status': 500, 'error': 'Operation failed'}
+    if response is None:
+        return {'status': 501, 'error': 'Operation not implemented'}
+
+    content = b''.join(response).decode('utf8')
+    if response['Content-Type'] == 'application/json':
+        return {'status': response.status_code, 'data': json.loads(content)}
+    return {'status': response.status_code, 'error': content}
+
+
+@rate_limit(1, 10)
+@ValidateApiRequest
+@ValidateToken
+def batch(request, user, data):
+    '''
+    Run an ordered list of operations under a single HMAC and token.
+
+    By default the operations share one transaction, which is rolled
+    back and the batch stopped when any operation fails. If `atomic`
+    is false, every operation runs in its own transaction, which is
+    rolled back if it fails, and later operations run regardless of
+    earlier failures. Each result says whether its operation was
+    committed; `committed` says whether all of them were.
     '''
-    pass
+    operations = data.get('operations')
+    if not isinstance(operations, list):
+        return django.http.HttpResponseBadRequest('Missing operations list')
+    if len(operations) > BATCH_MAX_OPERATIONS:
+        return django.http.HttpResponseBadRequest('Too many operations')
+
+    # Every operation counts against the capacity of the API; the batch
+    # itself took the first call
+    if len(operations) > 1:
+        wait = ratelimit.shed_wait(len(operations) - 1)
+        if wait:
+            return reject('shed', ratelimit.over_capacity(wait))
+
+    results = []
+    if data.get('atomic', True):
+        committed = True
+        try:
+            with transaction.atomic():
+                for operation in operations:
+                    result = run_batch_operation(request, user, operation)
+                    results.append(result)
+                    if result['status'] >= 400:
+                        raise BatchAborted()
+        except BatchAborted:
+            committed = False
+        for result in results:
+            result['committed'] = committed
+        return JsonResponse({'committed': committed, 'results': results})
+
+    for operation in operations:
+        try:
+            with transaction.atomic():
+                result = run_batch_operation(request, user, operation)
+                result['committed'] = result['status'] < 400
+                if not result['committed']:
+                    raise BatchAborted()
+        except BatchAborted:
+            pass
+        results.append(result)
+    return JsonResponse({
+        'committed': all(result['committed'] for result in results),
+        'results': results,
+    })
+
+    for operation in operations:
+        with transaction.atomic():
+            results.append(run_batch_operation(request, user, operation))
+    return JsonResponse({'committed': True, 'results': results})
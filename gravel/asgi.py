@@ -0,0 +1,237 @@
+"""
+ASGI config for gravel project.
+
+It exposes the ASGI callable as a module-level variable named
+``application``, for servers such as uvicorn or daphne.
+
+Django 1.8 cannot run async views, so the application adapts the WSGI
+handler: the request body is received and the response sent on the
+event loop, and only the Django request handling itself runs in a
+bounded pool of threads. A robot uploading a large batch slowly then
+holds a connection but not a thread, and so does one reading a reply
+slowly as long as the reply fits in the response buffer. A longer
+reply holds its thread until the client has read all but a buffer's
+worth of it, since the rest is produced in that thread; raise
+`GRAVEL_ASGI_RESPONSE_BUFFER` to trade memory for threads.
+
+The benchmark_asgi management command measures how many slow clients
+a pool of threads serves this way.
+"""
+
+import io
+import os
+import sys
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.wsgi import get_wsgi_application
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "gravel.settings")
+
+#: The size of the chunks a response is queued in
+CHUNK_SIZE = 64 * 1024
+
+
+class RequestTooLarge(Exception):
+    pass
+
+
+class ClientDisconnected(Exception):
+    pass
+
+
+class AsgiAdapter():
+    '''
+    Serve a WSGI application as an ASGI 3 application.
+    '''
+    def __init__(self, wsgi_application, threads=32,
+                 max_body=10 * 1024 * 1024, response_buffer=1024 * 1024):
+        '''
+        :param wsgi_application: The WSGI callable to serve.
+        :param int threads: The most requests handled at once.
+        :param int max_body: The largest request body accepted, in
+          bytes; larger requests get a 413.
+        :param int response_buffer: The most bytes of a response queued
+          on the event loop before the thread producing it waits for
+          the client to read them.
+        '''
+        self.wsgi_application = wsgi_application
+        self.max_body = max_body
+        self.response_chunks = max(response_buffer // CHUNK_SIZE, 1)
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] != 'http':
+            raise ValueError('Unsupported ASGI scope type %r'
+                             % scope['type'])
+
+        try:
+            body = await self.read_body(receive)
+        except RequestTooLarge:
+            await send({'type': 'http.response.start', 'status': 413,
+                        'headers': [(b'content-type', b'text/plain')]})
+            await send({'type': 'http.response.body',
+                        'body': b'Request body too large'})
+            return
+        except ClientDisconnected:
+            # Nobody is waiting for the response to a truncated request
+            return
+
+        loop = asyncio.get_event_loop()
+        queue = asyncio.Queue(maxsize=self.response_chunks)
+        stopped = []
+        handler = loop.run_in_executor(
+            self.executor, self.handle, loop, queue, stopped,
+            self.environ(scope, body))
+        try:
+            start = await queue.get()
+            if start is None:
+                # The application failed before starting a response
+                await handler
+                raise RuntimeError('WSGI application gave no response')
+            await send({'type': 'http.response.start', 'status': start[0],
+                        'headers': start[1]})
+            while True:
+                chunk = await queue.get()
+                if chunk is None:
+                    break
+                await send({'type': 'http.response.body', 'body': chunk,
+                            'more_body': True})
+            # Only end the body if it was produced without errors
+            await handler
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            # Unblock the thread if the client went away mid-response
+            stopped.append(True)
+            while not queue.empty():
+                queue.get_nowait()
+            await handler
+
+    async def read_body(self, receive):
+        '''
+        Receive the whole request body without holding a thread.
+
+        :raises RequestTooLarge: if the body exceeds `max_body`.
+        :raises ClientDisconnected: if the client went away before
+          sending the whole body.
+        '''
+        body = bytearray()
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                raise ClientDisconnected()
+            body += message.get('body', b'')
+            if len(body) > self.max_body:
+                raise RequestTooLarge()
+            if not message.get('more_body', False):
+                break
+        return bytes(body)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=True)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    @staticmethod
+    def environ(scope, body):
+        '''
+        Build the WSGI environ of an ASGI HTTP request.
+        '''
+        server = scope.get('server') or ('localhost', 80)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', ''),
+            # WSGI strings hold the raw bytes as latin-1
+            'PATH_INFO': scope['path'].encode('utf8').decode('latin1'),
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+        }
+        if scope.get('client'):
+            environ['REMOTE_ADDR'] = scope['client'][0]
+
+        for name, value in scope.get('headers', []):
+            name = name.decode('latin1').upper().replace('-', '_')
+            value = value.decode('latin1')
+            if name == 'CONTENT_LENGTH':
+                continue
+            if name != 'CONTENT_TYPE':
+                name = 'HTTP_' + name
+            if name in environ:
+                value = environ[name] + ',' + value
+            environ[name] = value
+        return environ
+
+    def handle(self, loop, queue, stopped, environ):
+        '''
+        Run the WSGI application in a pool thread, queueing the status
+        and headers and then the body in chunks for the event loop, and
+        None when the response is finished. The whole response is
+        produced and closed in this thread, because Django's database
+        connections belong to the thread that opened them.
+        '''
+        def put(item):
+            if not stopped:
+                asyncio.run_coroutine_threadsafe(
+                    queue.put(item), loop).result()
+
+        start = []
+        buffer = bytearray()
+
+        def start_response(status, headers, exc_info=None):
+            start[:] = [int(status.split(' ', 1)[0]), [
+                (name.lower().encode('latin1'), value.encode('latin1'))
+                for name, value in headers]]
+            return buffer.extend
+
+        try:
+            chunks = self.wsgi_application(environ, start_response)
+            try:
+                started = False
+                for chunk in chunks:
+                    if not started:
+                        put(tuple(start))
+                        started = True
+                    buffer += chunk
+                    while len(buffer) >= CHUNK_SIZE:
+                        put(bytes(buffer[:CHUNK_SIZE]))
+                        del buffer[:CHUNK_SIZE]
+                if not started:
+                    put(tuple(start))
+                if buffer:
+                    put(bytes(buffer))
+            finally:
+                if hasattr(chunks, 'close'):
+                    chunks.close()
+        finally:
+            put(None)
+
+
+application = AsgiAdapter(
+    get_wsgi_application(),
+    threads=getattr(settings, 'GRAVEL_ASGI_THREADS', 32),
+    max_body=getattr(settings, 'GRAVEL_ASGI_MAX_BODY', 10 * 1024 * 1024),
+    response_buffer=getattr(settings, 'GRAVEL_ASGI_RESPONSE_BUFFER',
+                            1024 * 1024))
+
+# Periodically purge expired request tokens if the settings ask for it;
+# the tokens module can only be imported once Django is set up
+from api.libs.tokens import start_purge_thread  # noqa: E402
+start_purge_thread()
@@ -0,0 +1,402 @@
+'''
+Counters and histograms exposed at /metrics in the Prometheus text
+exposition format.
+
+Recording a value only updates a dict in this process. When
+`GRAVEL_METRICS_DIR` is set, every process also writes its values to
+its own file in that directory at most every
+`GRAVEL_METRICS_FLUSH_INTERVAL` seconds, and /metrics adds up the files
+of all processes, so the numbers cover every WSGI worker. Reading
+/metrics also adds the files of processes that have exited into one
+archive file and deletes them, so that counters never go down and the
+directory does not grow with every worker restart.
+
+Without `GRAVEL_METRICS_DIR` only the serving process is reported.
+'''
+import os
+import json
+import time
+import atexit
+import bisect
+import logging
+import binascii
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import django.http
+from django.conf import settings
+
+from gravel.queries import view_name
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+
+#: Upper bounds in seconds of the default histogram buckets
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+#: The file in the metrics directory holding the values of processes
+#: that have exited, and the file locked while it is updated
+ARCHIVE = 'archive.json'
+ARCHIVE_LOCK = 'archive.lock'
+
+logger = logging.getLogger(__name__)
+
+
+def process_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        # It exists, but belongs to another user
+        return True
+    return True
+
+
+def merge_values(merged, values):
+    '''
+    Add `values`, a list of `[name, labels, value]` lists as written to
+    the metrics files, into the dict `merged`.
+    '''
+    for name, labels, value in values:
+        key = (name, tuple(labels))
+        if key not in merged:
+            merged[key] = value
+        elif isinstance(value, list):
+            merged[key] = [a + b for a, b in zip(merged[key], value)]
+        else:
+            merged[key] += value
+
+
+def read_values(path, default=None):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+
+class Registry():
+    '''
+    The metrics of this process and the values recorded for them.
+    '''
+    def __init__(self, directory=None, flush_interval=5):
+        '''
+        :param str directory: Where processes share their values, or
+          None to report only this process.
+        :param float flush_interval: The longest time in seconds
+          between writes of this process's file.
+        '''
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.metrics = OrderedDict()
+        self._lock = threading.Lock()
+        self._start()
+
+    def _start(self):
+        '''
+        Begin recording for the current process, which may have been
+        forked from the one that created the registry.
+        '''
+        self._pid = os.getpid()
+        self._values = {}
+        self._flushed = time.monotonic()
+        self._path = None
+        if self.directory:
+            suffix = binascii.hexlify(os.urandom(4)).decode('ascii')
+            self._path = os.path.join(
+                self.directory, 'metrics-%i-%s.json' % (self._pid, suffix))
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def add(self, name, labels, amount):
+        with self._lock:
+            if os.getpid() != self._pid:
+                self._start()
+            key = (name, labels)
+            self._values[key] = self._values.get(key, 0) + amount
+            self._maybe_flush()
+
+    def observe(self, name, labels, buckets, value):
+        with self._lock:
+            if os.getpid() != self._pid:
+                self._start()
+            key = (name, labels)
+            # A count per bucket, one for values above every bucket, and
+            # the sum of all values
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * (len(buckets) + 2)
+            counts[bisect.bisect_left(buckets, value)] += 1
+            counts[-1] += value
+            self._maybe_flush()
+
+    def _maybe_flush(self):
+        if (self._path is not None and
+                time.monotonic() - self._flushed >= self.flush_interval):
+            self._write()
+
+    def _write(self):
+        self._flushed = time.monotonic()
+        values = [[name, labels, value]
+                  for (name, labels), value in self._values.items()]
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            temp = self._path + '.tmp'
+            with open(temp, 'w') as f:
+                json.dump(values, f)
+            os.replace(temp, self._path)
+        except OSError:
+            logger.exception('Writing metrics to %s failed', self._path)
+
+    def flush(self):
+        '''
+        Write this process's values to its file now.
+        '''
+        with self._lock:
+            if self._path is not None and os.getpid() == self._pid:
+                self._write()
+
+    def collect(self):
+        '''
+        Return the values of every process as a dict keyed by
+        `(name, labels)` tuples.
+        '''
+        if self.directory is None:
+            with self._lock:
+                return {key: (list(value) if isinstance(value, list)
+                              else value)
+                        for key, value in self._values.items()}
+
+        self.flush()
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            lock = os.open(os.path.join(self.directory, ARCHIVE_LOCK),
+                           os.O_RDWR | os.O_CREAT, 0o600)
+        except OSError:
+            logger.exception('Locking metrics in %s failed', self.directory)
+            return {}
+        try:
+            if fcntl is not None:
+                fcntl.lockf(lock, fcntl.LOCK_EX)
+            return self._collect_files()
+        finally:
+            os.close(lock)
+
+    def _collect_files(self):
+        '''
+        Add up the archive and the files of every process, and move the
+        files of processes that have exited into the archive. The caller
+        holds the archive lock.
+        '''
+        path = os.path.join(self.directory, ARCHIVE)
+        archive = read_values(path, {'values': [], 'merged': []})
+        # Files archived before but not deleted then; their values are
+        # already in the archive
+        leftover = []
+        for filename in archive['merged']:
+            try:
+                os.remove(os.path.join(self.directory, filename))
+            except FileNotFoundError:
+                pass
+            except OSError:
+                leftover.append(filename)
+        archived = {}
+        merge_values(archived, archive['values'])
+
+        merged = dict(archived)
+        dead = []
+        for filename in os.listdir(self.directory):
+            if not (filename.startswith('metrics-') and
+                    filename.endswith('.json')) or filename in leftover:
+                continue
+            values = read_values(os.path.join(self.directory, filename))
+            if values is None:
+                continue
+            merge_values(merged, values)
+
+            pid = filename.split('-')[1]
+            if (pid.isdigit() and int(pid) != os.getpid() and
+                    not process_exists(int(pid))):
+                merge_values(archived, values)
+                dead.append(filename)
+
+        if dead and fcntl is not None:
+            archive = {'merged': dead + leftover,
+                       'values': [[name, labels, value] for (name, labels),
+                                  value in archived.items()]}
+            try:
+                with open(path + '.tmp', 'w') as f:
+                    json.dump(archive, f)
+                os.replace(path + '.tmp', path)
+                for filename in dead:
+                    os.remove(os.path.join(self.directory, filename))
+            except OSError:
+                logger.exception('Archiving metrics in %s failed',
+                                 self.directory)
+        return merged
+
+    def exposition(self):
+        '''
+        Return every metric in the Prometheus text exposition format.
+        '''
+        values = self.collect()
+        lines = []
+        for metric in self.metrics.values():
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.type))
+            for (name, labels), value in sorted(values.items()):
+                if name == metric.name:
+                    lines.extend(metric.samples(labels, value))
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    escaped = (value.replace('\\', r'\\').replace('"', r'\"')
+               .replace('\n', r'\n') for value in values)
+    return '{%s}' % ','.join('%s="%s"' % (name, value)
+                             for name, value in zip(names, escaped))
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter():
+    type = 'counter'
+
+    def __init__(self, name, help, labelnames=(), registry=None):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.registry = registry if registry is not None else REGISTRY
+        self.registry.register(self)
+
+    def label_values(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def inc(self, amount=1, **labels):
+        self.registry.add(self.name, self.label_values(labels), amount)
+
+    def samples(self, labels, value):
+        yield '%s%s %s' % (self.name, format_labels(self.labelnames, labels),
+                           format_value(value))
+
+
+class Histogram(Counter):
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS,
+                 registry=None):
+        super().__init__(name, help, labelnames, registry)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        self.registry.observe(self.name, self.label_values(labels),
+                              self.buckets, value)
+
+    @contextmanager
+    def time(self, **labels):
+        '''
+        Observe the time taken by the block, in seconds.
+        '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self, labels, counts):
+        names = self.labelnames + ('le',)
+        total = 0
+        for bound, count in zip(self.buckets + ('+Inf',), counts):
+            total += count
+            bound = bound if bound == '+Inf' else format_value(float(bound))
+            yield '%s_bucket%s %i' % (
+                self.name, format_labels(names, labels + (bound,)), total)
+        labels = format_labels(self.labelnames, labels)
+        yield '%s_sum%s %s' % (self.name, labels, format_value(counts[-1]))
+        yield '%s_count%s %i' % (self.name, labels, total)
+
+
+#: The registry of the metrics below
+REGISTRY = Registry(
+    directory=getattr(settings, 'GRAVEL_METRICS_DIR', None),
+    flush_interval=getattr(settings, 'GRAVEL_METRICS_FLUSH_INTERVAL', 5))
+atexit.register(REGISTRY.flush)
+
+REQUEST_DURATION = Histogram(
+    'gravel_request_duration_seconds',
+    'Time taken to handle a request, by view.', ['view'])
+RESPONSES = Counter(
+    'gravel_responses_total',
+    'Responses sent, by view and HTTP status code.', ['view', 'code'])
+API_REJECTIONS = Counter(
+    'gravel_api_rejections_total',
+    'API requests refused before reaching the view, by reason.', ['reason'])
+TOKENS_ISSUED = Counter(
+    'gravel_api_tokens_issued_total',
+    'API request tokens issued, by token mode.', ['mode'])
+TOKENS_REDEEMED = Counter(
+    'gravel_api_tokens_redeemed_total',
+    'API request tokens presented, by whether they were accepted.',
+    ['result'])
+MARKDOWN_RENDER = Histogram(
+    'gravel_markdown_render_seconds',
+    'Time taken to render and sanitize markdown.',
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25))
+
+
+def view_label(request):
+    '''
+    Return the URL name of the view that handled `request`, or the
+    dotted path of the view if its URL has no name.
+    '''
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return 'unresolved'
+    return match.url_name or view_name(match.func)
+
+
+class MetricsMiddleware():
+    '''
+    Record the latency and status code of every request. List this
+    first in MIDDLEWARE_CLASSES so that the time spent in the other
+    middleware is included.
+    '''
+    def process_request(self, request):
+        request.metrics_start = time.perf_counter()
+
+    def process_response(self, request, response):
+        start = getattr(request, 'metrics_start', None)
+        if start is None:
+            return response
+
+        view = view_label(request)
+        REQUEST_DURATION.observe(time.perf_counter() - start, view=view)
+        RESPONSES.inc(view=view, code=response.status_code)
+        return response
+
+
+def metrics(request):
+    '''
+    Return every metric in the Prometheus text exposition format.
+
+    Only clients whose address is in `GRAVEL_METRICS_ALLOWED_IPS` may
+    read the metrics; set it to None to allow everyone.
+    '''
+    allowed = getattr(settings, 'GRAVEL_METRICS_ALLOWED_IPS',
+                      ('127.0.0.1', '::1'))
+    if allowed is not None and request.META.get('REMOTE_ADDR') not in allowed:
+        return django.http.HttpResponseForbidden('Metrics are not public')
+
+    return django.http.HttpResponse(
+        REGISTRY.exposition(), content_type='text/plain; version=0.0.4')
@@ -25,6 +25,23 @@ DATABASES = {
     }
 }
 
+# API load shedding
+# Authenticated API calls share a token bucket of (rate per second,
+# burst); once it is empty they get a 503, so robots cannot take every
+# worker from the HTML pages. Too small a bucket refuses calls that the
+# workers could have served, and too large a bucket lets robots
+# saturate the workers first. The default is shown; set it to None to
+# never shed API calls.
+
+# GRAVEL_API_CAPACITY = (100, 1000)
+
+# API rate limit buckets
+# Without a file every worker process keeps its own buckets, so each
+# limit is multiplied by the number of workers. Point this at a file on
+# local disk, writable by every worker, to share them.
+
+GRAVEL_RATE_LIMIT_FILE = os.path.join(BASE_DIR, 'ratelimit.buckets')
+
 # Internationalization
 # https://docs.djangoproject.com/en/1.8/topics/i18n/
 
@@ -0,0 +1,142 @@
+'''
+Instrumentation of the SQL queries made while handling each request.
+
+Views declare the most queries a request to them should need with the
+`query_budget` decorator. `QueryBudgetMiddleware` records the number of
+queries, the total SQL time and the slowest statements of every
+request, logs them, and in debug mode adds them to the response
+headers. Tests check views against their budgets with
+`gravel.testing.QueryBudgetMixin`.
+'''
+import logging
+
+from django.conf import settings
+from django.db import connection
+
+
+#: The number of slowest statements reported for each request
+SLOWEST_COUNT = 3
+
+logger = logging.getLogger(__name__)
+
+
+def query_budget(budget):
+    '''
+    Declare that a request to the decorated view should make at most
+    `budget` queries, counting those made by middleware.
+
+    Apply this outside any other decorators so that the budget is
+    visible on the view that the URLconf routes to.
+    '''
+    def decorator(view):
+        view.query_budget = budget
+        return view
+    return decorator
+
+
+def view_name(view):
+    '''
+    Return the dotted path of `view`, looking through the validation
+    wrappers of `api.libs.validate`.
+    '''
+    while hasattr(view, 'view'):
+        view = view.view
+    if not hasattr(view, '__name__'):
+        return repr(view)
+    return '%s.%s' % (view.__module__, view.__name__)
+
+
+class QueryRecorder():
+    '''
+    Record the queries made on the default connection between `start`
+    and `stop`, whether or not DEBUG is on.
+    '''
+    def __init__(self):
+        self.queries = []
+
+    def start(self):
+        self._forced = connection.force_debug_cursor
+        connection.force_debug_cursor = True
+        self._first = len(connection.queries_log)
+
+    def stop(self):
+        self.queries = list(connection.queries_log)[self._first:]
+        connection.force_debug_cursor = self._forced
+
+    @property
+    def count(self):
+        return len(self.queries)
+
+    @property
+    def time(self):
+        '''
+        The total time spent in SQL, in seconds.
+        '''
+        return sum(float(query['time']) for query in self.queries)
+
+    def slowest(self, count=SLOWEST_COUNT):
+        return sorted(self.queries, key=lambda query: float(query['time']),
+                      reverse=True)[:count]
+
+
+def header_sql(sql, length=200):
+    '''
+    Squash `sql` into a single line of ASCII that fits in a header.
+    '''
+    sql = ' '.join(sql.split())[:length]
+    return sql.encode('ascii', 'replace').decode('ascii')
+
+
+class QueryBudgetMiddleware():
+    '''
+    Record the queries made while handling each request.
+
+    Every request is logged at DEBUG level, or at WARNING level if it
+    made more queries than its view's `query_budget`. When DEBUG is on
+    the response also gets these headers:
+
+    * X-Query-Count: the number of queries.
+    * X-Query-Time: the total SQL time in milliseconds.
+    * X-Query-Budget: the view's budget, if it declares one.
+    * X-Query-Slowest-1 and up: the slowest statements with their times.
+
+    List this first in MIDDLEWARE_CLASSES so the queries of the other
+    middleware are counted too. The body of a streaming response is
+    produced after the response leaves the middleware, so queries made
+    while streaming are not counted.
+    '''
+    def process_request(self, request):
+        request.query_recorder = QueryRecorder()
+        request.query_recorder.start()
+
+    def process_response(self, request, response):
+        recorder = getattr(request, 'query_recorder', None)
+        if recorder is None:
+            return response
+        recorder.stop()
+
+        budget = None
+        match = getattr(request, 'resolver_match', None)
+        if match is not None:
+            budget = getattr(match.func, 'query_budget', None)
+
+        level = logging.DEBUG
+        if budget is not None and recorder.count > budget:
+            level = logging.WARNING
+        logger.log(level, '%s %s: %i queries (budget %s) in %.1fms',
+                   request.method, request.path, recorder.count, budget,
+                   recorder.time * 1000)
+        slowest = recorder.slowest()
+        for query in slowest:
+            logger.debug('%.1fms %s', float(query['time']) * 1000,
+                         query['sql'])
+
+        if settings.DEBUG:
+            response['X-Query-Count'] = str(recorder.count)
+            response['X-Query-Time'] = '%.1f' % (recorder.time * 1000)
+            if budget is not None:
+                response['X-Query-Budget'] = str(budget)
+            for i, query in enumerate(slowest, 1):
+                response['X-Query-Slowest-%i' % i] = '%.1fms %s' % (
+                    float(query['time']) * 1000, header_sql(query['sql']))
+        return response
@@ -31,9 +31,12 @@ INSTALLED_APPS = (
     'api',
     'home',
     'account',
+    'webhooks',
 )
 
 MIDDLEWARE_CLASSES = (
+    'gravel.metrics.MetricsMiddleware',
+    'gravel.queries.QueryBudgetMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
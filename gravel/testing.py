@@ -0,0 +1,34 @@
+from contextlib import contextmanager
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from gravel.queries import view_name
+
+
+class QueryBudgetMixin():
+    '''
+    TestCase mixin for checking views against the budgets they declare
+    with `gravel.queries.query_budget`.
+    '''
+
+    @contextmanager
+    def assertQueryBudget(self, view):
+        '''
+        Fail if the code in the block makes more queries than the
+        budget of `view`, or if `view` declares no budget.
+
+        Read streaming responses inside the block so that the queries
+        made while streaming are counted.
+        '''
+        budget = getattr(view, 'query_budget', None)
+        if budget is None:
+            self.fail('%s declares no query budget' % view_name(view))
+
+        with CaptureQueriesContext(connection) as context:
+            yield context
+
+        if len(context) > budget:
+            self.fail('%s made %i queries, over its budget of %i:\n%s' % (
+                view_name(view), len(context), budget,
+                '\n'.join(query['sql'] for query in context.captured_queries)))
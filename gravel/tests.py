@@ -0,0 +1,347 @@
+import os
+import shutil
+import asyncio
+import tempfile
+from unittest import mock
+
+import django.test
+from django.conf.urls import url
+from django.contrib.auth.models import User
+from django.core.wsgi import get_wsgi_application
+from django.http import HttpResponse
+
+from gravel import metrics
+from gravel.asgi import AsgiAdapter
+from gravel.queries import query_budget
+from gravel.testing import QueryBudgetMixin
+
+
+@query_budget(2)
+def count_users(request):
+    User.objects.count()
+    User.objects.exists()
+    return HttpResponse('ok')
+
+
+@query_budget(1)
+def count_users_strict(request):
+    return count_users(request)
+
+
+urlpatterns = [
+    url(r'^count$', count_users),
+    url(r'^count/strict$', count_users_strict),
+]
+
+
+@django.test.override_settings(ROOT_URLCONF='gravel.tests')
+class TestQueryBudgetMiddleware(django.test.TestCase):
+    '''
+    Test the per-request query instrumentation.
+    '''
+
+    def test_debug_headers(self):
+        with self.settings(DEBUG=True):
+            response = self.client.get('/count')
+
+        self.assertEqual(response['X-Query-Count'], '2')
+        self.assertEqual(response['X-Query-Budget'], '2')
+        self.assertIn('X-Query-Time', response)
+        self.assertIn('SELECT', response['X-Query-Slowest-1'])
+        self.assertIn('SELECT', response['X-Query-Slowest-2'])
+        self.assertNotIn('X-Query-Slowest-3', response)
+
+    def test_no_headers_without_debug(self):
+        response = self.client.get('/count')
+        self.assertNotIn('X-Query-Count', response)
+
+    def test_over_budget_logged(self):
+        with self.assertLogs('gravel.queries', 'WARNING') as logs:
+            self.client.get('/count/strict')
+        self.assertIn('/count/strict: 2 queries (budget 1)', logs.output[0])
+
+
+class TestQueryBudgetMixin(QueryBudgetMixin, django.test.TestCase):
+    '''
+    Test the assertQueryBudget helper.
+    '''
+
+    def test_within_budget(self):
+        with self.assertQueryBudget(count_users):
+            User.objects.count()
+
+    def test_over_budget(self):
+        with self.assertRaises(AssertionError):
+            with self.assertQueryBudget(count_users_strict):
+                count_users(None)
+
+    def test_no_budget(self):
+        with self.assertRaises(AssertionError):
+            with self.assertQueryBudget(lambda request: None):
+                pass
+
+
+class TestMetricsRegistry(django.test.SimpleTestCase):
+    '''
+    Test recording and exposing metrics, within one process and
+    across processes sharing a directory.
+    '''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def make_registry(self, directory=None):
+        registry = metrics.Registry(directory, flush_interval=3600)
+        counter = metrics.Counter('test_total', 'A counter.', ['kind'],
+                                  registry=registry)
+        histogram = metrics.Histogram('test_seconds', 'A histogram.',
+                                      buckets=(0.1, 1), registry=registry)
+        return registry, counter, histogram
+
+    def test_exposition(self):
+        registry, counter, histogram = self.make_registry()
+        counter.inc(kind='a')
+        counter.inc(2, kind='b"c')
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(5)
+
+        lines = registry.exposition().splitlines()
+        self.assertEqual(lines[:4], [
+            '# HELP test_total A counter.',
+            '# TYPE test_total counter',
+            'test_total{kind="a"} 1',
+            'test_total{kind="b\\"c"} 2',
+        ])
+        self.assertEqual(lines[6:], [
+            'test_seconds_bucket{le="0.1"} 1',
+            'test_seconds_bucket{le="1.0"} 2',
+            'test_seconds_bucket{le="+Inf"} 3',
+            'test_seconds_sum 5.55',
+            'test_seconds_count 3',
+        ])
+
+    def test_processes_aggregate(self):
+        '''
+        Test that registries sharing a directory, as in separate worker
+        processes, report the sum of their values.
+        '''
+        first, first_counter, first_histogram = self.make_registry(
+            self.directory)
+        second, second_counter, second_histogram = self.make_registry(
+            self.directory)
+
+        first_counter.inc(kind='a')
+        second_counter.inc(3, kind='a')
+        first_histogram.observe(0.5)
+        second_histogram.observe(0.5)
+        second.flush()
+
+        text = first.exposition()
+        self.assertIn('test_total{kind="a"} 4', text)
+        self.assertIn('test_seconds_count 2', text)
+        self.assertEqual(text, second.exposition())
+
+    def test_exited_processes_archived(self):
+        '''
+        Test that the files of processes that have exited are added into
+        the archive and deleted, without changing the totals.
+        '''
+        first, first_counter, first_histogram = self.make_registry(
+            self.directory)
+        second, second_counter, second_histogram = self.make_registry(
+            self.directory)
+        second._path = os.path.join(self.directory, 'metrics-0-dead.json')
+        first_counter.inc(kind='a')
+        second_counter.inc(3, kind='a')
+        second_histogram.observe(0.5)
+        second.flush()
+
+        with mock.patch.object(metrics, 'process_exists', return_value=False):
+            for i in range(2):
+                text = first.exposition()
+                self.assertIn('test_total{kind="a"} 4', text)
+                self.assertIn('test_seconds_count 1', text)
+        self.assertFalse(os.path.exists(second._path))
+        self.assertTrue(os.path.exists(
+            os.path.join(self.directory, metrics.ARCHIVE)))
+
+    def test_fork_starts_fresh(self):
+        registry, counter, histogram = self.make_registry(self.directory)
+        counter.inc(kind='a')
+        registry.flush()
+
+        # Pretend this is a child process forked after the first record
+        registry._pid = -1
+        counter.inc(kind='a')
+        registry.flush()
+
+        self.assertIn('test_total{kind="a"} 2', registry.exposition())
+
+
+class TestMetricsEndpoint(django.test.TestCase):
+    '''
+    Test the /metrics view and the metrics recorded by requests.
+    '''
+
+    def value(self, name, labels):
+        return metrics.REGISTRY.collect().get((name, labels), 0)
+
+    def test_request_metrics(self):
+        self.client.get('/problem/report/')
+        response = self.client.get('/metrics')
+
+        self.assertEqual(response.status_code, 200)
+        text = response.content.decode('utf8')
+        self.assertIn('gravel_request_duration_seconds_bucket{'
+                      'view="problems.views.problem_report",le="+Inf"}', text)
+        self.assertIn('gravel_responses_total{'
+                      'view="problems.views.problem_report",code="200"}', text)
+
+    def test_not_public(self):
+        response = self.client.get('/metrics', REMOTE_ADDR='192.0.2.1')
+        self.assertEqual(response.status_code, 403)
+
+    def test_api_rejections(self):
+        user = User.objects.create(username='test')
+
+        before = self.value('gravel_api_rejections_total', ('bad_hmac',))
+        response = self.client.post(
+            '/api/tag/all', '{}', content_type='application/json',
+            HTTP_X_GRAVEL_USER_ID=user.pk, HTTP_X_GRAVEL_HMAC_SHA256='bad')
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(
+            self.value('gravel_api_rejections_total', ('bad_hmac',)),
+            before + 1)
+
+
+def echo_application(environ, start_response):
+    '''
+    A WSGI application answering with the request path, query string
+    and body.
+    '''
+    body = environ['wsgi.input'].read()
+    start_response('200 OK', [('Content-Type', 'text/plain'),
+                              ('X-Path', environ['PATH_INFO'])])
+    return [environ['QUERY_STRING'].encode('latin1'), b'|', body]
+
+
+class TestAsgiAdapter(django.test.SimpleTestCase):
+    '''
+    Test serving WSGI applications over ASGI.
+    '''
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def scope(self, path, method='GET', query=b'', headers=()):
+        return {'type': 'http', 'method': method, 'path': path,
+                'query_string': query, 'headers': list(headers),
+                'server': ('testserver', 80), 'client': ('127.0.0.1', 1234)}
+
+    async def request(self, adapter, scope, chunks=(b'',), wait=None):
+        '''
+        Send a request with its body in `chunks`, waiting for the
+        `wait` event before the last one, and return the messages sent
+        back.
+        '''
+        chunks = list(chunks)
+        messages = []
+
+        async def receive():
+            if len(chunks) == 1 and wait is not None:
+                await wait.wait()
+            body = chunks.pop(0)
+            return {'type': 'http.request', 'body': body,
+                    'more_body': bool(chunks)}
+
+        async def send(message):
+            messages.append(message)
+
+        await adapter(scope, receive, send)
+        return messages
+
+    def test_request(self):
+        adapter = AsgiAdapter(echo_application, threads=1)
+        messages = self.loop.run_until_complete(self.request(
+            adapter, self.scope('/caf\xe9', 'POST', b'a=1'), [b'he', b'llo']))
+
+        self.assertEqual(messages[0]['status'], 200)
+        self.assertIn((b'x-path', '/caf\xe9'.encode('utf8')),
+                      messages[0]['headers'])
+        self.assertEqual(b''.join(m.get('body', b'') for m in messages[1:]),
+                         b'a=1|hello')
+        self.assertFalse(messages[-1].get('more_body', False))
+
+    def test_body_too_large(self):
+        adapter = AsgiAdapter(echo_application, threads=1, max_body=4)
+        messages = self.loop.run_until_complete(self.request(
+            adapter, self.scope('/', 'POST'), [b'abc', b'def']))
+        self.assertEqual(messages[0]['status'], 413)
+
+    def test_disconnect_during_upload(self):
+        '''
+        Test that a request whose client goes away before sending the
+        whole body is not handled.
+        '''
+        handled = []
+
+        def application(environ, start_response):
+            handled.append(environ)
+            return echo_application(environ, start_response)
+
+        messages = []
+        received = [{'type': 'http.request', 'body': b'a', 'more_body': True},
+                    {'type': 'http.disconnect'}]
+
+        async def receive():
+            return received.pop(0)
+
+        async def send(message):
+            messages.append(message)
+
+        adapter = AsgiAdapter(application, threads=1)
+        self.loop.run_until_complete(
+            adapter(self.scope('/', 'POST'), receive, send))
+        self.assertEqual(handled, [])
+        self.assertEqual(messages, [])
+
+    def test_slow_upload_holds_no_thread(self):
+        '''
+        Test that a request whose body is still arriving does not stop
+        another request from being handled by the only thread.
+        '''
+        adapter = AsgiAdapter(echo_application, threads=1)
+        arrived = asyncio.Event()
+
+        async def requests():
+            slow = asyncio.ensure_future(self.request(
+                adapter, self.scope('/slow', 'POST'), [b'a', b'b'], arrived))
+            fast = await asyncio.wait_for(
+                self.request(adapter, self.scope('/fast')), 5)
+            self.assertFalse(slow.done())
+            arrived.set()
+            return fast, await slow
+
+        fast, slow = self.loop.run_until_complete(requests())
+        self.assertEqual(fast[0]['status'], 200)
+        self.assertEqual(slow[-1]['body'], b'')
+        self.assertEqual(b''.join(m.get('body', b'') for m in slow[1:]),
+                         b'|ab')
+
+    def test_django(self):
+        adapter = AsgiAdapter(get_wsgi_application(), threads=2)
+        messages = self.loop.run_until_complete(self.request(
+            adapter, self.scope('/metrics')))
+
+        self.assertEqual(messages[0]['status'], 200)
+        body = b''.join(m.get('body', b'') for m in messages[1:])
+        self.assertIn(b'# TYPE gravel_responses_total counter', body)
@@ -11,5 +11,6 @@ urlpatterns = [
 
     # Home URLs
     url(r'^$', 'home.views.home'),
+    url(r'^metrics$', 'gravel.metrics.metrics'),
     url(r'^account/$', include('account.urls')),
 ]
@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "gravel.settings")
 
 application = get_wsgi_application()
+
+# Periodically purge expired request tokens if the settings ask for it;
+# the tokens module can only be imported once Django is set up
+from api.libs.tokens import start_purge_thread  # noqa: E402
+start_purge_thread()
@@ -5,3 +5,4 @@ from problems import models
 admin.site.register(models.Problem)
 admin.site.register(models.ProblemTag)
 admin.site.register(models.Reply)
+admin.site.register(models.RoutingRule)
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from problems import models
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the search index for every problem and reply.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Number of problems to index per '
+                                 'transaction')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        count = 0
+        last_pk = 0
+        while True:
+            problems = list(models.Problem.objects.filter(pk__gt=last_pk)
+                            .order_by('pk')
+                            .prefetch_related('reply_set')[:batch_size])
+            if not problems:
+                break
+
+            with transaction.atomic():
+                models.SearchTerm.objects.filter(
+                    problem__in=problems).delete()
+                for problem in problems:
+                    models.SearchTerm.index_problem(problem)
+                    for reply in problem.reply_set.all():
+                        models.SearchTerm.index_reply(problem, reply)
+
+            count += len(problems)
+            last_pk = problems[-1].pk
+
+        self.stdout.write('Indexed %i problems' % count)
@@ -0,0 +1,59 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from problems import models
+from problems.render import RENDER_VERSION, render_markdown
+
+
+class Command(BaseCommand):
+    help = ('Render and store HTML for problem descriptions and replies '
+            'that were rendered by an older RENDER_VERSION.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Number of rows to render per transaction')
+        parser.add_argument('--all', action='store_true', default=False,
+                            help='Re-render every row, even current ones')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        force = options['all']
+
+        count = self.render(models.Problem, 'description', batch_size, force)
+        self.stdout.write('Rendered %i problem descriptions' % count)
+
+        count = self.render(models.Reply, 'text', batch_size, force)
+        self.stdout.write('Rendered %i replies' % count)
+
+    @staticmethod
+    def render(model, source, batch_size, force=False):
+        '''
+        Re-render the `<source>_html` field of every stale `model` row,
+        walking the table in primary key order one batch at a time.
+
+        :returns: the number of rows rendered.
+        '''
+        html = source + '_html'
+        version = source + '_html_version'
+
+        queryset = model.objects.all()
+        if not force:
+            queryset = queryset.exclude(**{version: RENDER_VERSION})
+
+        count = 0
+        last_pk = 0
+        while True:
+            batch = list(queryset.filter(pk__gt=last_pk).order_by('pk')
+                         .values_list('pk', source)[:batch_size])
+            if not batch:
+                return count
+
+            with transaction.atomic():
+                for pk, text in batch:
+                    model.objects.filter(pk=pk).update(**{
+                        html: render_markdown(text),
+                        version: RENDER_VERSION
+                    })
+
+            count += len(batch)
+            last_pk = batch[-1][0]
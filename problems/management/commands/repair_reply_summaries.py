@@ -0,0 +1,65 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Max
+
+from problems import models
+
+
+class Command(BaseCommand):
+    help = ('Recompute the reply_count, last_reply_at and last_reply_user '
+            'summary of every problem from its replies, fixing any that '
+            'have drifted.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Number of problems to check per '
+                                 'transaction')
+
+    def handle(self, *args, **options):
+        checked, repaired = self.repair(options['batch_size'])
+        self.stdout.write('Checked %i problems, repaired %i'
+                          % (checked, repaired))
+
+    @staticmethod
+    def repair(batch_size):
+        '''
+        Walk the problems in primary key order one batch at a time,
+        aggregating the replies of each batch in one query and updating
+        the problems whose summary differs.
+
+        :returns: a `(checked, repaired)` tuple of problem counts.
+        '''
+        checked = repaired = 0
+        last_pk = 0
+        while True:
+            with transaction.atomic():
+                batch = list(models.Problem.objects.filter(pk__gt=last_pk)
+                             .order_by('pk')
+                             .values_list('pk', 'reply_count',
+                                          'last_reply_at',
+                                          'last_reply_user')[:batch_size])
+                if not batch:
+                    return checked, repaired
+
+                stats = (models.Reply.objects
+                         .filter(problem__in=[row[0] for row in batch])
+                         .values('problem')
+                         .annotate(count=Count('pk'), last=Max('pk')))
+                counts = {s['problem']: s['count'] for s in stats}
+                # Replies are numbered in the order they are added, so the
+                # highest primary key is the newest reply
+                last = {reply[0]: reply[1:] for reply in
+                        models.Reply.objects
+                        .filter(pk__in=[s['last'] for s in stats])
+                        .values_list('problem', 'date', 'user')}
+
+                for pk, count, date, user in batch:
+                    summary = (counts.get(pk, 0),) + last.get(pk, (None, None))
+                    if summary != (count, date, user):
+                        models.Problem.objects.filter(pk=pk).update(
+                            reply_count=summary[0], last_reply_at=summary[1],
+                            last_reply_user=summary[2])
+                        repaired += 1
+
+            checked += len(batch)
+            last_pk = batch[-1][0]
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('problems', '0005_remove_problem_reference'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='problem',
+            name='description_html',
+            field=models.TextField(default='', editable=False),
+        ),
+        migrations.AddField(
+            model_name='problem',
+            name='description_html_version',
+            field=models.PositiveSmallIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='reply',
+            name='text_html',
+            field=models.TextField(default='', editable=False),
+        ),
+        migrations.AddField(
+            model_name='reply',
+            name='text_html_version',
+            field=models.PositiveSmallIntegerField(default=0, editable=False),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('problems', '0006_rendered_html'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='problem',
+            index_together=set([('date_created', 'id'), ('resolved', 'date_created', 'id')]),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('problems', '0007_problem_list_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchTerm',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('term', models.CharField(max_length=40)),
+                ('weight', models.PositiveIntegerField()),
+                ('problem', models.ForeignKey(related_name='+', to='problems.Problem')),
+                ('reply', models.ForeignKey(null=True, default=None, related_name='+', to='problems.Reply')),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='searchterm',
+            index_together=set([('term', 'problem')]),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def count_tag_problems(apps, schema_editor):
+    ProblemTag = apps.get_model('problems', 'ProblemTag')
+    for tag in ProblemTag.objects.annotate(count=models.Count('problem')):
+        ProblemTag.objects.filter(pk=tag.pk).update(problem_count=tag.count)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('problems', '0008_searchterm'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='problemtag',
+            name='problem_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(count_tag_problems, migrations.RunPython.noop),
+    ]
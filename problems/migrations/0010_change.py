@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def seed_changes(apps, schema_editor):
+    '''
+    Put every existing problem and reply in the change feed once.
+    '''
+    Change = apps.get_model('problems', 'Change')
+    Problem = apps.get_model('problems', 'Problem')
+    Reply = apps.get_model('problems', 'Reply')
+
+    Change.objects.bulk_create(
+        Change(problem_id=pk) for pk in
+        Problem.objects.order_by('pk').values_list('pk', flat=True))
+    Change.objects.bulk_create(
+        Change(reply_id=pk) for pk in
+        Reply.objects.order_by('pk').values_list('pk', flat=True))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('problems', '0009_problemtag_problem_count'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Change',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('problem', models.ForeignKey(null=True, default=None, related_name='+', to='problems.Problem')),
+                ('reply', models.ForeignKey(null=True, default=None, related_name='+', to='problems.Reply')),
+            ],
+        ),
+        migrations.RunPython(seed_changes, migrations.RunPython.noop),
+    ]
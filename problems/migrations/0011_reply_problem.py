@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+#: The number of problem/reply links copied per query
+BATCH_SIZE = 1000
+
+
+def copy_links(apps, schema_editor):
+    '''
+    Copy each reply's link in problems_problem_responses onto its new
+    `problem` column, in batches of `BATCH_SIZE` links.
+    '''
+    Problem = apps.get_model('problems', 'Problem')
+    Reply = apps.get_model('problems', 'Reply')
+    Link = Problem.responses.through
+
+    last_pk = 0
+    while True:
+        links = list(Link.objects.filter(pk__gt=last_pk).order_by('pk')
+                     .values_list('pk', 'problem_id', 'reply_id')
+                     [:BATCH_SIZE])
+        if not links:
+            break
+
+        by_problem = {}
+        for _, problem_id, reply_id in links:
+            by_problem.setdefault(problem_id, []).append(reply_id)
+        for problem_id, reply_ids in by_problem.items():
+            Reply.objects.filter(pk__in=reply_ids).update(
+                problem_id=problem_id)
+
+        last_pk = links[-1][0]
+
+
+def restore_links(apps, schema_editor):
+    Problem = apps.get_model('problems', 'Problem')
+    Reply = apps.get_model('problems', 'Reply')
+    Link = Problem.responses.through
+
+    last_pk = 0
+    while True:
+        replies = list(Reply.objects.filter(pk__gt=last_pk,
+                                            problem__isnull=False)
+                       .order_by('pk').values_list('pk', 'problem_id')
+                       [:BATCH_SIZE])
+        if not replies:
+            break
+
+        Link.objects.bulk_create(
+            Link(problem_id=problem_id, reply_id=reply_id)
+            for reply_id, problem_id in replies)
+        last_pk = replies[-1][0]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('problems', '0010_change'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='reply',
+            name='problem',
+            field=models.ForeignKey(null=True, default=None, to='problems.Problem', db_index=False),
+        ),
+        migrations.AlterIndexTogether(
+            name='reply',
+            index_together=set([('problem', 'date')]),
+        ),
+        migrations.RunPython(copy_links, restore_links),
+    ]
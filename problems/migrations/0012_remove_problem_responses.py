@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('problems', '0011_reply_problem'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='problem',
+            name='responses',
+        ),
+    ]
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.conf import settings
+
+
+def summarize_replies(apps, schema_editor):
+    '''
+    Fill in the reply summary of every problem that has replies, 500
+    problems at a time.
+    '''
+    Problem = apps.get_model('problems', 'Problem')
+    Reply = apps.get_model('problems', 'Reply')
+
+    stats = list(Reply.objects.filter(problem__isnull=False)
+                 .values('problem')
+                 .annotate(count=models.Count('pk'), last=models.Max('pk'))
+                 .order_by('problem'))
+    for i in range(0, len(stats), 500):
+        batch = stats[i:i + 500]
+        last = Reply.objects.in_bulk([s['last'] for s in batch])
+        for s in batch:
+            reply = last[s['last']]
+            Problem.objects.filter(pk=s['problem']).update(
+                reply_count=s['count'], last_reply_at=reply.date,
+                last_reply_user=reply.user_id)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('problems', '0012_remove_problem_responses'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='problem',
+            name='last_reply_at',
+            field=models.DateTimeField(null=True, default=None, editable=False),
+        ),
+        migrations.AddField(
+            model_name='problem',
+            name='last_reply_user',
+            field=models.ForeignKey(null=True, default=None, editable=False, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='problem',
+            name='reply_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(summarize_replies, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.conf import settings
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('problems', '0013_reply_summary'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Occurrence',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('date', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='problem',
+            name='fingerprint',
+            field=models.CharField(max_length=64, unique=True, null=True, default=None, editable=False),
+        ),
+        migrations.AddField(
+            model_name='problem',
+            name='last_occurred',
+            field=models.DateTimeField(null=True, default=None, editable=False),
+        ),
+        migrations.AddField(
+            model_name='problem',
+            name='occurrence_count',
+            field=models.PositiveIntegerField(default=1, editable=False),
+        ),
+        migrations.AddField(
+            model_name='occurrence',
+            name='problem',
+            field=models.ForeignKey(related_name='occurrences', to='problems.Problem'),
+        ),
+        migrations.AddField(
+            model_name='occurrence',
+            name='user',
+            field=models.ForeignKey(null=True, default=None, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterIndexTogether(
+            name='occurrence',
+            index_together=set([('problem', 'date')]),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.conf import settings
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('problems', '0014_problem_fingerprint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RoutingRule',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('kind', models.CharField(max_length=10, default='keyword', choices=[('keyword', 'Keyword'), ('regex', 'Regular expression')])),
+                ('pattern', models.CharField(max_length=200)),
+                ('active', models.BooleanField(default=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('assignee', models.ForeignKey(blank=True, null=True, default=None, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('tag', models.ForeignKey(blank=True, null=True, default=None, related_name='+', to='problems.ProblemTag')),
+            ],
+        ),
+    ]
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def start_rollups(apps, schema_editor):
+    '''
+    Set the rollup of every problem to its own progress; there are no
+    dependencies yet.
+    '''
+    Problem = apps.get_model('problems', 'Problem')
+    Problem.objects.filter(resolved=True).update(rollup_progress=100)
+    Problem.objects.filter(resolved=False).update(
+        rollup_progress=models.F('percent_complete'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('problems', '0015_routingrule'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Dependency',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='problem',
+            name='rollup_count',
+            field=models.PositiveIntegerField(default=1, editable=False),
+        ),
+        migrations.AddField(
+            model_name='problem',
+            name='rollup_progress',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='dependency',
+            name='child',
+            field=models.ForeignKey(related_name='+', to='problems.Problem', db_index=False),
+        ),
+        migrations.AddField(
+            model_name='dependency',
+            name='parent',
+            field=models.ForeignKey(related_name='+', to='problems.Problem'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='dependency',
+            unique_together=set([('parent', 'child')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='dependency',
+            index_together=set([('child', 'parent')]),
+        ),
+        migrations.RunPython(start_rollups, migrations.RunPython.noop),
+    ]
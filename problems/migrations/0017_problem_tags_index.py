@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+INDEX = 'problems_problem_tags_problemtag_id_problem_id'
+
+
+def add_index(apps, schema_editor):
+    '''
+    Index the problems of each tag in ID order, so that paging through a
+    tag's problems seeks into the index instead of sorting all of them.
+
+    The table is the one Django creates for `Problem.tags`; giving the
+    field an explicit through model instead would take away its add()
+    and remove() on this version of Django.
+    '''
+    table = apps.get_model('problems', 'Problem').tags.through._meta.db_table
+    schema_editor.execute(schema_editor.sql_create_index % {
+        'name': schema_editor.quote_name(INDEX),
+        'table': schema_editor.quote_name(table),
+        'columns': '%s, %s' % (schema_editor.quote_name('problemtag_id'),
+                               schema_editor.quote_name('problem_id')),
+        'extra': '',
+    })
+
+
+def remove_index(apps, schema_editor):
+    table = apps.get_model('problems', 'Problem').tags.through._meta.db_table
+    schema_editor.execute(schema_editor.sql_delete_index % {
+        'name': schema_editor.quote_name(INDEX),
+        'table': schema_editor.quote_name(table),
+    })
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('problems', '0016_dependency'),
+    ]
+
+    operations = [
+        migrations.RunPython(add_index, remove_index),
+    ]
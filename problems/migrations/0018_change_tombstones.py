@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('problems', '0017_problem_tags_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='change',
+            name='deleted_problem',
+            field=models.IntegerField(null=True, default=None),
+        ),
+        migrations.AddField(
+            model_name='change',
+            name='deleted_reply',
+            field=models.IntegerField(null=True, default=None),
+        ),
+    ]
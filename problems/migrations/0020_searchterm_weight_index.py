@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('problems', '0019_dependencygraphlock'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='searchterm',
+            index_together=set([('term', 'weight'), ('term', 'problem')]),
+        ),
+    ]
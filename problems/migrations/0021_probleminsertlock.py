@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def create_lock(apps, schema_editor):
+    '''
+    Create the lock row up front, so that the first bulk insert does
+    not have to.
+    '''
+    apps.get_model('problems', 'ProblemInsertLock').objects.create(pk=1)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('problems', '0020_searchterm_weight_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProblemInsertLock',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+            ],
+        ),
+        migrations.RunPython(create_lock, migrations.RunPython.noop),
+    ]
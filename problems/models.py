@@ -1,14 +1,30 @@
+import re
 import datetime
-from django.db import models
+import threading
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, connection, models, transaction
+from django.db.models import Case, F, Q, Value, When
+from django.db.models.signals import m2m_changed, post_delete, pre_delete
+from django.dispatch import receiver
+from django.utils import timezone
 from django.contrib.auth.models import User
 
-import bleach
-import markdown
+from problems.render import RENDER_VERSION, render_markdown
+from problems.routing import Router
+from problems.search import (MAX_CANDIDATES, MAX_COUNTED_TERMS, TITLE_WEIGHT,
+                             term_weights, tokenize)
+from webhooks import events
+import webhooks.models
 
 
 class Problem(models.Model):
     title = models.CharField(max_length=80)
     description = models.TextField()
+    #: Sanitized HTML rendered from `description`
+    description_html = models.TextField(default='', editable=False)
+    #: The `RENDER_VERSION` that produced `description_html`
+    description_html_version = models.PositiveSmallIntegerField(
+        default=0, editable=False)
 
     #: Was the user logged in when submitting the problem
     userauthed = models.BooleanField(default=False)
@@ -26,32 +42,576 @@ class Problem(models.Model):
     assigned_to = models.ManyToManyField(User, default=None, related_name='+')
     percent_complete = models.PositiveSmallIntegerField(default=0)
 
+    #: Indexed on (problemtag, problem) by migration 0017 for paging
     tags = models.ManyToManyField('ProblemTag')
 
-    responses = models.ManyToManyField('Reply')
+    #: The number of replies, maintained by `add_response`
+    reply_count = models.PositiveIntegerField(default=0, editable=False)
+    #: The date of the newest reply, maintained by `add_response`
+    last_reply_at = models.DateTimeField(default=None, null=True,
+                                         editable=False)
+    #: The author of the newest reply, maintained by `add_response`
+    last_reply_user = models.ForeignKey(User, default=None, null=True,
+                                        related_name='+', editable=False)
+
+    #: The `fingerprint_hash` of the fingerprint the problem was
+    #: reported with, so that repeat reports count as occurrences
+    fingerprint = models.CharField(max_length=64, default=None, null=True,
+                                   unique=True, editable=False)
+    #: The number of times the problem has been reported
+    occurrence_count = models.PositiveIntegerField(default=1,
+                                                   editable=False)
+    #: When the problem was last reported again, if it has been
+    last_occurred = models.DateTimeField(default=None, null=True,
+                                         editable=False)
+
+    #: The sum of the `progress` of this problem and of every problem
+    #: it depends on, directly or not, once for every path to it
+    rollup_progress = models.PositiveIntegerField(default=0, editable=False)
+    #: The number of problems summed in `rollup_progress`, at most
+    #: `ROLLUP_COUNT_MAX`
+    rollup_count = models.PositiveIntegerField(default=1, editable=False)
+
+    #: Fields that are only written with queryset updates, so that
+    #: saving a stale instance cannot overwrite them
+    SUMMARY_FIELDS = ('reply_count', 'last_reply_at', 'last_reply_user',
+                      'occurrence_count', 'last_occurred',
+                      'rollup_progress', 'rollup_count')
+
+    class Meta:
+        index_together = [
+            ('date_created', 'id'),
+            ('resolved', 'date_created', 'id'),
+        ]
 
     def replies(self):
-        return self.responses.all().order_by('date')
+        # Not self.reply_set, which assigns this problem to every reply
+        # it loads through the relation descriptor
+        return Reply.objects.filter(problem=self).order_by('date')
 
     def add_response(self, response):
         '''
         Add the response, update last_updated, and save.
+
+        The response is saved as well; it need not have been saved
+        before.
         '''
-        self.last_updated = datetime.datetime.now()
-        self.responses.add(response)
-        self.last_update_user = response.user
-        self.save()
+        with transaction.atomic():
+            self.last_updated = datetime.datetime.now()
+            response.problem = self
+            response.save()
+            self.last_update_user = response.user
+
+            Problem.objects.filter(pk=self.pk).update(
+                reply_count=F('reply_count') + 1,
+                last_reply_at=response.date,
+                last_reply_user=response.user)
+            self.reply_count += 1
+            self.last_reply_at = response.date
+            self.last_reply_user = response.user
+
+            self.save()
+            SearchTerm.index_reply(self, response)
+            events.emit(webhooks.models.REPLY_ADDED,
+                        {'problem': self.pk, 'reply': response.serialize()})
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._rendered_source = instance.__dict__.get('description')
+        instance._indexed_source = (instance.__dict__.get('title'),
+                                    instance.__dict__.get('description'))
+        instance._saved_resolved = instance.__dict__.get('resolved')
+        if 'resolved' in instance.__dict__:
+            instance._saved_progress = instance.progress()
+        return instance
+
+    def save(self, *args, **kwargs):
+        if (self.description_html_version != RENDER_VERSION or
+                getattr(self, '_rendered_source', None) != self.description):
+            self.render_description()
+
+        created = self.pk is None
+        adding = self._state.adding
+        resolved = (self.resolved and
+                    not getattr(self, '_saved_resolved', False))
+        progress = self.progress()
+        if adding:
+            self.rollup_progress = progress
+
+        if not self._state.adding and 'update_fields' not in kwargs:
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and
+                field.name not in self.SUMMARY_FIELDS]
+
+        with transaction.atomic():
+            change = 0
+            if not adding and progress != getattr(self, '_saved_progress',
+                                                  None):
+                # Measure the change against the stored row, which may be
+                # newer than this instance
+                saved = (Problem.objects.select_for_update()
+                         .filter(pk=self.pk)
+                         .values_list('percent_complete', 'resolved').first())
+                if saved is not None:
+                    change = progress - (100 if saved[1] else saved[0])
+
+            super().save(*args, **kwargs)
+            if change:
+                add_to_rollups(self.pk, change, 0)
+                self.rollup_progress += change
+
+            if getattr(self, '_indexed_source', None) != (self.title,
+                                                          self.description):
+                SearchTerm.index_problem(self)
+
+            Change.record(problem=self)
+            if created:
+                events.emit(webhooks.models.PROBLEM_CREATED,
+                            self.serialize())
+            if resolved:
+                events.emit(webhooks.models.PROBLEM_RESOLVED,
+                            self.serialize())
+        self._saved_resolved = self.resolved
+        self._saved_progress = progress
+
+    def progress(self):
+        '''
+        Return how complete this problem is by itself, in percent.
+        '''
+        return 100 if self.resolved else self.percent_complete
+
+    @property
+    def rollup_completion(self):
+        '''
+        The mean of the `progress` of this problem and of everything it
+        depends on, from the rollup fields. A problem reached by several
+        paths counts once for each path, so this is weighted towards
+        shared dependencies and is not the share of distinct problems
+        complete.
+        '''
+        return int(round(self.rollup_progress / max(self.rollup_count, 1)))
+
+    def add_dependency(self, child):
+        '''
+        Make this problem depend on `child`, adding the rollup of
+        `child` to this problem and everything that depends on it.
+
+        :raises DependencyCycle: if `child` already depends on this
+          problem, directly or not, or is this problem.
+        :raises DependencyTooDeep: if the graph would have a chain of
+          more than `DEPENDENCY_MAX_DEPTH` links.
+        :raises RollupOverflow: if a problem depending on this one would
+          count more than `ROLLUP_COUNT_MAX` problems in its rollup.
+        '''
+        with transaction.atomic():
+            # Two links can close a cycle together without sharing a
+            # problem, so every change to the graph takes the graph lock;
+            # lock both rows too, against concurrent progress updates
+            DependencyGraphLock.acquire()
+            locked = Problem.objects.select_for_update().in_bulk(
+                [self.pk, child.pk])
+            if child.pk == self.pk:
+                raise DependencyCycle('%i depends on itself' % self.pk)
+
+            # The walks stop past the depth limit, so that they make a
+            # bounded number of queries
+            depth = 1
+            for level in Dependency.levels(child.pk):
+                if self.pk in level:
+                    raise DependencyCycle('%i depends on %i' % (child.pk,
+                                                                self.pk))
+                depth += 1
+                if depth > DEPENDENCY_MAX_DEPTH:
+                    break
+            if depth <= DEPENDENCY_MAX_DEPTH:
+                for level in Dependency.levels(self.pk, up=True):
+                    depth += 1
+                    if depth > DEPENDENCY_MAX_DEPTH:
+                        break
+            if depth > DEPENDENCY_MAX_DEPTH:
+                raise DependencyTooDeep('Over %i links in a chain'
+                                        % DEPENDENCY_MAX_DEPTH)
+
+            dependency, created = Dependency.objects.get_or_create(
+                parent=self, child=child)
+            if created:
+                child = locked[child.pk]
+                add_to_rollups(self.pk, child.rollup_progress,
+                               child.rollup_count)
+                self.rollup_progress += child.rollup_progress
+                self.rollup_count += child.rollup_count
+
+    def remove_dependency(self, child):
+        '''
+        Stop this problem depending on `child`, taking the rollup of
+        `child` back out of this problem and everything that depends on
+        it.
+        '''
+        with transaction.atomic():
+            DependencyGraphLock.acquire()
+            locked = Problem.objects.select_for_update().in_bulk(
+                [self.pk, child.pk])
+            links = Dependency.objects.filter(parent=self, child=child)
+            if not links.exists():
+                return
+            links.delete()
+
+            child = locked[child.pk]
+            add_to_rollups(self.pk, -child.rollup_progress,
+                           -child.rollup_count)
+            self.rollup_progress -= child.rollup_progress
+            self.rollup_count -= child.rollup_count
+
+    def subtree(self, depth=5, limit=1000):
+        '''
+        Return this problem and the problems it depends on, down to
+        `depth` levels and at most `limit` links, in one query per level.
+
+        :returns: a list of serialized problems, this one first, each
+          with the IDs of the problems it depends on in `children`. A
+          problem whose dependencies were not loaded has `truncated`
+          set instead.
+        '''
+        problems = [self]
+        children = {}
+        frontier = [self.pk]
+        seen = {self.pk}
+        links = 0
+        for level in range(depth):
+            if not frontier:
+                break
+            dependencies = list(
+                Dependency.objects.filter(parent__in=frontier)
+                .select_related('child')
+                .order_by('parent', 'child')[:limit - links + 1])
+            if len(dependencies) > limit - links:
+                break
+            links += len(dependencies)
+
+            for pk in frontier:
+                children[pk] = []
+            frontier = []
+            for dependency in dependencies:
+                children[dependency.parent_id].append(dependency.child_id)
+                if dependency.child_id not in seen:
+                    seen.add(dependency.child_id)
+                    problems.append(dependency.child)
+                    frontier.append(dependency.child_id)
+
+        nodes = []
+        for problem in problems:
+            node = problem.serialize()
+            if problem.pk in children:
+                node['children'] = children[problem.pk]
+            else:
+                # Only problems with dependencies count more than one
+                node['truncated'] = problem.rollup_count > 1
+            nodes.append(node)
+        return nodes
+
+    def render_description(self):
+        '''
+        Render `description` into `description_html` without saving.
+        '''
+        self.description_html = render_markdown(self.description)
+        self.description_html_version = RENDER_VERSION
+        self._rendered_source = self.description
 
     def markdown_description(self):
-        return bleach.clean(markdown.markdown(self.description),
-                            tags=bleach.ALLOWED_TAGS + ['p'])
+        '''
+        Return the stored HTML for the description, re-rendering and
+        storing it first if it was produced by an older renderer.
+        '''
+        if getattr(self, '_rendered_source', None) != self.description:
+            # Unsaved edit; render it but leave the stored HTML alone
+            self.render_description()
+        elif self.description_html_version != RENDER_VERSION:
+            self.render_description()
+            if self.pk is not None:
+                Problem.objects.filter(pk=self.pk).update(
+                    description_html=self.description_html,
+                    description_html_version=self.description_html_version)
+        return self.description_html
+
+    def serialize(self):
+        return {
+            'id': self.pk,
+            'title': self.title,
+            'date_created': self.date_created.isoformat(),
+            'resolved': self.resolved,
+            'percent_complete': self.percent_complete,
+            'reply_count': self.reply_count,
+            'last_reply_at': (self.last_reply_at and
+                              self.last_reply_at.isoformat()),
+            'occurrences': self.occurrence_count,
+            'rollup_completion': self.rollup_completion
+        }
 
     def __str__(self):
         return '%i: %s' % (self.pk, self.title)
 
 
+class DependencyCycle(Exception):
+    '''
+    Raised when a dependency would make a problem depend on itself.
+    '''
+
+
+class RollupOverflow(Exception):
+    '''
+    Raised when a dependency would make a problem count more than
+    `ROLLUP_COUNT_MAX` problems in its rollup.
+    '''
+
+
+class DependencyTooDeep(Exception):
+    '''
+    Raised when a dependency would make a chain of more than
+    `DEPENDENCY_MAX_DEPTH` links.
+    '''
+
+
+#: The most problems a rollup may count. Problems reached by several
+#: paths are counted once for each, so the count can grow exponentially
+#: with the depth of a graph of overlapping diamonds; the limit keeps
+#: `rollup_progress`, up to 100 per problem counted, within the 32-bit
+#: columns of PostgreSQL and MySQL.
+ROLLUP_COUNT_MAX = (2 ** 31 - 1) // 100
+
+#: The most links in a chain of dependencies. Checking and updating the
+#: graph takes a query for each level, so this bounds their number.
+DEPENDENCY_MAX_DEPTH = 10
+
+
+class Dependency(models.Model):
+    '''
+    A link in the dependency graph: `parent` is not complete until
+    `child` is. The graph is kept acyclic by `Problem.add_dependency`,
+    which along with `Problem.remove_dependency` also maintains the
+    rollups; links should not be created or deleted any other way.
+    '''
+    parent = models.ForeignKey(Problem, related_name='+')
+    # Indexed by the (child, parent) index below
+    child = models.ForeignKey(Problem, related_name='+', db_index=False)
+
+    class Meta:
+        unique_together = [('parent', 'child')]
+        index_together = [('child', 'parent')]
+
+    @classmethod
+    def levels(cls, pk, up=False):
+        '''
+        Yield the IDs of the problems that the problem with ID `pk`
+        depends on through exactly one link, then through two links and
+        so on, as sets, in one query per level. With `up`, yield the
+        problems that depend on it instead.
+
+        In an acyclic graph there is a level for every link in the
+        longest chain from the problem.
+        '''
+        near, far = ('child', 'parent') if up else ('parent', 'child')
+        level = {pk}
+        while True:
+            level = set(cls.objects.filter(**{near + '__in': level})
+                        .values_list(far, flat=True))
+            if not level:
+                return
+            yield level
+
+    def __str__(self):
+        return '%i depends on %i' % (self.parent_id, self.child_id)
+
+
+class DependencyGraphLock(models.Model):
+    '''
+    A single row that every change to the dependency graph locks until
+    its transaction ends, so that the changes are made one at a time.
+    '''
+
+    @classmethod
+    def acquire(cls):
+        cls.objects.select_for_update().get_or_create(pk=1)
+
+
+class ProblemInsertLock(models.Model):
+    '''
+    A single row that every bulk insert of problems locks until its
+    transaction ends, so that the primary keys of each batch can be
+    read back.
+    '''
+
+    @classmethod
+    def acquire(cls):
+        cls.objects.select_for_update().get_or_create(pk=1)
+
+
+def add_to_rollups(problemid, progress, count):
+    '''
+    Add `progress` and `count` to the rollup fields of a problem and,
+    once for every path to it, of every problem depending on it. This
+    only reads the links above the problem, with two queries per level.
+
+    :raises RollupOverflow: if a rollup would count more than
+      `ROLLUP_COUNT_MAX` problems; some rollups may already have been
+      changed, so the caller's transaction must be rolled back.
+    '''
+    paths = {problemid: 1}
+    changed = set()
+    while paths:
+        # One update for the whole level, adding to each problem as many
+        # times as there are paths to it
+        by_paths = {}
+        for pk, number in paths.items():
+            by_paths.setdefault(number, []).append(pk)
+        rollups = Q()
+        progress_cases = []
+        count_cases = []
+        for number, pks in by_paths.items():
+            within = Q(pk__in=pks)
+            if count > 0:
+                if count * number > ROLLUP_COUNT_MAX:
+                    raise RollupOverflow('Over %i problems in a rollup'
+                                         % ROLLUP_COUNT_MAX)
+                within &= Q(rollup_count__lte=ROLLUP_COUNT_MAX -
+                            count * number)
+            rollups |= within
+            progress_cases.append(When(pk__in=pks,
+                                       then=Value(progress * number)))
+            count_cases.append(When(pk__in=pks, then=Value(count * number)))
+        updated = Problem.objects.filter(rollups).update(
+            rollup_progress=F('rollup_progress') + Case(
+                *progress_cases, default=Value(0),
+                output_field=models.IntegerField()),
+            rollup_count=F('rollup_count') + Case(
+                *count_cases, default=Value(0),
+                output_field=models.IntegerField()))
+        if count > 0 and updated < len(paths):
+            raise RollupOverflow('Over %i problems in a rollup'
+                                 % ROLLUP_COUNT_MAX)
+        changed.update(paths)
+
+        parents = {}
+        for parent, child in (Dependency.objects.filter(child__in=paths)
+                              .values_list('parent', 'child')):
+            parents[parent] = parents.get(parent, 0) + paths[child]
+        paths = parents
+
+    # The rolled up values are part of the problems' representations
+    Change.objects.filter(problem__in=changed, reply=None).delete()
+    Change.objects.bulk_create(Change(problem_id=pk) for pk in changed)
+
+
+class SearchTerm(models.Model):
+    '''
+    One entry of the inverted index used for searching problems: the
+    weight of `term` in the title and description of `problem`, or in
+    `reply` to it.
+    '''
+    term = models.CharField(max_length=40)
+    problem = models.ForeignKey(Problem, related_name='+')
+    #: The reply the term occurs in, or None for the problem itself
+    reply = models.ForeignKey('Reply', null=True, default=None,
+                              related_name='+')
+    weight = models.PositiveIntegerField()
+
+    class Meta:
+        index_together = [('term', 'problem'), ('term', 'weight')]
+
+    @classmethod
+    def index_problem(cls, problem):
+        '''
+        Replace the index entries for the title and description of
+        `problem`. Entries for its replies are left alone.
+        '''
+        cls.objects.filter(problem=problem, reply=None).delete()
+        cls.index_new_problems([problem])
+
+    @classmethod
+    def index_new_problems(cls, problems):
+        '''
+        Add index entries for the titles and descriptions of saved
+        `problems` that have not been indexed before.
+        '''
+        entries = []
+        for problem in problems:
+            weights = term_weights(problem.title, TITLE_WEIGHT)
+            weights.update(term_weights(problem.description))
+            entries.extend(cls(term=term, problem=problem, weight=weight)
+                           for term, weight in weights.items())
+            problem._indexed_source = (problem.title, problem.description)
+        cls.objects.bulk_create(entries)
+
+    @classmethod
+    def index_reply(cls, problem, reply):
+        '''
+        Add index entries for a new `reply` to `problem`.
+        '''
+        cls.objects.bulk_create(
+            cls(term=term, problem=problem, reply=reply, weight=weight)
+            for term, weight in term_weights(reply.text).items())
+
+    @classmethod
+    def term_counts(cls, terms, limit=MAX_CANDIDATES):
+        '''
+        Count the index entries of each of `terms`, stopping at `limit`
+        so that common terms cost no more than rare ones.
+
+        :returns: a dict mapping each term to its count.
+        '''
+        select = ('SELECT %s, COUNT(*) FROM (SELECT 1 FROM {} WHERE {} = %s '
+                  'LIMIT %s) entries').format(
+            connection.ops.quote_name(cls._meta.db_table),
+            connection.ops.quote_name(cls._meta.get_field('term').column))
+        params = []
+        for term in terms:
+            params.extend([term, term, limit])
+        with connection.cursor() as cursor:
+            cursor.execute(' UNION ALL '.join([select] * len(terms)), params)
+            return dict(cursor.fetchall())
+
+    @classmethod
+    def search(cls, query, offset=0, limit=20):
+        '''
+        Find the problems whose title, description or replies contain
+        every term in `query`, best matches first.
+
+        Only the problems with the `MAX_CANDIDATES` heaviest index
+        entries for the query's rarest term are scored, so the results
+        are exact unless every term is that common.
+
+        :returns: a list of `(problem, score)` tuples.
+        '''
+        terms = set(tokenize(query))
+        if not terms:
+            return []
+
+        if len(terms) == 1:
+            rarest, = terms
+        else:
+            counts = cls.term_counts(sorted(terms)[:MAX_COUNTED_TERMS],
+                                     MAX_CANDIDATES)
+            rarest = min(counts, key=counts.get)
+        candidates = (cls.objects.filter(term=rarest).order_by('-weight')
+                      .values('problem')[:MAX_CANDIDATES])
+
+        matches = (cls.objects.filter(term__in=terms, problem__in=candidates)
+                   .values('problem')
+                   .annotate(score=models.Sum('weight'),
+                             matched=models.Count('term', distinct=True))
+                   .filter(matched=len(terms))
+                   .order_by('-score', '-problem'))[offset:offset + limit]
+        matches = list(matches)
+
+        problems = Problem.objects.in_bulk([m['problem'] for m in matches])
+        return [(problems[m['problem']], m['score']) for m in matches]
+
+
 class ProblemTag(models.Model):
     name = models.CharField(max_length=30, unique=True)
+    #: The number of problems with this tag, maintained as tags change
+    problem_count = models.PositiveIntegerField(default=0, editable=False)
 
     @classmethod
     def get_or_create(cls, name):
@@ -62,21 +622,104 @@ class ProblemTag(models.Model):
             newtag.save()
             return newtag
 
+    @classmethod
+    def get_or_create_many(cls, names):
+        '''
+        Like `get_or_create`, for many names at once.
+
+        :returns: a dict mapping each name to its tag.
+        '''
+        names = set(names)
+        tags = {tag.name: tag for tag in cls.objects.filter(name__in=names)}
+        missing = names - set(tags)
+        if missing:
+            try:
+                with transaction.atomic():
+                    cls.objects.bulk_create(cls(name=name)
+                                            for name in missing)
+            except IntegrityError:
+                # A concurrent request created some of them first
+                for name in missing:
+                    try:
+                        with transaction.atomic():
+                            cls.objects.create(name=name)
+                    except IntegrityError:
+                        pass
+            tags.update((tag.name, tag) for tag in
+                        cls.objects.filter(name__in=missing))
+        return tags
+
+    def serialize(self):
+        return {
+            'id': self.pk,
+            'name': self.name,
+            'problems': self.problem_count
+        }
+
     def __str__(self):
         return self.name
 
 
 class Reply(models.Model):
+    # Indexed by the (problem, date) index below
+    problem = models.ForeignKey(Problem, null=True, default=None,
+                                db_index=False)
     date = models.DateTimeField(auto_now_add=True)
     text = models.TextField()
     user = models.ForeignKey(User)
 
+    #: Sanitized HTML rendered from `text`
+    text_html = models.TextField(default='', editable=False)
+    #: The `RENDER_VERSION` that produced `text_html`
+    text_html_version = models.PositiveSmallIntegerField(
+        default=0, editable=False)
+
+    class Meta:
+        index_together = [('problem', 'date')]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._rendered_source = instance.__dict__.get('text')
+        return instance
+
+    def save(self, *args, **kwargs):
+        if (self.text_html_version != RENDER_VERSION or
+                getattr(self, '_rendered_source', None) != self.text):
+            self.render_text()
+
+        edited = self.pk is not None
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            Change.record(reply=self)
+            if edited and self.problem_id is not None:
+                # The problem's page shows its replies
+                Change.record(problem=Problem(pk=self.problem_id))
+
+    def render_text(self):
+        '''
+        Render `text` into `text_html` without saving.
+        '''
+        self.text_html = render_markdown(self.text)
+        self.text_html_version = RENDER_VERSION
+        self._rendered_source = self.text
+
     def format(self):
         '''
-        Return HTML-formatted markdown with dangerous tags removed.
+        Return HTML-formatted markdown with dangerous tags removed,
+        re-rendering and storing it first if it was produced by an
+        older renderer.
         '''
-        return bleach.clean(markdown.markdown(self.text),
-                            tags=bleach.ALLOWED_TAGS + ['p'])
+        if getattr(self, '_rendered_source', None) != self.text:
+            # Unsaved edit; render it but leave the stored HTML alone
+            self.render_text()
+        elif self.text_html_version != RENDER_VERSION:
+            self.render_text()
+            if self.pk is not None:
+                Reply.objects.filter(pk=self.pk).update(
+                    text_html=self.text_html,
+                    text_html_version=self.text_html_version)
+        return self.text_html
 
     def serialize(self):
         # TODO: Should we return the raw text which might contain
@@ -85,8 +728,241 @@ class Reply(models.Model):
             'id': self.pk,
             'date': self.date.isoformat(),
             'text': self.text,
-            'userid': self.user.pk
+            'userid': self.user_id
         }
 
     def __str__(self):
-        return 'Reply %i on %s' % (self.pk, self.date.isoformat())
\ No newline at end of file
+        return 'Reply %i on %s' % (self.pk, self.date.isoformat())
+
+
+class Occurrence(models.Model):
+    '''
+    A repeat report of a fingerprinted problem.
+    '''
+    problem = models.ForeignKey(Problem, related_name='occurrences')
+    date = models.DateTimeField(auto_now_add=True)
+    user = models.ForeignKey(User, null=True, default=None, related_name='+')
+
+    class Meta:
+        index_together = [('problem', 'date')]
+
+    def __str__(self):
+        return 'Occurrence of %i on %s' % (self.problem_id,
+                                           self.date.isoformat())
+
+
+class RoutingRuleQuerySet(models.QuerySet):
+    def update(self, **kwargs):
+        # Mark the rules changed, as saving them does, so that routers
+        # compiled from them are replaced
+        kwargs.setdefault('updated', timezone.now())
+        return super().update(**kwargs)
+
+
+class RoutingRule(models.Model):
+    '''
+    Tag new problems whose title or description matches `pattern` with
+    `tag`, and assign them to `assignee`.
+    '''
+    KEYWORD = 'keyword'
+    REGEX = 'regex'
+    KINDS = ((KEYWORD, 'Keyword'), (REGEX, 'Regular expression'))
+
+    kind = models.CharField(max_length=10, choices=KINDS, default=KEYWORD)
+    #: A word or phrase for keyword rules, or a regular expression;
+    #: both ignore case
+    pattern = models.CharField(max_length=200)
+    tag = models.ForeignKey(ProblemTag, null=True, blank=True, default=None,
+                            related_name='+')
+    assignee = models.ForeignKey(User, null=True, blank=True, default=None,
+                                 related_name='+')
+    active = models.BooleanField(default=True)
+    #: Changes whenever the rule is saved or updated, so routers know to
+    #: recompile
+    updated = models.DateTimeField(auto_now=True)
+
+    objects = RoutingRuleQuerySet.as_manager()
+
+    def clean(self):
+        if self.tag_id is None and self.assignee_id is None:
+            raise ValidationError('A rule needs a tag or an assignee.')
+        if self.kind == self.REGEX:
+            try:
+                re.compile(self.pattern)
+            except re.error as e:
+                raise ValidationError(
+                    {'pattern': 'Invalid regular expression: %s' % e})
+
+    @classmethod
+    def router(cls):
+        '''
+        Return the `problems.routing.Router` of the active rules, whose
+        values are `(tag ID, assignee ID)` tuples with None for what a
+        rule does not set. Tags are routed by ID, so renaming one does
+        not invalidate the router.
+
+        The router is compiled again only when the rules have changed,
+        which costs one query to find out.
+        '''
+        stats = cls.objects.aggregate(count=models.Count('pk'),
+                                      updated=models.Max('updated'))
+        version = (stats['count'], stats['updated'])
+        with _router_lock:
+            if _router['version'] != version:
+                keywords = []
+                regexes = []
+                for rule in cls.objects.filter(active=True):
+                    value = (rule.tag_id, rule.assignee_id)
+                    if rule.kind == cls.REGEX:
+                        regexes.append((rule.pattern, value))
+                    else:
+                        keywords.append((rule.pattern, value))
+                _router['router'] = Router(keywords, regexes)
+                _router['version'] = version
+            return _router['router']
+
+    def __str__(self):
+        return '%s %r' % (self.get_kind_display(), self.pattern)
+
+
+#: The router compiled by `RoutingRule.router` and the rules it is for
+_router = {'version': None, 'router': None}
+_router_lock = threading.Lock()
+
+
+class Change(models.Model):
+    '''
+    The change feed: the primary key of each row is a monotonically
+    increasing sequence number, and every problem or reply that has
+    been created or changed has exactly one row, which is replaced with
+    a new, higher-numbered row each time it changes again. The rows of
+    a deleted object go with it, and a tombstone row holding its ID is
+    added instead.
+
+    Reading the rows above a sequence number therefore yields each
+    object changed or deleted since then once, in O(changes).
+    '''
+    problem = models.ForeignKey(Problem, null=True, default=None,
+                                related_name='+')
+    reply = models.ForeignKey(Reply, null=True, default=None,
+                              related_name='+')
+    #: The ID of the deleted problem, in a tombstone row
+    deleted_problem = models.IntegerField(null=True, default=None)
+    #: The ID of the deleted reply, in a tombstone row
+    deleted_reply = models.IntegerField(null=True, default=None)
+
+    @classmethod
+    def record(cls, problem=None, reply=None):
+        '''
+        Move `problem` or `reply` to the head of the change feed.
+        '''
+        cls.objects.filter(problem=problem, reply=reply).delete()
+        cls.objects.create(problem=problem, reply=reply)
+
+    @classmethod
+    def since(cls, seq, limit=500):
+        '''
+        Return the problems and replies changed or deleted after
+        sequence number `seq`, at most `limit` of them in total.
+
+        Sequence numbers come from an autoincrement key, which only
+        SQLite hands out in commit order. On other backends a
+        transaction can commit a row below a number that a reader has
+        already gone past, and that reader then skips the row.
+
+        :returns: a `(problems, replies, deleted, last_seq, more)` tuple,
+          where `deleted` is a `(problem_ids, reply_ids)` tuple of the
+          deleted objects, `last_seq` is the sequence number to pass
+          next time and `more` tells whether further changes are
+          waiting.
+        '''
+        changes = list(cls.objects.filter(pk__gt=seq).order_by('pk')
+                       .values_list('pk', 'problem', 'reply',
+                                    'deleted_problem', 'deleted_reply')
+                       [:limit + 1])
+        more = len(changes) > limit
+        changes = changes[:limit]
+
+        problem_ids = [change[1] for change in changes if change[1]]
+        reply_ids = [change[2] for change in changes if change[2]]
+        problems = Problem.objects.in_bulk(problem_ids)
+        replies = Reply.objects.in_bulk(reply_ids)
+        deleted = ([change[3] for change in changes if change[3]],
+                   [change[4] for change in changes if change[4]])
+
+        last_seq = changes[-1][0] if changes else seq
+        return ([problems[pk] for pk in problem_ids if pk in problems],
+                [replies[pk] for pk in reply_ids if pk in replies],
+                deleted, last_seq, more)
+
+
+@receiver(m2m_changed, sender=Problem.tags.through)
+def update_tag_counts(sender, instance, action, reverse, pk_set, **kwargs):
+    '''
+    Keep `ProblemTag.problem_count` in step with links that are added,
+    from either side of the relation, or about to be removed, and emit
+    a webhook event for each of those links.
+    '''
+    if action == 'post_add':
+        sign = 1
+    elif action in ('pre_remove', 'pre_clear'):
+        sign = -1
+    else:
+        return
+
+    if reverse:
+        links = sender.objects.filter(problemtag=instance)
+        if pk_set is not None:
+            links = links.filter(problem__in=pk_set)
+    else:
+        links = sender.objects.filter(problem=instance)
+        if pk_set is not None:
+            links = links.filter(problemtag__in=pk_set)
+
+    counts = links.values('problemtag').annotate(count=models.Count('pk'))
+    for row in counts:
+        ProblemTag.objects.filter(pk=row['problemtag']).update(
+            problem_count=F('problem_count') + sign * row['count'])
+
+    changed = list(links.values_list('problem', 'problemtag__name'))
+    events.emit_many(webhooks.models.PROBLEM_TAGS_CHANGED, (
+        {'problem': problem, 'tag': name,
+         'action': 'added' if sign > 0 else 'removed'}
+        for problem, name in changed
+    ))
+    for problemid in set(problem for problem, name in changed):
+        Change.record(problem=Problem(pk=problemid))
+
+
+@receiver(m2m_changed, sender=Problem.assigned_to.through)
+def record_assignment(sender, instance, action, reverse, pk_set, **kwargs):
+    '''
+    Move a problem to the head of the change feed when its assignees
+    change, since its page shows them.
+    '''
+    if action not in ('post_add', 'post_remove', 'post_clear') or reverse:
+        return
+    Change.record(problem=instance)
+
+
+@receiver(pre_delete, sender=Problem)
+def remove_deleted_problem_tags(sender, instance, **kwargs):
+    instance.tags.clear()
+
+
+@receiver(pre_delete, sender=Problem)
+def remove_deleted_problem_dependencies(sender, instance, **kwargs):
+    for parent in Problem.objects.filter(
+            pk__in=Dependency.objects.filter(child=instance)
+            .values('parent')):
+        parent.remove_dependency(instance)
+
+
+@receiver(post_delete, sender=Problem)
+def record_problem_deletion(sender, instance, **kwargs):
+    Change.objects.create(deleted_problem=instance.pk)
+
+
+@receiver(post_delete, sender=Reply)
+def record_reply_deletion(sender, instance, **kwargs):
+    Change.objects.create(deleted_reply=instance.pk)
@@ -0,0 +1,24 @@
+import bleach
+import markdown
+
+from gravel.metrics import MARKDOWN_RENDER
+
+
+#: Bump this whenever the rendering pipeline or the sanitization
+#: policy changes; stored HTML with an older version is re-rendered
+#: the next time it is read.
+RENDER_VERSION = 1
+
+#: The tags that survive sanitization of rendered markdown.
+ALLOWED_TAGS = list(bleach.ALLOWED_TAGS) + ['p']
+
+
+def render_markdown(text):
+    '''
+    Return HTML-formatted markdown with dangerous tags removed.
+
+    :param str text: The markdown source text.
+    :returns: a sanitized HTML string.
+    '''
+    with MARKDOWN_RENDER.time():
+        return bleach.clean(markdown.markdown(text), tags=ALLOWED_TAGS)
@@ -0,0 +1,145 @@
+'''
+Matching of routing rules against the text of problems.
+
+Keyword rules are compiled together into one Aho-Corasick automaton,
+which finds every keyword in a text in a single pass, in time linear in
+the length of the text and the number of matches however many keywords
+there are. Keywords match whole words, ignoring case.
+
+Regular expressions cannot be merged into an automaton without losing
+overlapping matches, so each regex rule is searched for on its own;
+prefer keywords when there are many rules.
+'''
+import re
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+def is_word_char(char):
+    return char.isalnum() or char == '_'
+
+
+class KeywordMatcher():
+    '''
+    An Aho-Corasick automaton over a set of keywords.
+    '''
+    def __init__(self, keywords):
+        '''
+        :param keywords: An iterable of `(keyword, value)` pairs; a
+          keyword may be given several values.
+        '''
+        # State 0 is the root; each state has its transitions, the
+        # state of its longest proper suffix in the trie, the values of
+        # keywords ending there and the nearest suffix state with values
+        self._goto = [{}]
+        self._fail = [0]
+        self._values = [[]]
+        self._output = [None]
+
+        for keyword, value in keywords:
+            keyword = keyword.lower()
+            if not keyword:
+                continue
+            state = 0
+            for char in keyword:
+                following = self._goto[state].get(char)
+                if following is None:
+                    following = len(self._goto)
+                    self._goto[state][char] = following
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._values.append([])
+                    self._output.append(None)
+                state = following
+            self._values[state].append((len(keyword), value))
+
+        # Breadth first, so the suffix states are done before the states
+        # that depend on them
+        queue = list(self._goto[0].values())
+        for state in queue:
+            for char, following in self._goto[state].items():
+                queue.append(following)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                fail = self._goto[fail].get(char, 0)
+                self._fail[following] = fail
+                self._output[following] = (
+                    fail if self._values[fail] else self._output[fail])
+
+    def __bool__(self):
+        return len(self._goto) > 1
+
+    def finditer(self, text):
+        '''
+        Yield `(start, end, value)` for every occurrence of a keyword in
+        `text`, ignoring case, overlapping occurrences included. The
+        positions are in `text.lower()`, which may differ in length.
+        '''
+        goto = self._goto
+        fail = self._fail
+        state = 0
+        for end, char in enumerate(text.lower(), 1):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+
+            match = state if self._values[state] else self._output[state]
+            while match:
+                for length, value in self._values[match]:
+                    yield end - length, end, value
+                match = self._output[match]
+
+    def find_words(self, text):
+        '''
+        Return the set of values of the keywords that occur in `text`
+        as whole words, ignoring case.
+        '''
+        text = text.lower()
+        found = set()
+        for start, end, value in self.finditer(text):
+            if value in found:
+                continue
+            if start > 0 and is_word_char(text[start - 1]):
+                continue
+            if end < len(text) and is_word_char(text[end]):
+                continue
+            found.add(value)
+        return found
+
+
+class Router():
+    '''
+    A compiled set of routing rules.
+    '''
+    def __init__(self, keywords, regexes):
+        '''
+        :param keywords: An iterable of `(keyword, value)` pairs.
+        :param regexes: An iterable of `(pattern, value)` pairs;
+          invalid patterns are logged and skipped.
+        '''
+        self.keywords = KeywordMatcher(keywords)
+        self.regexes = []
+        for pattern, value in regexes:
+            try:
+                self.regexes.append((re.compile(pattern, re.IGNORECASE),
+                                     value))
+            except re.error as e:
+                logger.warning('Skipping routing regex %r: %s', pattern, e)
+
+    def __bool__(self):
+        return bool(self.keywords) or bool(self.regexes)
+
+    def match(self, *texts):
+        '''
+        Return the set of values of the rules that match any of
+        `texts`.
+        '''
+        found = set()
+        for text in texts:
+            found |= self.keywords.find_words(text)
+            found.update(value for regex, value in self.regexes
+                         if value not in found and regex.search(text))
+        return found
@@ -0,0 +1,35 @@
+import re
+from collections import Counter
+
+
+#: Terms longer than this are truncated before indexing
+MAX_TERM_LENGTH = 40
+
+#: How much more a term in a title counts than one in body text
+TITLE_WEIGHT = 3
+
+#: The most index entries of a query's rarest term that are scored
+MAX_CANDIDATES = 1000
+
+#: The most terms of a query that are counted to find its rarest term
+MAX_COUNTED_TERMS = 16
+
+_word = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+    '''
+    Split `text` into lowercase search terms.
+    '''
+    return [word[:MAX_TERM_LENGTH] for word in _word.findall(text.lower())]
+
+
+def term_weights(text, weight=1):
+    '''
+    Return a Counter mapping each term in `text` to the number of times
+    it occurs multiplied by `weight`.
+    '''
+    weights = Counter()
+    for term in tokenize(text):
+        weights[term] += weight
+    return weights
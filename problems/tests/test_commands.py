@@ -0,0 +1,104 @@
+from django.test import TestCase
+from django.core.management import call_command
+from django.contrib.auth.models import User
+from django.utils.six import StringIO
+
+from problems import models
+from problems.render import RENDER_VERSION
+
+
+class TestRenderMarkdown(TestCase):
+    '''
+    Test the render_markdown management command.
+    '''
+
+    def test_backfill(self):
+        '''
+        Test that rows rendered by an older version are re-rendered and
+        that current rows are left alone.
+        '''
+        user = User(username='test', email='test@example.com')
+        user.set_password('test')
+        user.save()
+
+        problems = []
+        for i in range(5):
+            problem = models.Problem(title='test', description='*%i*' % i)
+            problem.save()
+            problems.append(problem)
+        reply = models.Reply(user=user, text='**reply**')
+        reply.save()
+
+        stale = [problem.pk for problem in problems[:3]]
+        models.Problem.objects.filter(pk__in=stale).update(
+            description_html='', description_html_version=0)
+        models.Reply.objects.update(text_html='', text_html_version=0)
+
+        out = StringIO()
+        call_command('render_markdown', batch_size=2, stdout=out)
+
+        self.assertIn('Rendered 3 problem descriptions', out.getvalue())
+        self.assertIn('Rendered 1 replies', out.getvalue())
+        for problem in models.Problem.objects.all():
+            self.assertEqual(problem.description_html_version, RENDER_VERSION)
+            self.assertIn('<em>', problem.description_html)
+        reply = models.Reply.objects.get(pk=reply.pk)
+        self.assertIn('<strong>reply</strong>', reply.text_html)
+
+
+class TestRebuildSearchIndex(TestCase):
+    '''
+    Test the rebuild_search_index management command.
+    '''
+
+    def test_rebuild(self):
+        user = User(username='test', email='test@example.com')
+        user.set_password('test')
+        user.save()
+
+        problem = models.Problem(title='test', description='alpha')
+        problem.save()
+        reply = models.Reply(user=user, text='beta')
+        reply.save()
+        problem.add_response(reply)
+        models.SearchTerm.objects.all().delete()
+
+        out = StringIO()
+        call_command('rebuild_search_index', batch_size=1, stdout=out)
+
+        self.assertIn('Indexed 1 problems', out.getvalue())
+        results = models.SearchTerm.search('alpha beta')
+        self.assertEqual([p.pk for p, score in results], [problem.pk])
+
+
+class TestRepairReplySummaries(TestCase):
+    '''
+    Test the repair_reply_summaries management command.
+    '''
+
+    def test_repair(self):
+        first = User.objects.create(username='first')
+        second = User.objects.create(username='second')
+
+        problems = []
+        for i in range(3):
+            problem = models.Problem(title='test', description='test')
+            problem.save()
+            problems.append(problem)
+        problems[0].add_response(models.Reply(user=first, text='a'))
+        problems[0].add_response(models.Reply(user=second, text='b'))
+        problems[1].add_response(models.Reply(user=first, text='c'))
+
+        models.Problem.objects.filter(pk=problems[0].pk).update(
+            reply_count=7, last_reply_user=first)
+        models.Problem.objects.filter(pk=problems[2].pk).update(
+            reply_count=1)
+
+        out = StringIO()
+        call_command('repair_reply_summaries', batch_size=2, stdout=out)
+
+        self.assertIn('Checked 3 problems, repaired 2', out.getvalue())
+        summaries = [(p.reply_count, p.last_reply_user_id)
+                     for p in models.Problem.objects.order_by('pk')]
+        self.assertEqual(summaries,
+                         [(2, second.pk), (1, first.pk), (0, None)])
@@ -1,6 +1,11 @@
+from unittest import mock
+
 from django.test import TestCase
 from django.contrib.auth.models import User
-from problems import models
+from django.core.exceptions import ValidationError
+from problems import models, utils
+from problems.render import RENDER_VERSION
+from problems.routing import KeywordMatcher, Router
 
 
 class TestProblem(TestCase):
@@ -30,6 +35,53 @@ class TestProblem(TestCase):
         self.assertEqual(len(problem.replies()), 1,
                          'Response not added correctly')
 
+    def test_add_unsaved_response(self):
+        '''
+        Test that add_response saves a new reply and that replies are
+        kept per problem, in date order.
+        '''
+        user = User.objects.create(username='testuser')
+        problem = models.Problem(title='test', description='test')
+        problem.save()
+        other = models.Problem(title='other', description='test')
+        other.save()
+
+        first = models.Reply(user=user, text='first')
+        problem.add_response(first)
+        other.add_response(models.Reply(user=user, text='other'))
+        second = models.Reply(user=user, text='second')
+        problem.add_response(second)
+
+        self.assertIsNotNone(first.pk)
+        self.assertEqual(first.problem_id, problem.pk)
+        self.assertEqual([r.pk for r in problem.replies()],
+                         [first.pk, second.pk])
+
+    def test_reply_summary(self):
+        '''
+        Test that add_response maintains the reply summary, and that
+        saving a stale copy of the problem does not overwrite it.
+        '''
+        first = User.objects.create(username='first')
+        second = User.objects.create(username='second')
+        problem = models.Problem(title='test', description='test')
+        problem.save()
+        stale = models.Problem.objects.get(pk=problem.pk)
+
+        problem.add_response(models.Reply(user=first, text='a'))
+        reply = models.Reply(user=second, text='b')
+        problem.add_response(reply)
+
+        stale.title = 'edited'
+        stale.save()
+
+        problem = models.Problem.objects.get(pk=problem.pk)
+        self.assertEqual(problem.title, 'edited')
+        self.assertEqual(problem.reply_count, 2)
+        self.assertEqual(problem.last_reply_user, second)
+        self.assertEqual(problem.last_reply_at, reply.date)
+        self.assertEqual(problem.serialize()['reply_count'], 2)
+
     def test_description_html_sanitization(self):
         '''
         Test that HTML is correctly removed when the provided
@@ -42,6 +94,60 @@ class TestProblem(TestCase):
         self.assertFalse('<script>' in problem.markdown_description())
         self.assertTrue('hello' in problem.markdown_description())
 
+    def test_description_html_stored(self):
+        '''
+        Test that saving a problem stores the rendered description and
+        that changing the description re-renders it.
+        '''
+        problem = models.Problem(title='test', description='*first*')
+        problem.save()
+
+        problem = models.Problem.objects.get(pk=problem.pk)
+        self.assertIn('<em>first</em>', problem.description_html)
+        self.assertEqual(problem.description_html_version, RENDER_VERSION)
+
+        problem.description = '*second*'
+        problem.save()
+
+        problem = models.Problem.objects.get(pk=problem.pk)
+        self.assertIn('<em>second</em>', problem.description_html)
+
+    def test_stale_description_html_rerendered(self):
+        '''
+        Test that HTML from an older render version is re-rendered and
+        stored when it is read.
+        '''
+        problem = models.Problem(title='test', description='*text*')
+        problem.save()
+        models.Problem.objects.filter(pk=problem.pk).update(
+            description_html='stale', description_html_version=0)
+
+        problem = models.Problem.objects.get(pk=problem.pk)
+        self.assertIn('<em>text</em>', problem.markdown_description())
+
+        problem = models.Problem.objects.get(pk=problem.pk)
+        self.assertEqual(problem.description_html_version, RENDER_VERSION)
+        self.assertIn('<em>text</em>', problem.description_html)
+
+    def test_create_problems(self):
+        '''
+        Test that bulk-created problems get their own primary keys, and
+        that only the fingerprints given are kept.
+        '''
+        user = User.objects.create_user('testuser')
+        problems = [models.Problem(title='test %i' % i, description='test')
+                    for i in range(12)]
+        problems[3].fingerprint = 'f' * 64
+        utils.create_problems(user, problems, [[] for problem in problems])
+
+        for problem in problems:
+            stored = models.Problem.objects.get(pk=problem.pk)
+            self.assertEqual(stored.title, problem.title)
+        self.assertEqual(
+            list(models.Problem.objects.exclude(fingerprint=None)
+                 .values_list('pk', flat=True)), [problems[3].pk])
+        self.assertIsNone(problems[0].fingerprint)
+
 
 class TestProblemTag(TestCase):
     '''
@@ -73,6 +179,79 @@ class TestProblemTag(TestCase):
         self.assertEqual(tag.pk, stored_tag.pk,
                          'Method returned a tag with a different PK')
 
+    def test_get_or_create_many_race(self):
+        '''
+        Test that get_or_create_many returns a tag created by another
+        request after it looked for the tags.
+        '''
+        stored_tag = models.ProblemTag.objects.create(name='second')
+        filter = models.ProblemTag.objects.filter
+        lookups = []
+
+        def first_lookup_misses(**kwargs):
+            lookups.append(kwargs)
+            if len(lookups) == 1:
+                return filter(pk__in=[])
+            return filter(**kwargs)
+
+        with mock.patch.object(models.ProblemTag.objects, 'filter',
+                               first_lookup_misses):
+            tags = models.ProblemTag.get_or_create_many(['first', 'second'])
+
+        self.assertEqual(tags['second'].pk, stored_tag.pk)
+        self.assertEqual(tags['first'].name, 'first')
+        self.assertEqual(models.ProblemTag.objects.count(), 2)
+
+
+class TestProblemTagCount(TestCase):
+    '''
+    Test that ProblemTag.problem_count follows changes to problem tags.
+    '''
+
+    def setUp(self):
+        self.tag = models.ProblemTag.get_or_create('robot')
+        self.other = models.ProblemTag.get_or_create('human')
+        self.problems = []
+        for i in range(3):
+            problem = models.Problem(title='test', description='test')
+            problem.save()
+            self.problems.append(problem)
+
+    def assertCounts(self, tag_count, other_count):
+        self.tag.refresh_from_db()
+        self.other.refresh_from_db()
+        self.assertEqual(self.tag.problem_count, tag_count)
+        self.assertEqual(self.other.problem_count, other_count)
+
+    def test_add_and_remove(self):
+        self.problems[0].tags.add(self.tag, self.other)
+        self.problems[1].tags.add(self.tag)
+        self.problems[1].tags.add(self.tag)
+        self.assertCounts(2, 1)
+
+        self.problems[0].tags.remove(self.tag)
+        self.problems[2].tags.remove(self.tag)
+        self.assertCounts(1, 1)
+
+        self.problems[0].tags.clear()
+        self.assertCounts(1, 0)
+
+    def test_reverse_side(self):
+        self.tag.problem_set.add(*self.problems)
+        self.assertCounts(3, 0)
+
+        self.tag.problem_set.remove(self.problems[0])
+        self.assertCounts(2, 0)
+
+        self.tag.problem_set.clear()
+        self.assertCounts(0, 0)
+
+    def test_delete_problem(self):
+        self.problems[0].tags.add(self.tag)
+        self.problems[1].tags.add(self.tag)
+        self.problems[0].delete()
+        self.assertCounts(1, 0)
+
 
 class TestReply(TestCase):
     '''
@@ -93,6 +272,22 @@ class TestReply(TestCase):
         self.assertFalse('<script>' in reply.format())
         self.assertTrue('hello' in reply.format())
 
+    def test_format_uses_stored_html(self):
+        '''
+        Test that the format method returns the HTML stored on save
+        rather than rendering the text again.
+        '''
+        user = User(username='test', email='test@example.com')
+        user.set_password('test')
+        user.save()
+
+        reply = models.Reply(user=user, text='*hello*')
+        reply.save()
+        models.Reply.objects.filter(pk=reply.pk).update(text_html='stored')
+
+        reply = models.Reply.objects.get(pk=reply.pk)
+        self.assertEqual(reply.format(), 'stored')
+
     def test_serialize(self):
         '''
         Test that the serialize method returns correct data.
@@ -108,4 +303,377 @@ class TestReply(TestCase):
         data = reply.serialize()
         self.assertEqual(data['id'], reply.pk)
         self.assertEqual(data['userid'], user.pk)
-        self.assertEqual(data['date'], reply.date.isoformat())
\ No newline at end of file
+        self.assertEqual(data['date'], reply.date.isoformat())
+
+
+class TestSearchTerm(TestCase):
+    '''
+    Test that the search index follows problems and replies and ranks
+    its results.
+    '''
+
+    def setUp(self):
+        self.user = User(username='test', email='test@example.com')
+        self.user.set_password('test')
+        self.user.save()
+
+    def search_ids(self, query):
+        return [problem.pk for problem, score in
+                models.SearchTerm.search(query)]
+
+    def test_index_on_save(self):
+        problem = models.Problem(title='Database timeout',
+                                 description='The nightly job failed')
+        problem.save()
+
+        self.assertEqual(self.search_ids('nightly'), [problem.pk])
+        self.assertEqual(self.search_ids('DATABASE job'), [problem.pk])
+        self.assertEqual(self.search_ids('database missing'), [],
+                         'Search should require every term')
+
+        problem.description = 'The weekly job failed'
+        problem.save()
+        self.assertEqual(self.search_ids('nightly'), [])
+        self.assertEqual(self.search_ids('weekly'), [problem.pk])
+
+    def test_index_replies(self):
+        problem = models.Problem(title='test', description='test')
+        problem.save()
+        reply = models.Reply(user=self.user, text='caused by a deadlock')
+        reply.save()
+        problem.add_response(reply)
+
+        self.assertEqual(self.search_ids('deadlock'), [problem.pk])
+
+        # Editing the problem keeps the entries for its replies
+        problem.title = 'changed'
+        problem.save()
+        self.assertEqual(self.search_ids('deadlock changed'), [problem.pk])
+
+    def test_ranking(self):
+        '''
+        Test that a term in a title ranks above one in a description.
+        '''
+        body = models.Problem(title='test', description='crash on start')
+        body.save()
+        title = models.Problem(title='crash', description='on start')
+        title.save()
+
+        self.assertEqual(self.search_ids('crash'), [title.pk, body.pk])
+        self.assertEqual(self.search_ids(''), [])
+
+    def test_candidates(self):
+        '''
+        Test that the rarest term picks the problems that are scored,
+        and that only the heaviest entries of a common term are.
+        '''
+        problems = [models.Problem(title='crash', description='crash')]
+        problems += [models.Problem(title='test', description='crash')
+                     for i in range(3)]
+        problems[-1].description = 'crash on upgrade'
+        for problem in problems:
+            problem.save()
+
+        self.assertEqual(models.SearchTerm.term_counts(['crash', 'upgrade']),
+                         {'crash': 4, 'upgrade': 1})
+        self.assertEqual(models.SearchTerm.term_counts(['crash'], 2),
+                         {'crash': 2})
+        with mock.patch.object(models, 'MAX_CANDIDATES', 2):
+            self.assertEqual(self.search_ids('crash upgrade'),
+                             [problems[-1].pk])
+            self.assertEqual(len(self.search_ids('crash')), 2)
+            self.assertEqual(self.search_ids('crash')[0], problems[0].pk)
+
+
+class TestOccurrence(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user('alice')
+        self.bob = User.objects.create_user('bob')
+
+    def report(self, user, fingerprint):
+        problem = models.Problem(title='Crash', description='test')
+        return utils.report_problems(user, [problem], [[]], [fingerprint])[0]
+
+    def test_fingerprints_are_per_user(self):
+        alice_pk, created = self.report(self.alice, 'crash')
+        self.assertTrue(created)
+        bob_pk, created = self.report(self.bob, 'crash')
+        self.assertTrue(created)
+        self.assertNotEqual(alice_pk, bob_pk)
+
+        self.assertEqual(self.report(self.alice, 'crash'), (alice_pk, False))
+
+    def test_save_keeps_occurrence_count(self):
+        pk, created = self.report(self.alice, 'crash')
+        problem = models.Problem.objects.get(pk=pk)
+        self.report(self.alice, 'crash')
+
+        problem.title = 'Edited'
+        problem.save()
+        self.assertEqual(models.Problem.objects.get(pk=pk).occurrence_count, 2)
+
+    def test_changes_on_occurrence(self):
+        pk, created = self.report(self.alice, 'crash')
+        version = utils.problem_version(pk)
+        self.report(self.alice, 'crash')
+        self.assertGreater(utils.problem_version(pk), version)
+
+
+class TestKeywordMatcher(TestCase):
+    def test_overlapping_keywords(self):
+        matcher = KeywordMatcher([('he', 1), ('she', 2), ('his', 3),
+                                  ('hers', 4)])
+        self.assertEqual(sorted(matcher.finditer('ushers')),
+                         [(1, 4, 2), (2, 4, 1), (2, 6, 4)])
+
+    def test_whole_words(self):
+        matcher = KeywordMatcher([('segfault', 'crash'),
+                                  ('null pointer', 'npe'), ('db', 'database')])
+        self.assertEqual(
+            matcher.find_words('A Segfault on a NULL POINTER in dbm'),
+            {'crash', 'npe'})
+        self.assertEqual(matcher.find_words('db_error'), set())
+        self.assertEqual(matcher.find_words('(db)'), {'database'})
+
+    def test_router(self):
+        with self.assertLogs('problems.routing', 'WARNING'):
+            router = Router([('disk', 'storage')],
+                            [(r'err(or)?\s+\d+', 'code'), ('(', 'invalid')])
+        self.assertEqual(router.match('Disk full', 'error 28'),
+                         {'storage', 'code'})
+        self.assertFalse(Router([], []))
+
+
+class TestRoutingRule(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('dba')
+        self.tag = models.ProblemTag.get_or_create('database')
+        models.RoutingRule.objects.create(pattern='deadlock', tag=self.tag)
+        models.RoutingRule.objects.create(
+            kind=models.RoutingRule.REGEX, pattern=r'pg_\w+',
+            assignee=self.user)
+
+    def test_route_problems(self):
+        problems = [models.Problem(title='Deadlock', description='in pg_dump'),
+                    models.Problem(title='Typo', description='on the page')]
+        tags = [['nightly'], []]
+        assignees = utils.route_problems(problems, tags)
+
+        self.assertEqual(tags, [['nightly', 'database'], []])
+        self.assertEqual(assignees, [{self.user.pk}, set()])
+
+    def test_recompiled_when_rules_change(self):
+        router = models.RoutingRule.router()
+        self.assertIs(models.RoutingRule.router(), router)
+
+        rule = models.RoutingRule.objects.get(pattern='deadlock')
+        rule.active = False
+        rule.save()
+        router = models.RoutingRule.router()
+        self.assertEqual(router.match('deadlock'), set())
+
+        rule.delete()
+        self.assertIsNot(models.RoutingRule.router(), router)
+
+    def test_tag_renamed(self):
+        models.RoutingRule.router()
+        self.tag.name = 'postgres'
+        self.tag.save()
+
+        tags = [[]]
+        utils.route_problems([models.Problem(title='Deadlock')], tags)
+        self.assertEqual(tags, [['postgres']])
+
+    def test_recompiled_when_rules_updated(self):
+        models.RoutingRule.router()
+        models.RoutingRule.objects.filter(pattern='deadlock').update(
+            pattern='livelock')
+        self.assertEqual(len(models.RoutingRule.router().match('livelock')),
+                         1)
+
+    def test_clean(self):
+        with self.assertRaises(ValidationError):
+            models.RoutingRule(pattern='test').clean()
+        with self.assertRaises(ValidationError):
+            models.RoutingRule(kind=models.RoutingRule.REGEX, pattern='(',
+                               tag=self.tag).clean()
+
+
+class TestDependency(TestCase):
+    '''
+    Test the dependency graph and the incrementally maintained rollups.
+    '''
+    def setUp(self):
+        self.problems = {}
+        for name in 'abcde':
+            problem = models.Problem(title=name, description='test')
+            problem.save()
+            self.problems[name] = problem
+
+    def get(self, name):
+        return models.Problem.objects.get(pk=self.problems[name].pk)
+
+    def depend(self, parent, child):
+        self.get(parent).add_dependency(self.get(child))
+
+    def assertRollupsConsistent(self):
+        '''
+        Check the stored rollups against rollups computed by walking
+        the whole graph.
+        '''
+        problems = models.Problem.objects.in_bulk(
+            [problem.pk for problem in self.problems.values()])
+        children = {}
+        for parent, child in models.Dependency.objects.values_list(
+                'parent', 'child'):
+            children.setdefault(parent, []).append(child)
+
+        def rollup(pk):
+            progress, count = problems[pk].progress(), 1
+            for child in children.get(pk, []):
+                child_progress, child_count = rollup(child)
+                progress += child_progress
+                count += child_count
+            return progress, count
+
+        for pk, problem in problems.items():
+            self.assertEqual(
+                (problem.rollup_progress, problem.rollup_count), rollup(pk),
+                'Rollup of %s is inconsistent' % problem.title)
+
+    def test_chain(self):
+        self.depend('a', 'b')
+        self.depend('b', 'c')
+
+        c = self.get('c')
+        c.percent_complete = 60
+        c.save()
+        self.assertEqual(self.get('b').rollup_completion, 30)
+        self.assertEqual(self.get('a').rollup_completion, 20)
+
+        c.resolved = True
+        c.save()
+        self.assertEqual(self.get('a').rollup_completion, 33)
+        self.assertRollupsConsistent()
+
+    def test_diamond(self):
+        '''
+        Test that a problem reached by two paths counts once for each.
+        '''
+        self.depend('a', 'b')
+        self.depend('a', 'c')
+        self.depend('b', 'd')
+        self.depend('c', 'd')
+
+        d = self.get('d')
+        d.percent_complete = 50
+        d.save()
+        a = self.get('a')
+        self.assertEqual((a.rollup_progress, a.rollup_count), (100, 5))
+        self.assertRollupsConsistent()
+
+    def test_stale_instance(self):
+        '''
+        Test that saving an instance loaded before its progress changed
+        elsewhere keeps the rollups right.
+        '''
+        self.depend('a', 'b')
+        stale = self.get('b')
+        fresh = self.get('b')
+        fresh.percent_complete = 40
+        fresh.save()
+        stale.percent_complete = 10
+        stale.save()
+        self.assertEqual(self.get('a').rollup_progress, 10)
+        self.assertRollupsConsistent()
+
+    def test_cycles(self):
+        self.depend('a', 'b')
+        self.depend('b', 'c')
+        with self.assertRaises(models.DependencyCycle):
+            self.depend('c', 'a')
+        with self.assertRaises(models.DependencyCycle):
+            self.depend('a', 'a')
+        self.assertFalse(models.Dependency.objects.filter(
+            parent=self.problems['c']).exists())
+
+    def test_depth_limit(self):
+        '''
+        Test that a dependency is refused if it would make too long a
+        chain, counting the links both above and below it.
+        '''
+        with mock.patch.object(models, 'DEPENDENCY_MAX_DEPTH', 3):
+            self.depend('a', 'b')
+            self.depend('c', 'd')
+            self.depend('b', 'c')
+            with self.assertRaises(models.DependencyTooDeep):
+                self.depend('d', 'e')
+            with self.assertRaises(models.DependencyTooDeep):
+                self.depend('e', 'a')
+
+        self.assertFalse(models.Dependency.objects.filter(
+            child=self.problems['e']).exists())
+        self.assertRollupsConsistent()
+
+    def test_rollup_overflow(self):
+        '''
+        Test that a dependency is refused, and changes nothing, if a
+        rollup above it would count too many problems.
+        '''
+        self.depend('b', 'c')
+        self.depend('a', 'b')
+        with mock.patch.object(models, 'ROLLUP_COUNT_MAX', 4):
+            self.depend('b', 'd')
+            with self.assertRaises(models.RollupOverflow):
+                self.depend('b', 'e')
+
+        self.assertEqual(self.get('a').rollup_count, 4)
+        self.assertFalse(models.Dependency.objects.filter(
+            child=self.problems['e']).exists())
+        self.assertRollupsConsistent()
+
+    def test_remove(self):
+        self.depend('a', 'b')
+        self.depend('b', 'c')
+        self.depend('d', 'b')
+        c = self.get('c')
+        c.percent_complete = 90
+        c.save()
+
+        self.get('b').remove_dependency(self.get('c'))
+        self.get('b').remove_dependency(self.get('c'))
+        self.assertEqual(self.get('a').rollup_count, 2)
+        self.assertEqual(self.get('d').rollup_progress, 0)
+        self.assertRollupsConsistent()
+
+    def test_delete(self):
+        self.depend('a', 'b')
+        self.depend('b', 'c')
+        b = self.get('b')
+        b.percent_complete = 20
+        b.save()
+
+        self.get('b').delete()
+        del self.problems['b']
+        self.assertEqual(self.get('a').rollup_count, 1)
+        self.assertRollupsConsistent()
+
+    def test_subtree(self):
+        self.depend('a', 'b')
+        self.depend('a', 'c')
+        self.depend('b', 'd')
+        self.depend('c', 'd')
+        self.depend('d', 'e')
+
+        nodes = self.get('a').subtree(depth=2)
+        self.assertEqual([node['title'] for node in nodes],
+                         ['a', 'b', 'c', 'd'])
+        self.assertEqual(nodes[0]['children'], [self.problems['b'].pk,
+                                                self.problems['c'].pk])
+        self.assertEqual(nodes[1]['children'], [self.problems['d'].pk])
+        self.assertTrue(nodes[3]['truncated'])
+        self.assertEqual(nodes[0]['rollup_completion'], 0)
+
+        nodes = self.get('a').subtree(limit=3)
+        self.assertEqual(len(nodes), 3)
+        self.assertTrue(nodes[1]['truncated'])
@@ -1,5 +1,10 @@
 import django.test
-from problems import views
+from django.db import connection
+from django.contrib.auth.models import User
+from django.test.utils import CaptureQueriesContext
+
+from gravel.testing import QueryBudgetMixin
+from problems import models, utils, views
 
 
 class TestProblemReport(django.test.TestCase):
@@ -45,6 +50,27 @@ class TestProblemSubmit(django.test.TestCase):
         self.assertEqual(response.status_code, 200,
                          'View returned an HTTP error code')
 
+    def test_routing(self):
+        '''
+        Test that a new problem matching routing rules gets their tags
+        and assignees.
+        '''
+        user = User.objects.create(username='dba')
+        tag = models.ProblemTag.get_or_create('database')
+        models.RoutingRule.objects.create(pattern='deadlock', tag=tag,
+                                          assignee=user)
+
+        response = django.test.Client().post('/problem/report/submit', {
+            'title': 'Nightly failure', 'username': 'robot',
+            'description': 'A *deadlock* in the importer'})
+        self.assertEqual(response.status_code, 302)
+
+        problem = models.Problem.objects.get()
+        self.assertEqual(list(problem.tags.all()), [tag])
+        self.assertEqual(list(problem.assigned_to.all()), [user])
+        self.assertEqual(models.ProblemTag.objects.get(pk=tag.pk)
+                         .problem_count, 1)
+
 
 class TestProblemView(django.test.TestCase):
 
@@ -59,3 +85,369 @@ class TestProblemView(django.test.TestCase):
 
         self.assertEqual(response.status_code, 404,
                          'View did not return 404 on mossing problem')
+
+
+class TestProblemViewQueries(django.test.TestCase):
+    '''
+    Test that problem_view loads a page in a number of queries that
+    does not depend on the number of replies.
+    '''
+
+    def setUp(self):
+        self.client = django.test.Client()
+        self.user = User(username='test', email='test@example.com',
+                         first_name='Test', last_name='User')
+        self.user.set_password('test')
+        self.user.save()
+
+        self.problem = models.Problem(title='test', description='test')
+        self.problem.save()
+        self.problem.assigned_to.add(self.user)
+
+    def add_replies(self, count):
+        '''
+        Add `count` rendered replies to the problem in bulk.
+        '''
+        replies = []
+        for i in range(count):
+            reply = models.Reply(user=self.user, problem=self.problem,
+                                 text='reply %i' % i)
+            reply.render_text()
+            replies.append(reply)
+        models.Reply.objects.bulk_create(replies[1:])
+        self.problem.add_response(replies[0])
+
+    def count_queries(self):
+        path = '/problem/view/%i/' % self.problem.pk
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(path)
+        self.assertEqual(response.status_code, 200)
+        return len(context)
+
+    def test_query_count_flat(self):
+        self.add_replies(1)
+        few = self.count_queries()
+
+        self.add_replies(999)
+        self.assertEqual(len(self.problem.replies()), 1000)
+        many = self.count_queries()
+
+        self.assertEqual(few, many,
+                         'Query count grows with the number of replies')
+        # The ETag lookup, the problem, its replies and its tags
+        self.assertLessEqual(many, 4)
+
+    def test_query_count_logged_in(self):
+        self.client.login(username='test', password='test')
+        self.add_replies(1)
+        few = self.count_queries()
+
+        self.add_replies(99)
+        many = self.count_queries()
+
+        self.assertEqual(few, many,
+                         'Query count grows with the number of replies')
+
+
+class TestProblemList(django.test.TestCase):
+    '''
+    Test the keyset pagination and filters of problem_list.
+    '''
+
+    def setUp(self):
+        self.factory = django.test.RequestFactory()
+
+        self.problems = []
+        for i in range(7):
+            problem = models.Problem(title='test %i' % i, description='test')
+            problem.resolved = (i % 2 == 0)
+            problem.save()
+            self.problems.append(problem)
+
+    def get_all_pages(self, page_size, **params):
+        '''
+        Follow the cursors of problem_list until the last page and
+        return every listed problem.
+        '''
+        queryset = utils.filter_problems(models.Problem.objects.all(), params)
+        seen = []
+        cursor = None
+        while True:
+            page, cursor = utils.paginate_problems(queryset, cursor,
+                                                   page_size)
+            self.assertLessEqual(len(page), page_size)
+            seen.extend(page)
+            if cursor is None:
+                return seen
+
+    def test_pages_cover_all_problems(self):
+        seen = self.get_all_pages(page_size=3)
+        expected = sorted(self.problems,
+                          key=lambda p: (p.date_created, p.pk), reverse=True)
+        self.assertEqual([p.pk for p in seen], [p.pk for p in expected])
+
+    def test_pages_with_equal_dates(self):
+        '''
+        Test that problems created at the same instant are neither
+        skipped nor repeated across pages.
+        '''
+        date = self.problems[0].date_created
+        models.Problem.objects.update(date_created=date)
+
+        seen = self.get_all_pages(page_size=2)
+        self.assertEqual(sorted(p.pk for p in seen),
+                         sorted(p.pk for p in self.problems))
+
+    def test_later_pages_seek(self):
+        '''
+        Test that a later page is found by seeking into the index on
+        `(date_created, id)` rather than by scanning from the newest
+        problem.
+        '''
+        if connection.vendor != 'sqlite':
+            self.skipTest('Checks an SQLite query plan')
+        cursor = utils.encode_cursor(self.problems[3])
+        queryset = utils.after_cursor(
+            models.Problem.objects.order_by('-date_created', '-pk'), cursor)
+        sql, params = queryset[:50].query.sql_with_params()
+
+        with connection.cursor() as db:
+            db.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            plan = ' '.join(str(row[-1]) for row in db.fetchall())
+        self.assertIn('date_created<', plan)
+
+    def test_filters(self):
+        user = User(username='test', email='test@example.com')
+        user.set_password('test')
+        user.save()
+        tag = models.ProblemTag.get_or_create('robot')
+
+        self.problems[1].assigned_to.add(user)
+        self.problems[2].assigned_to.add(user)
+        self.problems[2].tags.add(tag)
+
+        seen = self.get_all_pages(page_size=2, resolved='true')
+        self.assertEqual(len(seen), 4)
+        self.assertTrue(all(p.resolved for p in seen))
+
+        seen = self.get_all_pages(page_size=2, assignee=str(user.pk))
+        self.assertEqual(sorted(p.pk for p in seen),
+                         [self.problems[1].pk, self.problems[2].pk])
+
+        seen = self.get_all_pages(page_size=2, tag='robot', resolved='true')
+        self.assertEqual([p.pk for p in seen], [self.problems[2].pk])
+
+    def test_view(self):
+        request = self.factory.get('/problem/list/all', {'resolved': 'false'})
+        response = views.problem_list(request, 'all')
+        self.assertEqual(response.status_code, 200)
+
+    def test_reply_summary(self):
+        user = User.objects.create(username='replier')
+        self.problems[0].add_response(models.Reply(user=user, text='a'))
+        self.problems[0].add_response(models.Reply(user=user, text='b'))
+
+        request = self.factory.get('/problem/list/all')
+        response = views.problem_list(request, 'all')
+        self.assertContains(response, '2 replies, last by replier')
+
+    def test_bad_cursor(self):
+        request = self.factory.get('/problem/list/all', {'cursor': '!!'})
+        response = views.problem_list(request, 'all')
+        self.assertEqual(response.status_code, 400,
+                         'View accepted a malformed cursor')
+
+        request = self.factory.get('/problem/list/all', {'resolved': 'no'})
+        response = views.problem_list(request, 'all')
+        self.assertEqual(response.status_code, 400,
+                         'View accepted a malformed filter')
+
+
+class TestProblemSearch(django.test.TestCase):
+    '''
+    Test that the search view pages through its results.
+    '''
+
+    def setUp(self):
+        self.factory = django.test.RequestFactory()
+
+    def test_results(self):
+        for i in range(25):
+            problem = models.Problem(title='flaky test %i' % i,
+                                     description='test')
+            problem.save()
+
+        request = self.factory.get('/problem/search/', {'q': 'flaky'})
+        response = views.problem_search(request)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'flaky test 24', response.content)
+        self.assertIn(b'page=2', response.content)
+
+        request = self.factory.get('/problem/search/',
+                                   {'q': 'flaky', 'page': '2'})
+        response = views.problem_search(request)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn(b'page=3', response.content)
+
+    def test_bad_page(self):
+        request = self.factory.get('/problem/search/', {'page': 'x'})
+        response = views.problem_search(request)
+        self.assertEqual(response.status_code, 400)
+
+
+class TestConditionalGet(django.test.TestCase):
+    '''
+    Test that the HTML views answer 304 Not Modified while nothing they
+    show has changed.
+    '''
+
+    def setUp(self):
+        self.client = django.test.Client()
+        self.user = User(username='test', email='test@example.com')
+        self.user.set_password('test')
+        self.user.save()
+
+        self.tag = models.ProblemTag.get_or_create('robot')
+        self.problem = models.Problem(title='test', description='test')
+        self.problem.save()
+        self.problem.tags.add(self.tag)
+
+    def assertConditional(self, path, change):
+        '''
+        Check that `path` is unmodified until `change` is called.
+        '''
+        response = self.client.get(path)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+
+        response = self.client.get(path, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        change()
+        response = self.client.get(path, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def add_reply(self):
+        reply = models.Reply(user=self.user, text='test')
+        reply.save()
+        self.problem.add_response(reply)
+
+    def add_problem(self):
+        problem = models.Problem(title='other', description='test')
+        problem.save()
+        problem.tags.add(self.tag)
+
+    def test_problem_view(self):
+        path = '/problem/view/%i/' % self.problem.pk
+        self.assertConditional(path, self.add_reply)
+
+    def test_problem_view_assignees(self):
+        path = '/problem/view/%i/' % self.problem.pk
+        self.assertConditional(
+            path, lambda: self.problem.assigned_to.add(self.user))
+
+    def test_problem_view_reply_edited(self):
+        self.add_reply()
+        reply = self.problem.replies()[0]
+
+        def edit_reply():
+            reply.text = 'edited'
+            reply.save()
+
+        path = '/problem/view/%i/' % self.problem.pk
+        self.assertConditional(path, edit_reply)
+
+    def test_problem_view_per_user(self):
+        path = '/problem/view/%i/' % self.problem.pk
+        etag = self.client.get(path)['ETag']
+
+        self.client.login(username='test', password='test')
+        response = self.client.get(path, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200,
+                         'Anonymous page reused for a logged-in user')
+
+    def test_problem_view_unrendered(self):
+        '''
+        Test that a 304 is answered without rendering the description.
+        '''
+        path = '/problem/view/%i/' % self.problem.pk
+        etag = self.client.get(path)['ETag']
+
+        with self.assertNumQueries(1):
+            response = self.client.get(path, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+    def test_problem_list(self):
+        self.assertConditional('/problem/list/all', self.add_problem)
+
+    def test_problem_list_delete(self):
+        self.add_problem()
+        self.assertConditional('/problem/list/all',
+                               lambda: self.problem.delete())
+
+    def test_tag_view(self):
+        self.assertConditional('/problem/tag/robot/view', self.add_problem)
+
+
+class TestQueryBudgets(QueryBudgetMixin, django.test.TestCase):
+    '''
+    Test that the views stay within their query budgets with enough
+    replies, tags and assignees to show up any per-row queries.
+    '''
+
+    def setUp(self):
+        self.client = django.test.Client()
+        self.user = User(username='test', email='test@example.com')
+        self.user.set_password('test')
+        self.user.save()
+        self.client.login(username='test', password='test')
+
+        self.problem = models.Problem(title='deadlock', description='test')
+        self.problem.save()
+        for i in range(3):
+            other = User.objects.create(username='other%i' % i)
+            self.problem.assigned_to.add(other)
+            self.problem.tags.add(models.ProblemTag.get_or_create('tag%i' % i))
+            for n in range(10):
+                self.problem.add_response(
+                    models.Reply(user=other, text='deadlock %i' % n))
+
+    def test_problem_report(self):
+        with self.assertQueryBudget(views.problem_report):
+            self.client.get('/problem/report/')
+
+    def test_problem_submit(self):
+        # Routed to two tags and an assignee
+        for name in ('tag0', 'tag1'):
+            models.RoutingRule.objects.create(
+                pattern='test', tag=models.ProblemTag.objects.get(name=name))
+        models.RoutingRule.objects.create(kind=models.RoutingRule.REGEX,
+                                          pattern='^te', assignee=self.user)
+        with self.assertQueryBudget(views.problem_submit):
+            response = self.client.post('/problem/report/submit', {
+                'title': 'test', 'description': 'test', 'username': 'test'})
+        self.assertEqual(response.status_code, 302)
+
+    def test_problem_view(self):
+        with self.assertQueryBudget(views.problem_view):
+            self.client.get('/problem/view/%i/' % self.problem.pk)
+
+    def test_problem_list(self):
+        with self.assertQueryBudget(views.problem_list):
+            self.client.get('/problem/list/all', {'tag': 'tag0'})
+
+    def test_problem_reply_submit(self):
+        with self.assertQueryBudget(views.problem_reply_submit):
+            response = self.client.post(
+                '/problem/reply/%i/submit' % self.problem.pk,
+                {'text': 'test'})
+        self.assertEqual(response.status_code, 302)
+
+    def test_problem_search(self):
+        with self.assertQueryBudget(views.problem_search):
+            self.client.get('/problem/search/', {'q': 'deadlock test'})
+
+    def test_tag_view(self):
+        with self.assertQueryBudget(views.tag_view):
+            self.client.get('/problem/tag/tag0/view')
@@ -6,5 +6,6 @@ urlpatterns = patterns('problems.views',
     url(r'view/(?P<pk>\d+)/$', 'problem_view'),
     url(r'reply/(?P<pk>\d+)/submit$', 'problem_reply_submit'),
     url(r'tag/(?P<tag>[^/]+)/view', 'tag_view'),
-    url(r'list/(?P<subset>(all))$', 'problem_list')
+    url(r'list/(?P<subset>(all))$', 'problem_list'),
+    url(r'search/$', 'problem_search'),
 )
\ No newline at end of file
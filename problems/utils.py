@@ -1,4 +1,16 @@
-from problems import forms
+import base64
+import hashlib
+import binascii
+
+from django.db import IntegrityError, transaction
+from django.db.models import F, Max, Prefetch, Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from problems import forms, models
+from problems.render import RENDER_VERSION
+from webhooks import events
+import webhooks.models
 
 
 def create_form_with_request(request):
@@ -6,3 +18,360 @@ def create_form_with_request(request):
     if 'user' in request and request.user.is_authenticated():
         form.username = request.user.get_username()
     return form
+
+
+def get_problem_for_view(pk):
+    '''
+    Fetch a Problem along with everything `problems/view.html` needs,
+    in a fixed number of queries regardless of the number of replies.
+
+    The replies, in date order and with their users, are stored in the
+    `reply_list` attribute of the returned problem.
+
+    :raises models.Problem.DoesNotExist: if there is no such problem.
+    '''
+    replies = models.Reply.objects.select_related('user').order_by('date')
+    return (models.Problem.objects
+            .select_related('last_update_user')
+            .prefetch_related(
+                'assigned_to',
+                Prefetch('reply_set', queryset=replies,
+                         to_attr='reply_list'))
+            .get(pk=pk))
+
+
+def encode_cursor(problem):
+    '''
+    Return an opaque cursor pointing just past `problem` in a list of
+    problems ordered newest first by `(date_created, pk)`.
+    '''
+    value = '%s|%i' % (problem.date_created.isoformat(), problem.pk)
+    return base64.urlsafe_b64encode(value.encode('utf8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    '''
+    Decode a cursor created by `encode_cursor`.
+
+    :returns: a `(date_created, pk)` tuple.
+    :raises ValueError: if the cursor is malformed.
+    '''
+    try:
+        value = base64.urlsafe_b64decode(cursor.encode('ascii'))
+        date, pk = value.decode('utf8').split('|')
+        date = parse_datetime(date)
+        pk = int(pk)
+    except (binascii.Error, UnicodeError, TypeError):
+        raise ValueError('Malformed cursor')
+
+    if date is None:
+        raise ValueError('Malformed cursor')
+    return date, pk
+
+
+def after_cursor(queryset, cursor):
+    '''
+    Narrow `queryset` to the problems that come after `cursor` when
+    ordered newest first.
+
+    :raises ValueError: if the cursor is malformed.
+    '''
+    date, pk = decode_cursor(cursor)
+    # The plain bound lets the database seek into the (date_created, id)
+    # index; with the OR alone it scans from the newest problem
+    return queryset.filter(
+        Q(date_created__lt=date) | Q(date_created=date, pk__lt=pk),
+        date_created__lte=date)
+
+
+def paginate_problems(queryset, cursor=None, page_size=50):
+    '''
+    Return one page of `queryset` ordered newest first, starting after
+    `cursor`. The page is selected with a keyset condition on
+    `(date_created, pk)` rather than an offset, so later pages cost the
+    same as the first one.
+
+    :param str cursor: A cursor from `encode_cursor`, or None to start
+      at the newest problem.
+    :returns: a `(problems, next_cursor)` tuple; `next_cursor` is None
+      on the last page.
+    :raises ValueError: if the cursor is malformed.
+    '''
+    queryset = queryset.order_by('-date_created', '-pk')
+    if cursor:
+        queryset = after_cursor(queryset, cursor)
+
+    problems = list(queryset[:page_size + 1])
+    if len(problems) > page_size:
+        problems = problems[:page_size]
+        return problems, encode_cursor(problems[-1])
+    return problems, None
+
+
+def filter_problems(queryset, params):
+    '''
+    Narrow `queryset` using the `resolved`, `assignee` and `tag` keys
+    of `params`, which is usually `request.GET`.
+
+    :raises ValueError: if a filter value is malformed.
+    '''
+    resolved = params.get('resolved')
+    if resolved:
+        if resolved not in ('true', 'false'):
+            raise ValueError('resolved must be true or false')
+        queryset = queryset.filter(resolved=(resolved == 'true'))
+
+    assignee = params.get('assignee')
+    if assignee:
+        queryset = queryset.filter(assigned_to=int(assignee))
+
+    tag = params.get('tag')
+    if tag:
+        queryset = queryset.filter(tags__name=tag)
+
+    return queryset
+
+
+@transaction.atomic
+def create_problems(user, problems, tags):
+    '''
+    Save many new problems for `user` at once with `bulk_create`, route
+    them, link their tags in bulk and index them for search.
+
+    :param list problems: Unsaved Problem objects.
+    :param list tags: A list of tag name lists, parallel to `problems`.
+    :returns: `problems`, with their primary keys set.
+    '''
+    if not problems:
+        return problems
+
+    for problem in problems:
+        problem.userref = user
+        problem.username = user.get_full_name()
+        problem.userauthed = True
+        problem.render_description()
+        problem.rollup_progress = problem.progress()
+
+    with transaction.atomic():
+        # bulk_create does not set primary keys. Bulk inserts take turns,
+        # so this batch is the user's problems after the last key before
+        # it, in order
+        models.ProblemInsertLock.acquire()
+        last = models.Problem.objects.aggregate(last=Max('pk'))['last']
+        models.Problem.objects.bulk_create(problems)
+        pks = (models.Problem.objects.filter(userref=user, pk__gt=last or 0)
+               .order_by('pk').values_list('pk', flat=True))
+        for problem, pk in zip(problems, pks):
+            problem.pk = pk
+
+    models.SearchTerm.index_new_problems(problems)
+    models.Change.objects.bulk_create(
+        models.Change(problem=problem) for problem in problems)
+
+    events.emit_many(webhooks.models.PROBLEM_CREATED,
+                     [problem.serialize() for problem in problems])
+    link_new_problems(problems, tags)
+    return problems
+
+
+def link_new_problems(problems, tags):
+    '''
+    Route saved `problems` that have no tags or assignees yet, and link
+    them to their tags and to the routed tags and assignees in bulk.
+
+    :param list tags: A list of tag name lists, parallel to `problems`.
+    '''
+    assignees = route_problems(problems, tags)
+    Assignment = models.Problem.assigned_to.through
+    Assignment.objects.bulk_create(
+        Assignment(problem_id=problem.pk, user_id=userid)
+        for problem, users in zip(problems, assignees) for userid in users)
+
+    tag_objects = models.ProblemTag.get_or_create_many(
+        name for names in tags for name in names)
+    Link = models.Problem.tags.through
+    links = [Link(problem_id=problem.pk, problemtag_id=tag_objects[name].pk)
+             for problem, names in zip(problems, tags)
+             for name in set(names)]
+    Link.objects.bulk_create(links)
+
+    # bulk_create skips the m2m_changed signal that maintains the counts
+    counts = {}
+    for link in links:
+        counts[link.problemtag_id] = counts.get(link.problemtag_id, 0) + 1
+    for tagid, count in counts.items():
+        models.ProblemTag.objects.filter(pk=tagid).update(
+            problem_count=F('problem_count') + count)
+
+    events.emit_many(webhooks.models.PROBLEM_TAGS_CHANGED, (
+        {'problem': problem.pk, 'tag': name, 'action': 'added'}
+        for problem, names in zip(problems, tags) for name in set(names)))
+
+
+def route_problems(problems, tags):
+    '''
+    Apply the routing rules to new `problems`, adding the names of the
+    tags they are routed to to the parallel lists in `tags`.
+
+    :returns: a list of the sets of IDs of the users each problem is
+      routed to.
+    '''
+    router = models.RoutingRule.router()
+    if not router:
+        return [set() for problem in problems]
+
+    matches = [router.match(problem.title, problem.description)
+               for problem in problems]
+    # Rules route to tag IDs; look up the tags' current names
+    tag_names = dict(models.ProblemTag.objects.filter(
+        pk__in=set(tag for matched in matches for tag, userid in matched
+                   if tag is not None)).values_list('pk', 'name'))
+
+    assignees = []
+    for matched, names in zip(matches, tags):
+        names.extend(sorted(set(tag_names[tag] for tag, userid in matched
+                                if tag in tag_names) - set(names)))
+        assignees.append(set(userid for tag, userid in matched
+                             if userid is not None))
+    return assignees
+
+
+def route_problem(problem):
+    '''
+    Apply the routing rules to a newly saved `problem`, tagging and
+    assigning it.
+    '''
+    link_new_problems([problem], [[]])
+
+
+#: Attempts made by `report_problems` when concurrent reports collide
+REPORT_ATTEMPTS = 3
+
+
+def fingerprint_hash(user, fingerprint):
+    '''
+    Return the value stored in `Problem.fingerprint` for a problem that
+    `user` reports with `fingerprint`. Fingerprints are scoped to the
+    reporting user so that unrelated robots cannot collide.
+    '''
+    value = '%i:%s' % (user.pk, fingerprint)
+    return hashlib.sha256(value.encode('utf8')).hexdigest()
+
+
+@transaction.atomic
+def report_problems(user, problems, tags, fingerprints):
+    '''
+    Like `create_problems`, but a problem with a fingerprint that
+    `user` has reported before is counted as another occurrence of the
+    existing problem instead of being created again.
+
+    :param list fingerprints: A fingerprint string or None for each
+      problem, parallel to `problems`.
+    :returns: a list of `(pk, created)` tuples, parallel to `problems`.
+    '''
+    hashes = [fingerprint_hash(user, fingerprint) if fingerprint else None
+              for fingerprint in fingerprints]
+
+    for attempt in range(REPORT_ATTEMPTS):
+        existing = dict(models.Problem.objects
+                        .filter(fingerprint__in=set(filter(None, hashes)))
+                        .values_list('fingerprint', 'pk'))
+
+        # The problem created for each new fingerprint; later repeats
+        # within this batch are occurrences of it
+        first = {}
+        new_problems = []
+        new_tags = []
+        for problem, names, value in zip(problems, tags, hashes):
+            if value in existing or value in first:
+                continue
+            problem.fingerprint = value
+            if value is not None:
+                first[value] = problem
+            new_problems.append(problem)
+            new_tags.append(names)
+
+        try:
+            with transaction.atomic():
+                create_problems(user, new_problems, new_tags)
+            break
+        except IntegrityError:
+            # A concurrent report created one of the fingerprints first;
+            # look them up again
+            for problem in new_problems:
+                problem.pk = None
+            if attempt == REPORT_ATTEMPTS - 1:
+                raise
+
+    results = []
+    repeats = {}
+    for problem, value in zip(problems, hashes):
+        if value is None or first.get(value) is problem:
+            results.append((problem.pk, True))
+            continue
+        pk = existing[value] if value in existing else first[value].pk
+        repeats[pk] = repeats.get(pk, 0) + 1
+        results.append((pk, False))
+
+    if repeats:
+        for pk, count in repeats.items():
+            models.Problem.objects.filter(pk=pk).update(
+                occurrence_count=F('occurrence_count') + count,
+                last_occurred=timezone.now())
+        models.Occurrence.objects.bulk_create(
+            models.Occurrence(problem_id=pk, user=user)
+            for pk, count in repeats.items() for i in range(count))
+        models.Change.objects.filter(problem__in=list(repeats)).delete()
+        models.Change.objects.bulk_create(
+            models.Change(problem_id=pk) for pk in repeats)
+
+    return results
+
+
+def problem_version(pk):
+    '''
+    Return the change sequence number of a problem, which grows every
+    time the problem is saved, a reply to it is added or edited or its
+    tags or assignees change; or None if the problem does not exist.
+    '''
+    versions = models.Change.objects.filter(problem=pk).values_list(
+        'pk', flat=True)
+    return versions[0] if versions else None
+
+
+def feed_version():
+    '''
+    Return the highest change sequence number, which grows whenever any
+    problem or reply is created, changed or deleted.
+    '''
+    return models.Change.objects.aggregate(version=Max('pk'))['version'] or 0
+
+
+def make_etag(*parts):
+    '''
+    Build a compact entity tag from `parts`.
+    '''
+    value = '|'.join(str(part) for part in (RENDER_VERSION,) + parts)
+    return hashlib.sha1(value.encode('utf8')).hexdigest()
+
+
+def problem_view_etag(request, pk):
+    version = problem_version(pk)
+    if version is None:
+        return None
+
+    # Logged-in users see a reply form with their name and CSRF token
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated():
+        return make_etag('view', pk, version, user.pk,
+                         request.META.get('CSRF_COOKIE'))
+    return make_etag('view', pk, version)
+
+
+def problem_list_etag(request, subset):
+    return make_etag('list', subset, feed_version(),
+                     request.GET.urlencode())
+
+
+def tag_view_etag(request, tag):
+    return make_etag('tag', tag, feed_version())
@@ -1,18 +1,23 @@
 import django.http
+from django.db import transaction
 from django.shortcuts import render
 from django.contrib.auth.decorators import login_required
+from django.views.decorators.http import condition
 
+from gravel.queries import query_budget
 from problems import models, forms, utils
 
 
+@query_budget(2)
 def problem_report(request):
     form = utils.create_form_with_request(request)
     return render(request, 'problems/report.html', {'form': form})
 
 
+@query_budget(21)
 def problem_submit(request):
     '''
-    Create a new Problem and store it in the database.
+    Create a new Problem, store it in the database and route it.
     '''
     if request.method != 'POST':
         form = utils.create_form_with_request(request)
@@ -29,17 +34,21 @@ def problem_submit(request):
         problem.userref = request.user
         problem.username = request.user.get_full_name()
         problem.userauthed = True
-    problem.save()
+    with transaction.atomic():
+        problem.save()
+        utils.route_problem(problem)
 
     return django.http.HttpResponseRedirect('/problem/view/%i/' % problem.pk)
 
 
+@query_budget(6)
+@condition(etag_func=utils.problem_view_etag)
 def problem_view(request, pk):
     '''
     Return an HTML page for viewing a specific Problem.
     '''
     try:
-        problem = models.Problem.objects.get(pk=pk)
+        problem = utils.get_problem_for_view(pk)
     except models.Problem.DoesNotExist:
         # TODO: nicer error message
         return django.http.HttpResponseNotFound('Invalid problem ID')
@@ -50,21 +59,41 @@ def problem_view(request, pk):
         form = None
 
     return render(request, 'problems/view.html',
-                  {'problem': problem, 'form': form})
+                  {'problem': problem, 'replies': problem.reply_list,
+                   'form': form})
 
 
+@query_budget(4)
+@condition(etag_func=utils.problem_list_etag)
 def problem_list(request, subset):
     '''
-    Return a page listing all the problems.
+    Return a page listing the problems, newest first. The `resolved`,
+    `assignee` and `tag` query parameters filter the list and `cursor`
+    selects the page.
     '''
-    if subset == 'all':
-        problems = models.Problem.objects.all()
-        return render(request, 'problems/list.html',
-                      {'problems': problems, 'subset': 'All'})
-
-    else:
+    if subset != 'all':
         raise django.http.Http404()
 
+    try:
+        problems = utils.filter_problems(
+            models.Problem.objects.select_related('last_reply_user'),
+            request.GET)
+        problems, cursor = utils.paginate_problems(
+            problems, request.GET.get('cursor'))
+    except ValueError as e:
+        return django.http.HttpResponseBadRequest(str(e))
+
+    next_page = None
+    if cursor:
+        params = request.GET.copy()
+        params['cursor'] = cursor
+        next_page = '?' + params.urlencode()
+
+    return render(request, 'problems/list.html',
+                  {'problems': problems, 'subset': 'All',
+                   'next_page': next_page})
+
+@query_budget(18)
 @login_required
 def problem_reply_submit(request, pk):
     '''
@@ -82,13 +111,13 @@ def problem_reply_submit(request, pk):
 
     form = forms.ReplySubmit(request.POST)
     if not form.is_valid():
+        problem = utils.get_problem_for_view(pk)
         return render(request, 'problems/view.html',
-                      {'problem': problem, 'form': form})
+                      {'problem': problem, 'replies': problem.reply_list,
+                       'form': form})
 
     reply = form.save(commit=False)
     reply.user = request.user
-    reply.save()
-
     problem.add_response(reply)
 
     return django.http.HttpResponseRedirect('/problem/view/%i/' % problem.pk)
@@ -102,6 +131,36 @@ def problem_edit(request, pk):
     pass
 
 
+@query_budget(5)
+def problem_search(request):
+    '''
+    Search the titles, descriptions and replies of problems for the
+    terms in the `q` query parameter.
+    '''
+    query = request.GET.get('q', '')
+    try:
+        page = max(1, int(request.GET.get('page', 1)))
+    except ValueError:
+        return django.http.HttpResponseBadRequest('Invalid page number')
+
+    page_size = 20
+    results = models.SearchTerm.search(query, (page - 1) * page_size,
+                                       page_size + 1)
+
+    next_page = None
+    if len(results) > page_size:
+        results = results[:page_size]
+        params = request.GET.copy()
+        params['page'] = page + 1
+        next_page = '?' + params.urlencode()
+
+    return render(request, 'problems/search.html',
+                  {'query': query, 'results': results,
+                   'next_page': next_page})
+
+
+@query_budget(5)
+@condition(etag_func=utils.tag_view_etag)
 def tag_view(request, tag):
     '''
     Display a tag and the related problems.
@@ -0,0 +1,7 @@
+from django.contrib import admin
+from webhooks import models
+
+
+admin.site.register(models.Endpoint)
+admin.site.register(models.Event)
+admin.site.register(models.Delivery)
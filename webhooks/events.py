@@ -0,0 +1,29 @@
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+from webhooks import models
+
+
+def emit(event_type, data):
+    '''
+    Record an event in the outbox. Call this inside the transaction
+    that makes the change so that the event is stored if, and only if,
+    the change is committed.
+
+    :param str event_type: One of `models.EVENT_TYPES`.
+    :param dict data: JSON-serializable event data.
+    '''
+    models.Event.objects.create(
+        type=event_type, payload=json.dumps(data, cls=DjangoJSONEncoder))
+
+
+def emit_many(event_type, items):
+    '''
+    Record one event of `event_type` for each dict in `items` with a
+    single bulk insert.
+    '''
+    models.Event.objects.bulk_create(
+        models.Event(type=event_type,
+                     payload=json.dumps(data, cls=DjangoJSONEncoder))
+        for data in items)
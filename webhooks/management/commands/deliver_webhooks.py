@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+
+from webhooks.worker import Worker
+
+
+class Command(BaseCommand):
+    help = 'Deliver webhook events from the outbox to their endpoints.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', default=False,
+                            help='Make one round of deliveries and exit')
+        parser.add_argument('--threads', type=int, default=8,
+                            help='Number of concurrent sending threads')
+        parser.add_argument('--batch-size', type=int, default=50,
+                            help='Most events sent to an endpoint per POST')
+        parser.add_argument('--interval', type=float, default=1,
+                            help='Seconds to sleep when there is no work')
+        parser.add_argument('--retention-days', type=float, default=7,
+                            help='Days to keep events and finished '
+                                 'deliveries for; 0 keeps them forever')
+
+    def handle(self, *args, **options):
+        worker = Worker(threads=options['threads'],
+                        batch_size=options['batch_size'],
+                        retention=options['retention_days'] * 24 * 3600
+                        or None)
+
+        try:
+            if options['once']:
+                stats = worker.run_once()
+                self.stdout.write('Dispatched %(dispatched)i events, '
+                                  'delivered %(delivered)i, failed '
+                                  '%(failed)i' % stats)
+            else:
+                worker.run_forever(options['interval'])
+        finally:
+            worker.close()
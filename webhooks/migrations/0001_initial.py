@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import webhooks.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Delivery',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('status', models.CharField(max_length=10, default='pending', choices=[('pending', 'Pending'), ('delivered', 'Delivered'), ('failed', 'Failed')])),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('next_attempt', models.DateTimeField()),
+                ('last_error', models.TextField(blank=True, default='')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Endpoint',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('url', models.URLField()),
+                ('secret', models.CharField(max_length=64, default=webhooks.models.generate_secret)),
+                ('events', models.CharField(max_length=200, blank=True, default='')),
+                ('max_concurrency', models.PositiveSmallIntegerField(default=2)),
+                ('active', models.BooleanField(default=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Event',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('type', models.CharField(max_length=40)),
+                ('payload', models.TextField()),
+                ('date', models.DateTimeField(auto_now_add=True)),
+                ('dispatched', models.BooleanField(db_index=True, default=False)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='delivery',
+            name='endpoint',
+            field=models.ForeignKey(to='webhooks.Endpoint'),
+        ),
+        migrations.AddField(
+            model_name='delivery',
+            name='event',
+            field=models.ForeignKey(to='webhooks.Event'),
+        ),
+        migrations.AlterIndexTogether(
+            name='delivery',
+            index_together=set([('status', 'next_attempt')]),
+        ),
+    ]
@@ -0,0 +1,87 @@
+import os
+import binascii
+
+from django.db import models
+
+
+#: Event types that can be sent to endpoints
+PROBLEM_CREATED = 'problem.created'
+PROBLEM_RESOLVED = 'problem.resolved'
+PROBLEM_TAGS_CHANGED = 'problem.tags_changed'
+REPLY_ADDED = 'reply.added'
+
+EVENT_TYPES = (PROBLEM_CREATED, PROBLEM_RESOLVED, PROBLEM_TAGS_CHANGED,
+               REPLY_ADDED)
+
+
+def generate_secret():
+    return binascii.hexlify(os.urandom(32)).decode('ascii')
+
+
+class Endpoint(models.Model):
+    '''
+    A URL that is sent webhook events.
+    '''
+    url = models.URLField(max_length=200)
+    #: Key for the X-Gravel-HMAC-SHA256 header sent with every delivery
+    secret = models.CharField(max_length=64, default=generate_secret)
+    #: Comma-separated event types to send; empty means every type
+    events = models.CharField(max_length=200, blank=True, default='')
+    #: The largest number of requests in flight to this endpoint at once
+    max_concurrency = models.PositiveSmallIntegerField(default=2)
+    active = models.BooleanField(default=True)
+
+    def wants(self, event_type):
+        if not self.events:
+            return True
+        return event_type in [e.strip() for e in self.events.split(',')]
+
+    def __str__(self):
+        return self.url
+
+
+class Event(models.Model):
+    '''
+    The outbox: one row per event, written in the same transaction as
+    the change that caused it and fanned out to endpoints later by the
+    delivery worker.
+    '''
+    type = models.CharField(max_length=40)
+    #: The JSON-encoded event data
+    payload = models.TextField()
+    date = models.DateTimeField(auto_now_add=True)
+    #: Whether Delivery rows have been created for this event yet
+    dispatched = models.BooleanField(default=False, db_index=True)
+
+    def __str__(self):
+        return 'Event %i: %s' % (self.pk, self.type)
+
+
+class Delivery(models.Model):
+    '''
+    The delivery state of one event to one endpoint.
+    '''
+    PENDING = 'pending'
+    DELIVERED = 'delivered'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (PENDING, 'Pending'),
+        (DELIVERED, 'Delivered'),
+        (FAILED, 'Failed'),
+    )
+
+    event = models.ForeignKey(Event)
+    endpoint = models.ForeignKey(Endpoint)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES,
+                              default=PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    #: When the next attempt may be made
+    next_attempt = models.DateTimeField()
+    last_error = models.TextField(blank=True, default='')
+
+    class Meta:
+        index_together = [('status', 'next_attempt'),
+                          ('endpoint', 'status', 'next_attempt')]
+
+    def __str__(self):
+        return 'Delivery of %i to %s' % (self.event_id, self.endpoint_id)
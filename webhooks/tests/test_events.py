@@ -0,0 +1,83 @@
+import json
+
+from django.test import TestCase
+from django.contrib.auth.models import User
+from django.db import transaction
+
+from problems.models import Problem, ProblemTag, Reply
+from webhooks import models
+
+
+class TestEvents(TestCase):
+    '''
+    Test that changes to problems write the expected events to the
+    outbox.
+    '''
+
+    def setUp(self):
+        self.user = User(username='test', email='test@example.com')
+        self.user.set_password('test')
+        self.user.save()
+
+    def events(self, event_type):
+        return [json.loads(event.payload) for event in
+                models.Event.objects.filter(type=event_type).order_by('pk')]
+
+    def test_problem_created(self):
+        problem = Problem(title='test', description='test')
+        problem.save()
+        problem.title = 'changed'
+        problem.save()
+
+        created = self.events(models.PROBLEM_CREATED)
+        self.assertEqual([event['id'] for event in created], [problem.pk])
+
+    def test_problem_resolved(self):
+        problem = Problem(title='test', description='test')
+        problem.save()
+        self.assertEqual(self.events(models.PROBLEM_RESOLVED), [])
+
+        problem = Problem.objects.get(pk=problem.pk)
+        problem.resolved = True
+        problem.save()
+        problem.save()
+
+        resolved = self.events(models.PROBLEM_RESOLVED)
+        self.assertEqual([event['id'] for event in resolved], [problem.pk])
+
+    def test_reply_added(self):
+        problem = Problem(title='test', description='test')
+        problem.save()
+        reply = Reply(user=self.user, text='hello')
+        reply.save()
+        problem.add_response(reply)
+
+        added = self.events(models.REPLY_ADDED)
+        self.assertEqual(len(added), 1)
+        self.assertEqual(added[0]['problem'], problem.pk)
+        self.assertEqual(added[0]['reply']['id'], reply.pk)
+
+    def test_tags_changed(self):
+        problem = Problem(title='test', description='test')
+        problem.save()
+        tag = ProblemTag.get_or_create('robot')
+
+        problem.tags.add(tag)
+        tag.problem_set.remove(problem)
+
+        changed = self.events(models.PROBLEM_TAGS_CHANGED)
+        self.assertEqual([(e['problem'], e['tag'], e['action'])
+                          for e in changed],
+                         [(problem.pk, 'robot', 'added'),
+                          (problem.pk, 'robot', 'removed')])
+
+    def test_rolled_back_with_change(self):
+        try:
+            with transaction.atomic():
+                Problem(title='test', description='test').save()
+                raise RuntimeError()
+        except RuntimeError:
+            pass
+
+        self.assertFalse(models.Event.objects.exists(),
+                         'Event outlived the rolled back change')
@@ -0,0 +1,234 @@
+import hmac
+import json
+import hashlib
+import datetime
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from django.test import TestCase
+from django.utils import timezone
+
+from problems.models import Problem
+from webhooks import models
+from webhooks.worker import Worker
+
+
+class StubReceiver():
+    '''
+    A local HTTP server that records the webhook requests it receives
+    and answers with `status`, once `release` is set.
+    '''
+    def __init__(self, status=200):
+        self.status = status
+        self.requests = []
+        self.release = threading.Event()
+        self.release.set()
+        receiver = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers['Content-Length'])
+                body = self.rfile.read(length)
+                receiver.release.wait()
+                receiver.requests.append((dict(self.headers), body))
+                self.send_response(receiver.status)
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self.server = HTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%i/hook' % self.server.server_port
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def events(self):
+        return [event for headers, body in self.requests
+                for event in json.loads(body.decode('utf8'))['events']]
+
+    def close(self):
+        self.release.set()
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class TestWorker(TestCase):
+    '''
+    Test delivery of outbox events to a local stub receiver.
+    '''
+
+    def setUp(self):
+        self.receiver = StubReceiver()
+        self.addCleanup(self.receiver.close)
+        self.endpoint = models.Endpoint.objects.create(url=self.receiver.url)
+
+    def create_problems(self, count):
+        for i in range(count):
+            Problem(title='test %i' % i, description='test').save()
+
+    def worker(self, **kwargs):
+        worker = Worker(**kwargs)
+        self.addCleanup(worker.close)
+        return worker
+
+    def test_batched_delivery(self):
+        self.endpoint.max_concurrency = 4
+        self.endpoint.save()
+        self.create_problems(5)
+
+        stats = self.worker(batch_size=2).run_once()
+
+        self.assertEqual(stats, {'dispatched': 5, 'delivered': 5,
+                                 'failed': 0})
+        self.assertEqual(len(self.receiver.requests), 3)
+        # Concurrent batches may arrive in any order
+        self.assertEqual(
+            sorted(e['data']['title'] for e in self.receiver.events()),
+            ['test %i' % i for i in range(5)])
+        self.assertFalse(models.Delivery.objects.exclude(
+            status=models.Delivery.DELIVERED).exists())
+
+        # Nothing is sent twice
+        self.worker().run_once()
+        self.assertEqual(len(self.receiver.requests), 3)
+
+    def test_signature(self):
+        self.create_problems(1)
+        self.worker().run_once()
+
+        headers, body = self.receiver.requests[0]
+        expected = hmac.new(self.endpoint.secret.encode('utf8'), body,
+                            hashlib.sha256).hexdigest()
+        self.assertEqual(headers['X-Gravel-Hmac-Sha256'], expected)
+
+    def test_concurrency_limit(self):
+        '''
+        Test that a round sends no more batches to an endpoint than its
+        concurrency limit allows.
+        '''
+        self.endpoint.max_concurrency = 1
+        self.endpoint.save()
+        self.create_problems(4)
+
+        worker = self.worker(batch_size=2)
+        worker.run_once()
+        self.assertEqual(len(self.receiver.requests), 1)
+        worker.run_once()
+        self.assertEqual(len(self.receiver.requests), 2)
+
+    def test_event_filter(self):
+        self.endpoint.events = models.PROBLEM_RESOLVED
+        self.endpoint.save()
+        self.create_problems(2)
+
+        self.worker().run_once()
+        self.assertEqual(self.receiver.requests, [])
+        self.assertFalse(models.Delivery.objects.exists())
+
+    def test_retry_with_backoff(self):
+        self.receiver.status = 500
+        self.create_problems(1)
+
+        worker = self.worker(backoff=10, max_attempts=3)
+        with self.assertLogs('webhooks.worker', 'WARNING'):
+            stats = worker.run_once()
+        self.assertEqual(stats['failed'], 1)
+
+        delivery = models.Delivery.objects.get()
+        self.assertEqual(delivery.status, models.Delivery.PENDING)
+        self.assertEqual(delivery.attempts, 1)
+        wait = delivery.next_attempt - timezone.now()
+        self.assertTrue(datetime.timedelta(seconds=5) < wait <=
+                        datetime.timedelta(seconds=10))
+
+        # Not due yet, so nothing is sent
+        worker.run_once()
+        self.assertEqual(len(self.receiver.requests), 1)
+
+        # The wait doubles after the second failure
+        models.Delivery.objects.update(next_attempt=timezone.now())
+        with self.assertLogs('webhooks.worker', 'WARNING'):
+            worker.run_once()
+        delivery = models.Delivery.objects.get()
+        wait = delivery.next_attempt - timezone.now()
+        self.assertTrue(datetime.timedelta(seconds=15) < wait <=
+                        datetime.timedelta(seconds=20))
+
+        # The third failure is final
+        models.Delivery.objects.update(next_attempt=timezone.now())
+        with self.assertLogs('webhooks.worker', 'WARNING'):
+            worker.run_once()
+        delivery = models.Delivery.objects.get()
+        self.assertEqual(delivery.status, models.Delivery.FAILED)
+
+        # A recovered endpoint does not get failed deliveries
+        self.receiver.status = 200
+        worker.run_once()
+        self.assertEqual(len(self.receiver.requests), 3)
+
+    def test_endpoints_read_separately(self):
+        '''
+        Test that every endpoint gets its own batches, however many
+        deliveries another endpoint has due.
+        '''
+        other = models.Endpoint.objects.create(url=self.receiver.url,
+                                               max_concurrency=1)
+        self.create_problems(6)
+
+        worker = self.worker(batch_size=2)
+        worker.dispatch()
+        batches = worker.due_batches()
+        self.assertEqual([(endpoint.pk, len(deliveries))
+                          for endpoint, deliveries in batches],
+                         [(self.endpoint.pk, 2), (self.endpoint.pk, 2),
+                          (other.pk, 2)])
+
+    def test_slow_endpoint(self):
+        '''
+        Test that a round does not wait for a slow endpoint, and that its
+        requests are recorded in a later round.
+        '''
+        slow = StubReceiver()
+        self.addCleanup(slow.close)
+        slow.release.clear()
+        models.Endpoint.objects.create(url=slow.url)
+        self.create_problems(1)
+
+        worker = self.worker(round_wait=0.2)
+        stats = worker.run_once()
+        self.assertEqual(stats['delivered'], 1)
+        self.assertEqual(len(self.receiver.requests), 1)
+
+        # The slow request is not sent again while it is in flight
+        stats = worker.run_once()
+        self.assertEqual(stats['delivered'], 0)
+
+        slow.release.set()
+        worker.round_wait = 5
+        stats = worker.run_once()
+        self.assertEqual(stats['delivered'], 1)
+        self.assertEqual(len(slow.requests), 1)
+        self.assertFalse(models.Delivery.objects.exclude(
+            status=models.Delivery.DELIVERED).exists())
+
+    def test_purge(self):
+        '''
+        Test that events and finished deliveries past their retention
+        are deleted, and pending deliveries and their events are kept.
+        '''
+        self.create_problems(3)
+        worker = self.worker(retention=3600)
+        worker.dispatch()
+        old = timezone.now() - datetime.timedelta(hours=2)
+        events = list(models.Event.objects.order_by('pk'))
+        models.Event.objects.filter(pk__in=[e.pk for e in events[:2]]).update(
+            date=old)
+        models.Delivery.objects.filter(event=events[0]).update(
+            status=models.Delivery.DELIVERED)
+
+        self.assertEqual(worker.purge(batch_size=1), 2)
+        self.assertEqual(
+            list(models.Event.objects.values_list('pk', flat=True)
+                 .order_by('pk')), [events[1].pk, events[2].pk])
+        self.assertEqual(models.Delivery.objects.count(), 2)
@@ -0,0 +1,260 @@
+'''
+Delivery of webhook events from the outbox.
+
+A `Worker` runs in its own process (see the deliver_webhooks management
+command), so the request path never waits on outbound HTTP. Each round
+it fans new outbox events out into one `Delivery` per interested
+endpoint, then sends the due deliveries. Deliveries to the same endpoint
+are batched into one POST, and a thread pool sends the batches
+concurrently, with at most `Endpoint.max_concurrency` requests in flight
+per endpoint. A round waits a bounded time for its requests; those still
+in flight are recorded in a later round, so a slow endpoint does not
+hold up the others. Concurrent batches may arrive out of order;
+receivers can order events by their IDs. Failed deliveries are retried
+with exponential backoff until `max_attempts` is reached. Events and
+finished deliveries are deleted once they are older than `retention`.
+
+Only one worker process should run at a time; it does not lease rows
+against other workers.
+'''
+import json
+import hmac
+import time
+import hashlib
+import datetime
+import logging
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from django.db import transaction
+from django.utils import timezone
+
+from webhooks import models
+
+
+logger = logging.getLogger(__name__)
+
+
+class Worker():
+    def __init__(self, threads=8, batch_size=50, max_attempts=8,
+                 backoff=30, max_backoff=3600, timeout=10, round_wait=1,
+                 retention=7 * 24 * 3600, purge_interval=3600):
+        '''
+        :param int threads: Size of the pool of sending threads.
+        :param int batch_size: Most events sent in one POST.
+        :param int max_attempts: Attempts before a delivery fails.
+        :param float backoff: Seconds to wait after the first failure;
+          doubled after every further failure.
+        :param float max_backoff: The longest wait between attempts.
+        :param float timeout: Seconds to wait for an endpoint.
+        :param float round_wait: The longest a round waits for its
+          requests to finish.
+        :param float retention: Seconds to keep events and finished
+          deliveries for, or None to keep them forever.
+        :param float purge_interval: Seconds between purges.
+        '''
+        self.threads = threads
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.round_wait = round_wait
+        self.retention = retention
+        self.purge_interval = purge_interval
+
+        self.pool = ThreadPoolExecutor(max_workers=threads)
+        #: The deliveries of each batch still being sent, by its future
+        self.in_flight = {}
+        self.last_purge = None
+
+    def close(self):
+        '''
+        Wait for the requests in flight and stop the sending threads.
+        '''
+        self.pool.shutdown(wait=True)
+
+    def dispatch(self, limit=1000):
+        '''
+        Create Delivery rows for up to `limit` new outbox events.
+
+        :returns: the number of events dispatched.
+        '''
+        endpoints = list(models.Endpoint.objects.filter(active=True))
+        now = timezone.now()
+
+        with transaction.atomic():
+            events = list(models.Event.objects.filter(dispatched=False)
+                          .order_by('pk')[:limit])
+            if not events:
+                return 0
+
+            models.Delivery.objects.bulk_create(
+                models.Delivery(event=event, endpoint=endpoint,
+                                next_attempt=now)
+                for event in events
+                for endpoint in endpoints if endpoint.wants(event.type))
+            models.Event.objects.filter(
+                pk__in=[event.pk for event in events]
+            ).update(dispatched=True)
+
+        return len(events)
+
+    def due_batches(self):
+        '''
+        Group the due deliveries of each endpoint into batches, up to
+        the endpoint's `max_concurrency` less its batches in flight.
+        Every endpoint is read separately, so one with a long backlog
+        does not crowd out the others.
+
+        :returns: a list of `(endpoint, deliveries)` tuples.
+        '''
+        busy = {}
+        for deliveries in self.in_flight.values():
+            busy.setdefault(deliveries[0].endpoint_id, []).append(deliveries)
+
+        now = timezone.now()
+        batches = []
+        for endpoint in models.Endpoint.objects.filter(active=True):
+            sending = busy.get(endpoint.pk, [])
+            slots = max(endpoint.max_concurrency, 1) - len(sending)
+            if slots <= 0:
+                continue
+            pks = [delivery.pk for deliveries in sending
+                   for delivery in deliveries]
+
+            due = list(models.Delivery.objects
+                       .filter(endpoint=endpoint,
+                               status=models.Delivery.PENDING,
+                               next_attempt__lte=now)
+                       .exclude(pk__in=pks)
+                       .select_related('event')
+                       .order_by('next_attempt', 'pk')
+                       [:slots * self.batch_size])
+            for delivery in due:
+                delivery.endpoint = endpoint
+            batches.extend((endpoint, due[i:i + self.batch_size])
+                           for i in range(0, len(due), self.batch_size))
+        return batches
+
+    def send(self, endpoint, deliveries):
+        '''
+        POST a batch of events to `endpoint`. This runs in a pool thread
+        and does not touch the database.
+
+        :returns: None on success, or a string describing the failure.
+        '''
+        body = json.dumps({'events': [
+            {'id': d.event.pk, 'type': d.event.type,
+             'date': d.event.date.isoformat(),
+             'data': json.loads(d.event.payload)}
+            for d in deliveries
+        ]}).encode('utf8')
+        signature = hmac.new(endpoint.secret.encode('utf8'), body,
+                             hashlib.sha256).hexdigest()
+
+        request = urllib.request.Request(endpoint.url, data=body, headers={
+            'Content-Type': 'application/json',
+            'X-Gravel-HMAC-SHA256': signature,
+        })
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as r:
+                if 200 <= r.status < 300:
+                    return None
+                return 'HTTP %i' % r.status
+        except Exception as e:
+            return str(e) or e.__class__.__name__
+
+    def record(self, deliveries, error):
+        '''
+        Store the outcome of sending `deliveries`.
+        '''
+        pks = [delivery.pk for delivery in deliveries]
+        if error is None:
+            models.Delivery.objects.filter(pk__in=pks).update(
+                status=models.Delivery.DELIVERED, last_error='')
+            return
+
+        now = timezone.now()
+        for delivery in deliveries:
+            delivery.attempts += 1
+            delivery.last_error = error[:1000]
+            if delivery.attempts >= self.max_attempts:
+                delivery.status = models.Delivery.FAILED
+            else:
+                wait = min(self.backoff * 2 ** (delivery.attempts - 1),
+                           self.max_backoff)
+                delivery.next_attempt = now + datetime.timedelta(seconds=wait)
+            delivery.save(update_fields=['attempts', 'last_error', 'status',
+                                         'next_attempt'])
+
+    def purge(self, batch_size=1000):
+        '''
+        Delete finished deliveries of events older than `retention`,
+        then those events once they have no deliveries left, at most
+        `batch_size` rows per statement.
+
+        :returns: the number of rows deleted.
+        '''
+        cutoff = timezone.now() - datetime.timedelta(seconds=self.retention)
+        deleted = 0
+        for queryset in (
+                models.Delivery.objects.filter(event__date__lt=cutoff)
+                .exclude(status=models.Delivery.PENDING),
+                models.Event.objects.filter(date__lt=cutoff, dispatched=True,
+                                            delivery=None)):
+            while True:
+                pks = list(queryset.values_list('pk', flat=True)
+                           [:batch_size])
+                if not pks:
+                    break
+                queryset.model.objects.filter(pk__in=pks).delete()
+                deleted += len(pks)
+        return deleted
+
+    def run_once(self):
+        '''
+        Dispatch new events, start sending the due deliveries and record
+        the requests that finish within `round_wait`, purging old rows
+        every `purge_interval`.
+
+        :returns: a dict counting events dispatched and deliveries that
+          succeeded and failed this round.
+        '''
+        stats = {'dispatched': self.dispatch(), 'delivered': 0, 'failed': 0}
+
+        for endpoint, deliveries in self.due_batches():
+            future = self.pool.submit(self.send, endpoint, deliveries)
+            self.in_flight[future] = deliveries
+
+        if self.in_flight:
+            done, pending = wait(self.in_flight, timeout=self.round_wait)
+            for future in done:
+                deliveries = self.in_flight.pop(future)
+                error = future.result()
+                self.record(deliveries, error)
+                if error is None:
+                    stats['delivered'] += len(deliveries)
+                else:
+                    stats['failed'] += len(deliveries)
+                    logger.warning('Webhook delivery to %s failed: %s',
+                                   deliveries[0].endpoint.url, error)
+
+        now = time.monotonic()
+        if self.retention is not None and (
+                self.last_purge is None or
+                now - self.last_purge >= self.purge_interval):
+            self.last_purge = now
+            logger.info('Purged %i webhook rows', self.purge())
+
+        return stats
+
+    def run_forever(self, interval=1):
+        '''
+        Call `run_once` repeatedly, sleeping `interval` seconds after
+        any round that had nothing to do.
+        '''
+        while True:
+            stats = self.run_once()
+            if not any(stats.values()):
+                time.sleep(interval)